@@ -0,0 +1,121 @@
+import os
+import bz2
+import gzip
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from granule_validation import netcdf_lock
+
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open}
+
+
+# Checks whether a granule is .gz or .bz2 compressed
+def is_compressed(filename):
+    return os.path.splitext(filename)[1] in OPENERS
+
+
+# Strips the compression extension, adding .nc if nothing is left to say what the file is
+def decompressed_name(filename):
+    name = os.path.splitext(filename)[0]
+    return name if os.path.splitext(name)[1] else f'{name}.nc'
+
+
+# Rewrites a netCDF file with every variable zlib compressed at complevel
+def compress_netcdf(src_fp, dst_fp, complevel):
+    import netCDF4
+
+    with netcdf_lock, netCDF4.Dataset(src_fp, 'r') as src, netCDF4.Dataset(dst_fp, 'w', format='NETCDF4') as dst:
+        src.set_auto_maskandscale(False)
+        dst.setncatts({attr: src.getncattr(attr) for attr in src.ncattrs()})
+
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        for name, var in src.variables.items():
+            attrs = {attr: var.getncattr(attr) for attr in var.ncattrs()}
+            fill_value = attrs.pop('_FillValue', None)
+            compress = bool(var.dimensions) and var.dtype != str
+
+            out = dst.createVariable(name, var.datatype, var.dimensions, zlib=compress,
+                                     complevel=complevel, fill_value=fill_value)
+            out.set_auto_maskandscale(False)
+            out.setncatts(attrs)
+            out[...] = var[...]
+
+
+# Streams a .gz or .bz2 granule into cache_fp, optionally recompressing it as netCDF4
+# A cache file newer than the granule is reused
+# Returns the cache path, the md5 checksum of the cache file and its size
+def decompress_granule(local_fp, cache_fp, complevel=0):
+    cache_dir = os.path.dirname(cache_fp)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    if not (os.path.exists(cache_fp) and os.path.getmtime(cache_fp) >= os.path.getmtime(local_fp)):
+        tmp_fp = f'{cache_fp}.tmp'
+        with OPENERS[os.path.splitext(local_fp)[1]](local_fp, 'rb') as src, open(tmp_fp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+        if complevel:
+            try:
+                compress_netcdf(tmp_fp, f'{tmp_fp}.nc4', complevel)
+                os.replace(f'{tmp_fp}.nc4', tmp_fp)
+            except Exception as e:
+                print(f'Unable to recompress {os.path.basename(cache_fp)}, keeping it uncompressed: {e}')
+                if os.path.exists(f'{tmp_fp}.nc4'):
+                    os.remove(f'{tmp_fp}.nc4')
+
+        os.replace(tmp_fp, cache_fp)
+
+    hash_md5 = hashlib.md5()
+    with open(cache_fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_md5.update(chunk)
+
+    return cache_fp, hash_md5.hexdigest(), os.path.getsize(cache_fp)
+
+
+# Decompresses .gz and .bz2 granules in a pool of threads while the harvester moves on to the
+# next download. Granules under source_dir are cached at the same relative path under cache_dir,
+# so transformation opens the decompressed file instead of decompressing it for every grid
+# on_done(cache_fp, checksum, size) is called from join() for each granule decompressed
+class DecompressionQueue:
+    def __init__(self, source_dir, cache_dir, workers=4, complevel=0):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.complevel = complevel
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+
+    def cache_path(self, local_fp):
+        relative_fp = os.path.relpath(local_fp, self.source_dir)
+        return os.path.join(self.cache_dir, os.path.dirname(relative_fp),
+                            decompressed_name(os.path.basename(relative_fp)))
+
+    # Queues local_fp for decompression
+    # Returns a future resolving to decompress_granule's result, for callers that must wait on it
+    def submit(self, local_fp, on_done=None):
+        future = self.executor.submit(decompress_granule, local_fp,
+                                      self.cache_path(local_fp), self.complevel)
+        self.pending.append((local_fp, future, on_done))
+        return future
+
+    # Waits for all queued decompressions and runs their callbacks
+    # Returns the number of granules that couldn't be decompressed
+    def join(self):
+        failures = 0
+        for local_fp, future, on_done in self.pending:
+            try:
+                cache_fp, checksum, size = future.result()
+            except Exception as e:
+                print(f'Unable to decompress {os.path.basename(local_fp)}: {e}')
+                failures += 1
+                continue
+
+            if on_done:
+                on_done(cache_fp, checksum, size)
+
+        self.pending = []
+        self.executor.shutdown()
+        return failures
@@ -0,0 +1,176 @@
+import os
+import argparse
+from datetime import datetime
+
+ROW_GROUP_SIZE = 8192
+
+
+# One row per harvested granule, sorted by date so each row group covers a narrow
+# date range and filters on date skip the row groups outside it
+# pyarrow is only imported when a manifest is written or read, so harvesters import this
+# module without it and only the manifest update fails
+def manifest_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ('filename', pa.string()),
+        ('date', pa.timestamp('s')),
+        ('hemisphere', pa.string()),
+        ('size', pa.int64()),
+        ('checksum', pa.string()),
+        ('mtime', pa.timestamp('s')),
+        ('source', pa.string()),
+        ('file_path', pa.string()),
+        ('harvest_success', pa.bool_()),
+        ('download_time', pa.timestamp('s'))
+    ])
+
+
+def manifest_path(output_path, dataset_name):
+    return f'{output_path}{dataset_name}/granule_manifest.parquet'
+
+
+# Solr update bodies wrap values as {"set": value}, queried docs don't
+def _value(doc, key):
+    value = doc.get(key)
+    if isinstance(value, dict):
+        value = value.get('set')
+    return value
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+
+# Builds manifest rows from harvested granule docs, as posted to or queried from Solr
+# mtime is the local file's modification time, so it can be checked against the copy on disk
+def manifest_records(docs):
+    records = []
+    for doc in docs:
+        if _value(doc, 'type_s') != 'harvested':
+            continue
+
+        file_path = _value(doc, 'pre_transformation_file_path_s') or ''
+        mtime = None
+        if file_path and not file_path.startswith('s3://') and os.path.exists(file_path):
+            mtime = datetime.utcfromtimestamp(int(os.path.getmtime(file_path)))
+
+        records.append({
+            'filename': _value(doc, 'filename_s') or '',
+            'date': _timestamp(_value(doc, 'date_s')),
+            'hemisphere': _value(doc, 'hemisphere_s'),
+            'size': _value(doc, 'file_size_l'),
+            'checksum': _value(doc, 'checksum_s'),
+            'mtime': mtime,
+            'source': _value(doc, 'source_s'),
+            'file_path': file_path,
+            'harvest_success': bool(_value(doc, 'harvest_success_b')),
+            'download_time': _timestamp(_value(doc, 'download_time_dt'))
+        })
+    return records
+
+
+# Granules are keyed like the descendants docs, by date and hemisphere
+def _keys(table):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    return pc.binary_join_element_wise(
+        pc.cast(table['date'], pa.string()), pc.fill_null(table['hemisphere'], ''), '|')
+
+
+# Merges harvested granule docs into the dataset's manifest, replacing the rows of granules
+# harvested again. If there's no manifest yet, seed() is called for every harvested doc of the
+# dataset so the manifest starts out complete
+# The file is replaced atomically, so readers never see a partial manifest
+def update_manifest(manifest_fp, docs, seed=None):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(manifest_fp) and seed:
+        docs = list(seed()) + list(docs)
+
+    schema = manifest_schema()
+    table = pa.Table.from_pylist(manifest_records(docs), schema=schema)
+
+    # Later docs win over earlier ones for the same granule
+    if table.num_rows:
+        keys = _keys(table).to_pylist()
+        last = {key: i for i, key in enumerate(keys)}
+        table = table.take(sorted(last.values()))
+
+    if os.path.exists(manifest_fp):
+        existing = pq.read_table(manifest_fp, schema=schema)
+        keep = pc.invert(pc.is_in(_keys(existing), value_set=_keys(table)))
+        table = pa.concat_tables([existing.filter(keep), table])
+
+    table = table.sort_by([('date', 'ascending'), ('hemisphere', 'ascending')])
+
+    manifest_dir = os.path.dirname(manifest_fp)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+
+    pq.write_table(table, f'{manifest_fp}.tmp', row_group_size=ROW_GROUP_SIZE)
+    os.replace(f'{manifest_fp}.tmp', manifest_fp)
+
+    return table.num_rows
+
+
+# Reads manifest rows as dicts
+# filters are pyarrow filters, e.g. [('date', '>=', datetime(2010, 1, 1)), ('hemisphere', '=', 'nh')],
+# and are pushed down so row groups outside them aren't read
+def read_manifest(manifest_fp, filters=None, columns=None):
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(manifest_fp):
+        return []
+    return pq.read_table(manifest_fp, columns=columns, filters=filters).to_pylist()
+
+
+# Summarises the granules covered between start and end, per year and hemisphere
+def coverage(manifest_fp, start=None, end=None, hemisphere=None):
+    filters = []
+    if start:
+        filters.append(('date', '>=', start))
+    if end:
+        filters.append(('date', '<=', end))
+    if hemisphere:
+        filters.append(('hemisphere', '=', hemisphere))
+
+    rows = read_manifest(manifest_fp, filters=filters or None,
+                         columns=['date', 'hemisphere', 'size', 'harvest_success'])
+
+    summary = {}
+    for row in rows:
+        key = (row['date'].year, row['hemisphere'] or '')
+        entry = summary.setdefault(
+            key, {'granules': 0, 'failed': 0, 'bytes': 0, 'first': row['date'], 'last': row['date']})
+        entry['granules'] += 1
+        entry['failed'] += 0 if row['harvest_success'] else 1
+        entry['bytes'] += row['size'] or 0
+        entry['first'] = min(entry['first'], row['date'])
+        entry['last'] = max(entry['last'], row['date'])
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Print the harvested coverage recorded in a granule manifest')
+    parser.add_argument('manifest', help='granule_manifest.parquet in a dataset output directory')
+    parser.add_argument('--start', help='first date, as YYYYMMDD')
+    parser.add_argument('--end', help='last date, as YYYYMMDD')
+    parser.add_argument('--hemisphere', help='only granules of this hemisphere')
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y%m%d') if args.start else None
+    end = datetime.strptime(args.end, '%Y%m%d') if args.end else None
+
+    for (year, hemi), entry in sorted(coverage(args.manifest, start, end, args.hemisphere).items()):
+        print(f'{year} {hemi or "-"}\t{entry["granules"]} granules ({entry["failed"]} failed), '
+              f'{entry["bytes"] / 1e6:.1f} MB, {entry["first"]:%Y-%m-%d} to {entry["last"]:%Y-%m-%d}')
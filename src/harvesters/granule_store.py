@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+
+# Content addressed store of harvested granule files, shared across datasets
+# Files are kept once under blobs/, keyed by their md5 checksum, and hardlinked
+# (or symlinked across filesystems) into each dataset's harvested_granules layout.
+# sources/ maps each upstream source url to the checksum last harvested from it,
+# so re-harvests and cloned datasets can link the file instead of downloading it.
+class GranuleStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.blobs_dir = os.path.join(store_dir, 'blobs')
+        self.sources_dir = os.path.join(store_dir, 'sources')
+
+        for directory in [self.blobs_dir, self.sources_dir]:
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+
+    def blob_path(self, checksum):
+        return os.path.join(self.blobs_dir, checksum[:2], checksum)
+
+    def _source_path(self, source):
+        source_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        return os.path.join(self.sources_dir, f'{source_hash}.json')
+
+    # Returns the entry recorded for source, or None if there isn't one
+    def _entry(self, source):
+        source_path = self._source_path(source)
+        if not os.path.exists(source_path):
+            return None
+
+        with open(source_path, 'r') as f:
+            entry = json.load(f)
+
+        return entry if entry['source'] == source else None
+
+    # Returns the checksum of the stored copy of source, or None if there isn't one
+    # A stored copy only counts if it was harvested from the same upstream modified time
+    def lookup(self, source, modified_dt=None):
+        entry = self._entry(source)
+        if not entry or entry['modified_dt'] != modified_dt:
+            return None
+
+        if not os.path.exists(self.blob_path(entry['checksum'])):
+            return None
+
+        return entry['checksum']
+
+    # Points local_fp at the blob, replacing whatever was there
+    def _link(self, blob_fp, local_fp):
+        tmp_fp = f'{local_fp}.linking'
+        if os.path.lexists(tmp_fp):
+            os.remove(tmp_fp)
+
+        try:
+            os.link(blob_fp, tmp_fp)
+        except OSError:
+            os.symlink(os.path.abspath(blob_fp), tmp_fp)
+
+        os.replace(tmp_fp, local_fp)
+
+    # Checks whether local_fp is the blob last stored for source, hardlinked or symlinked
+    # Files hardlinked anywhere else, like a backup of the output directory, aren't the store's
+    def _is_linked(self, local_fp, source):
+        entry = self._entry(source)
+        if not entry or not os.path.exists(local_fp):
+            return False
+
+        blob_fp = self.blob_path(entry['checksum'])
+        return os.path.exists(blob_fp) and os.path.samefile(blob_fp, local_fp)
+
+    # Links the stored copy of source to local_fp
+    # Returns True if it was linked, False if source has to be downloaded
+    # On a miss, a local_fp linked to a stale blob is removed so the download
+    # can't write through the link into the store
+    def checkout(self, source, modified_dt, local_fp):
+        checksum = self.lookup(source, modified_dt)
+
+        if checksum:
+            blob_fp = self.blob_path(checksum)
+            if not (os.path.exists(local_fp) and os.path.samefile(blob_fp, local_fp)):
+                self._link(blob_fp, local_fp)
+            return True
+
+        if self._is_linked(local_fp, source):
+            os.remove(local_fp)
+        return False
+
+    # Adds a downloaded file to the store and records where it came from
+    # If the store already has identical contents, local_fp is replaced by a link to them
+    def checkin(self, local_fp, source, modified_dt=None, checksum=''):
+        if os.path.islink(local_fp):
+            local_fp = os.path.realpath(local_fp)
+
+        if not checksum:
+            hash_md5 = hashlib.md5()
+            with open(local_fp, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hash_md5.update(chunk)
+            checksum = hash_md5.hexdigest()
+
+        blob_fp = self.blob_path(checksum)
+
+        if not os.path.exists(blob_fp):
+            if not os.path.exists(os.path.dirname(blob_fp)):
+                os.makedirs(os.path.dirname(blob_fp), exist_ok=True)
+
+            # The blob is made under a temporary name, copied there across filesystems, and
+            # linked into place, which never replaces a blob another harvest stored meanwhile
+            tmp_fp = f'{blob_fp}.tmp{os.getpid()}'
+            if os.path.lexists(tmp_fp):
+                os.remove(tmp_fp)
+            try:
+                os.link(local_fp, tmp_fp)
+            except OSError:
+                shutil.copy2(local_fp, tmp_fp)
+
+            try:
+                os.link(tmp_fp, blob_fp)
+            except FileExistsError:
+                # Already stored, local_fp is linked to the stored copy below
+                pass
+            finally:
+                os.remove(tmp_fp)
+
+        # Copies and files matching a stored blob are linked to it so the data is only kept once
+        if not os.path.samefile(blob_fp, local_fp):
+            self._link(blob_fp, local_fp)
+
+        entry = {'source': source,
+                 'modified_dt': modified_dt,
+                 'checksum': checksum,
+                 'size': os.path.getsize(blob_fp)}
+
+        source_path = self._source_path(source)
+        with open(f'{source_path}.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(f'{source_path}.tmp', source_path)
+
+        return checksum
+
+    # Removes blobs no dataset links to anymore, and source entries pointing at removed blobs
+    # Hardlinked blobs are in use while their link count is above one. Symlinks are only
+    # found by scanning, so the output directories holding dataset layouts are given as roots
+    # Returns the number of blobs removed and the bytes freed
+    def collect_garbage(self, roots=(), dry_run=False):
+        symlinked = set()
+        for root in roots:
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    fp = os.path.join(dirpath, filename)
+                    if os.path.islink(fp):
+                        symlinked.add(os.path.realpath(fp))
+
+        removed = 0
+        freed = 0
+        for dirpath, _, filenames in os.walk(self.blobs_dir):
+            for filename in filenames:
+                blob_fp = os.path.join(dirpath, filename)
+                stat = os.stat(blob_fp)
+
+                if stat.st_nlink > 1 or os.path.realpath(blob_fp) in symlinked:
+                    continue
+
+                removed += 1
+                freed += stat.st_size
+                if not dry_run:
+                    os.remove(blob_fp)
+
+        if not dry_run:
+            for filename in os.listdir(self.sources_dir):
+                source_path = os.path.join(self.sources_dir, filename)
+                try:
+                    with open(source_path, 'r') as f:
+                        entry = json.load(f)
+                    if not os.path.exists(self.blob_path(entry['checksum'])):
+                        os.remove(source_path)
+                except Exception as e:
+                    print(f'Unable to read {source_path}: {e}')
+
+        return removed, freed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Remove granule store files no longer linked from any dataset')
+    parser.add_argument('store_dir', help='granule_store_dir from the harvester configs')
+    parser.add_argument('roots', nargs='*',
+                        help='output directories to scan for symlinks into the store')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='only report what would be removed')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.store_dir):
+        print(f'{args.store_dir} is not a granule store')
+        sys.exit(1)
+
+    removed, freed = GranuleStore(args.store_dir).collect_garbage(
+        args.roots, args.dry_run)
+    action = 'Would remove' if args.dry_run else 'Removed'
+    print(f'{action} {removed} granules ({freed / 1e6:.1f} MB)')
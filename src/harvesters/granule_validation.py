@@ -0,0 +1,226 @@
+import os
+import json
+import struct
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+NETCDF3_SIGNATURES = [b'CDF\x01', b'CDF\x02', b'CDF\x05']
+
+# Compressed granules can't be checked without decompressing them, so they're passed through
+COMPRESSED_SIGNATURES = [b'\x1f\x8b', b'BZh']
+
+# netCDF-C isn't thread safe, so threads reading or writing netCDF files take turns
+# netCDF4 itself is only imported by the functions that open files, so harvesters that never
+# validate or recompress granules don't need it
+netcdf_lock = threading.Lock()
+
+
+# Finds the HDF5 superblock, which sits at 0 or at a power of two past 512 when there's a user block
+# Returns the end of file address it records, or None if it can't be read
+def hdf5_end_of_file(f, file_size):
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        if f.read(8) == HDF5_SIGNATURE:
+            break
+        offset = 512 if offset == 0 else offset * 2
+    else:
+        return None
+
+    header = f.read(40)
+    version = header[0]
+
+    if version in (0, 1):
+        size_of_offsets = header[5]
+        address_start = 16 if version == 0 else 20
+    elif version in (2, 3):
+        size_of_offsets = header[1]
+        address_start = 4
+    else:
+        return None
+
+    if size_of_offsets not in (4, 8):
+        return None
+    fmt = '<I' if size_of_offsets == 4 else '<Q'
+    undefined = 2 ** (8 * size_of_offsets) - 1
+
+    f.seek(offset + 8 + address_start)
+    addresses = f.read(size_of_offsets * 3)
+    if len(addresses) < size_of_offsets * 3:
+        return None
+
+    base_address = struct.unpack(fmt, addresses[:size_of_offsets])[0]
+    # v0/v1 keep the free space address between the base and end of file addresses,
+    # v2/v3 keep the superblock extension address there
+    eof_address = struct.unpack(fmt, addresses[2 * size_of_offsets:])[0]
+
+    if undefined in (base_address, eof_address):
+        return None
+    return base_address + eof_address
+
+
+# Converts numpy attribute values into something json can write
+def json_value(value):
+    if isinstance(value, np.ndarray):
+        return [json_value(v) for v in value.tolist()]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return str(value)
+    return value
+
+
+# Summarises what downstream stages need to know about a granule from its open header:
+# dimension sizes, the time range covered, and the shape, type, fill value and
+# valid range of each field, so transformation can plan and size work without opening the file
+def header_summary(ds, fields, time_dim='time'):
+    import netCDF4
+
+    summary = {'dims': {name: len(dim) for name, dim in ds.dimensions.items()},
+               'variables': {}}
+
+    for field in fields:
+        if field not in ds.variables:
+            continue
+        var = ds.variables[field]
+        entry = {'dims': list(var.dimensions),
+                 'shape': list(var.shape),
+                 'dtype': str(var.dtype)}
+        for attr in ['units', '_FillValue', 'missing_value', 'valid_min', 'valid_max', 'valid_range',
+                     'scale_factor', 'add_offset']:
+            if attr in var.ncattrs():
+                entry[attr] = json_value(var.getncattr(attr))
+        summary['variables'][field] = entry
+
+    # The time coordinate is small, so its values are read to record the time range
+    if time_dim and time_dim in ds.variables:
+        time_var = ds.variables[time_dim]
+        bounds = time_var.getncattr('bounds') if 'bounds' in time_var.ncattrs() else None
+        values = ds.variables[bounds][:] if bounds in ds.variables else time_var[:]
+
+        if np.ma.count(values):
+            times = [np.ma.min(values), np.ma.max(values)]
+            try:
+                times = [t.isoformat() for t in netCDF4.num2date(times, time_var.units,
+                                                                 getattr(time_var, 'calendar', 'standard'))]
+            except Exception:
+                times = [json_value(t) for t in times]
+            summary['time_start'], summary['time_end'] = times
+
+    return summary
+
+
+# Checks a harvested granule by reading only its header
+# The file must open, hold every field in fields and a time dimension or variable (unless
+# time_dim is None), and be at least as long as its header says it is
+# Returns a description of the problem (an empty string if the granule looks complete)
+# and the granule's header summary (None if the header couldn't be read)
+def inspect_granule(local_fp, fields, time_dim='time'):
+    import netCDF4
+
+    if not os.path.exists(local_fp):
+        return 'file missing', None
+
+    file_size = os.path.getsize(local_fp)
+    if not file_size:
+        return 'file empty', None
+
+    with open(local_fp, 'rb') as f:
+        signature = f.read(8)
+
+        if any(signature.startswith(s) for s in COMPRESSED_SIGNATURES):
+            return '', None
+
+        if signature[:4] not in NETCDF3_SIGNATURES:
+            expected_size = hdf5_end_of_file(f, file_size)
+            if expected_size is None:
+                return 'not a netCDF or HDF5 file', None
+            if file_size < expected_size:
+                return f'file truncated ({file_size} of {expected_size} bytes)', None
+
+    try:
+        with netcdf_lock, netCDF4.Dataset(local_fp, 'r') as ds:
+            variables = ds.variables
+            summary = header_summary(ds, fields, time_dim)
+
+            missing = [field for field in fields if field not in variables]
+            if missing:
+                return f'missing variables {", ".join(missing)}', summary
+
+            if time_dim and time_dim not in ds.dimensions and time_dim not in variables:
+                return f'missing {time_dim} dimension', summary
+
+            # netCDF3 headers don't record the file length, but the variables can't fit in less
+            if ds.data_model.startswith('NETCDF3'):
+                data_size = sum(v.size * v.dtype.itemsize for v in variables.values()
+                                if v.dimensions and v.dtype != str)
+                if file_size < data_size:
+                    return f'file truncated ({file_size} bytes for {data_size} bytes of data)', None
+    except Exception as e:
+        return f'unreadable header ({e})', None
+
+    return '', summary
+
+
+# Returns a description of what's wrong with a harvested granule, or an empty string if nothing is
+def validate_granule(local_fp, fields, time_dim='time'):
+    return inspect_granule(local_fp, fields, time_dim)[0]
+
+
+# Validates and summarises granule headers in a pool of threads while the harvester moves on
+# to the next download. With validate off, headers are only summarised and never fail
+# Headers are read one at a time under netcdf_lock, so extra workers only help by waiting on
+# decompressing granules side by side, not by reading headers in parallel
+# time_dim is only checked for if given, since some products keep time in their global attributes
+# From join(), a granule's on_summary(summary_json) is called if its header could be read
+# and on_failure(message) is called if it didn't pass
+class ValidationQueue:
+    def __init__(self, fields, workers=1, time_dim=None, validate=True):
+        self.fields = fields
+        self.time_dim = time_dim
+        self.validate = validate
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+
+    def _inspect(self, local_fp, after):
+        if after:
+            try:
+                local_fp = after.result()[0]
+            except Exception as e:
+                return (f'decompression unsuccessful ({e})' if self.validate else ''), None
+
+        message, summary = inspect_granule(local_fp, self.fields, self.time_dim)
+        return (message if self.validate else ''), summary
+
+    # Queues local_fp for validation
+    # after can be a DecompressionQueue future, in which case the decompressed file is validated
+    # Returns a future resolving to the (message, summary) pair, for callers that must wait on it
+    def submit(self, local_fp, on_failure=None, on_summary=None, after=None):
+        future = self.executor.submit(self._inspect, local_fp, after)
+        self.pending.append((local_fp, future, on_failure, on_summary))
+        return future
+
+    # Waits for all queued validations and runs their callbacks
+    # Returns the number of granules that failed
+    def join(self):
+        failures = 0
+        for local_fp, future, on_failure, on_summary in self.pending:
+            try:
+                message, summary = future.result()
+            except Exception as e:
+                message, summary = (f'validation error ({e})' if self.validate else ''), None
+
+            if summary and on_summary:
+                on_summary(json.dumps(summary, separators=(',', ':')))
+
+            if message:
+                print(f'{os.path.basename(local_fp)} failed validation: {message}')
+                failures += 1
+                if on_failure:
+                    on_failure(message)
+
+        self.pending = []
+        self.executor.shutdown()
+        return failures
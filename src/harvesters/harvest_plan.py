@@ -0,0 +1,115 @@
+import os
+import json
+from datetime import datetime
+
+
+# Decides what a harvest has to do with a granule given the existing harvested docs
+# Returns 'download' for granules never harvested, 'refresh' for granules that previously
+# failed or were modified upstream since their last harvest, and 'skip' otherwise
+def granule_action(docs, filename, mod_date_time=None):
+    if filename not in docs.keys():
+        return 'download'
+
+    doc = docs[filename]
+
+    if not doc['harvest_success_b']:
+        return 'refresh'
+
+    if mod_date_time and datetime.strptime(doc['download_time_dt'], "%Y-%m-%dT%H:%M:%SZ") <= mod_date_time:
+        return 'refresh'
+
+    return 'skip'
+
+
+# Parses the modified time recorded on a granule entry
+# Falls back to now when the source didn't provide one, so the granule is always fetched
+def modified_date_time(granule, now):
+    if granule.get('modified_dt'):
+        return datetime.strptime(granule['modified_dt'], "%Y-%m-%dT%H:%M:%SZ")
+    return now
+
+
+# Checks whether a granule would actually be transferred, or if the local copy is already current
+def needs_transfer(local_fp, mod_date_time):
+    if not os.path.exists(local_fp):
+        return True
+    return datetime.fromtimestamp(os.path.getmtime(local_fp)) <= mod_date_time
+
+
+# Builds the manifest of a harvest plan from the granule listing
+# Each granule entry has at least filename, source, date, action, size and transfer keys
+# size_upper_bound marks granules whose size is only an upper bound, like subsets sized by their full file
+def make_harvest_plan(config, harvester_type, granules):
+    summary = {}
+
+    for action in ['download', 'refresh', 'skip']:
+        action_granules = [g for g in granules if g['action'] == action]
+        summary[action] = {
+            'granules': len(action_granules),
+            'bytes': sum([g['size'] or 0 for g in action_granules])
+        }
+
+    to_transfer = [g for g in granules if g['action'] != 'skip' and g['transfer']]
+    bytes_to_transfer = sum([g['size'] or 0 for g in to_transfer])
+
+    # Expected sustained download rate, used to estimate how long the harvest will take
+    throughput_mb_s = config.get('plan_throughput_mb_s', 10)
+
+    summary['granules_to_transfer'] = len(to_transfer)
+    summary['bytes_to_transfer'] = bytes_to_transfer
+    summary['unknown_size_granules'] = len(
+        [g for g in to_transfer if g['size'] is None])
+    summary['upper_bound_size_granules'] = len(
+        [g for g in to_transfer if g.get('size_upper_bound')])
+    summary['estimated_seconds'] = round(
+        bytes_to_transfer / (throughput_mb_s * 1e6), 1)
+
+    plan = {
+        'dataset': config['ds_name'],
+        'harvester_type': harvester_type,
+        'start': config['start'],
+        'end': config['end'],
+        'created_dt': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'summary': summary,
+        'granules': granules
+    }
+    return plan
+
+
+# Writes a harvest plan manifest to disk and prints its summary
+def write_harvest_plan(plan, plan_path):
+    plan_dir = os.path.dirname(plan_path)
+    if plan_dir and not os.path.exists(plan_dir):
+        os.makedirs(plan_dir)
+
+    with open(plan_path, 'w') as f:
+        json.dump(plan, f, indent=2)
+
+    summary = plan['summary']
+    print(f'Harvest plan for {plan["dataset"]} written to {plan_path}')
+    for action in ['download', 'refresh', 'skip']:
+        print(
+            f'\t{action}: {summary[action]["granules"]} granules ({summary[action]["bytes"] / 1e6:.1f} MB)')
+    print(
+        f'\t{summary["granules_to_transfer"]} granules to transfer ({summary["bytes_to_transfer"] / 1e6:.1f} MB)')
+    if summary['unknown_size_granules']:
+        print(f'\t{summary["unknown_size_granules"]} granules of unknown size')
+    if summary.get('upper_bound_size_granules'):
+        print(f'\t{summary["upper_bound_size_granules"]} granules sized by their full file, an upper bound for the subset transferred')
+    print(f'\testimated transfer time: {summary["estimated_seconds"]} s')
+
+
+# Reads the granule listing back from a harvest plan manifest
+# Returns None if the manifest belongs to another dataset
+def read_harvest_plan(plan_path, config):
+    with open(plan_path, 'r') as f:
+        plan = json.load(f)
+
+    if plan['dataset'] != config['ds_name']:
+        print(
+            f'Harvest plan {plan_path} is for {plan["dataset"]}, not {config["ds_name"]}')
+        return None
+
+    print(
+        f'Using granule listing from harvest plan created {plan["created_dt"]}')
+    return plan['granules']
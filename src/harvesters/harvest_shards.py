@@ -0,0 +1,95 @@
+import os
+import yaml
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+DATE_FORMAT = "%Y%m%dT%H:%M:%SZ"
+
+
+# Splits the configured start to end range into one config per year, and per region as well
+# if by_region is set, so each shard lists and downloads only its own part of the harvest
+# Returns (label, config) pairs
+def shard_configs(config, by_region=False):
+    start = datetime.strptime(config['start'], DATE_FORMAT)
+    end = datetime.strptime(config['end'], DATE_FORMAT)
+    regions = config['regions'] if by_region and config.get('regions') else [None]
+
+    shards = []
+    for year in range(start.year, end.year + 1):
+        shard_start = max(start, datetime(year, 1, 1))
+        shard_end = min(end, datetime(year, 12, 31, 23, 59, 59))
+
+        for region in regions:
+            shard_config = dict(config)
+            shard_config['start'] = shard_start.strftime(DATE_FORMAT)
+            shard_config['end'] = shard_end.strftime(DATE_FORMAT)
+
+            label = str(year)
+            if region is not None:
+                shard_config['regions'] = [region]
+                label = f'{year}_{region}'
+
+            shards.append((label, shard_config))
+
+    return shards
+
+
+# Runs harvest_function over each shard of the harvest in a pool of worker processes
+# Each shard runs as a full harvest with its own connections, called with shard=True so it
+# returns its granule metadata instead of posting it to Solr
+# Returns the results of the shards that finished
+def run_shards(harvest_function, config, output_path, workers, by_region=False):
+    shard_dir = f'{output_path}{config["ds_name"]}/shards/'
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    shard_paths = {}
+    for label, shard_config in shard_configs(config, by_region):
+        shard_path = f'{shard_dir}{label}_config.yaml'
+        with open(shard_path, 'w') as f:
+            yaml.dump(shard_config, f)
+        shard_paths[label] = shard_path
+
+    print(f'Harvesting {config["ds_name"]} in {len(shard_paths)} shards across {workers} processes')
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(harvest_function, config_path=shard_path, output_path=output_path, shard=True): label
+                   for label, shard_path in shard_paths.items()}
+
+        for future in as_completed(futures):
+            label = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(e)
+                print(f'Shard {label} of {config["ds_name"]} failed')
+                continue
+
+            if result:
+                print(f'Shard {label} of {config["ds_name"]} done')
+                results.append(result)
+
+    return results
+
+
+# Combines the results of the shards into the arguments of a single set of Solr updates
+# Lists (granule metadata and granule dates) are concatenated, and the shards' telemetry is
+# added into the sharded harvest's telemetry
+def merge_shard_results(results, telemetry=None):
+    merged = {'meta': [], 'last_success_item': {}, 'updating': False}
+
+    for result in results:
+        for key, value in result.items():
+            if key == 'telemetry':
+                if telemetry:
+                    telemetry.add_summary(value)
+            elif key == 'last_success_item':
+                if value:
+                    merged[key] = value
+            elif key == 'updating':
+                merged[key] = merged[key] or value
+            else:
+                merged.setdefault(key, []).extend(value)
+
+    return merged
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from urllib.request import urlretrieve
+
+
+# Collects per-phase timers and byte counters for one dataset's harvest
+# Phases are download, upload and solr. Downloads are also broken down per remote host,
+# with the time to first byte, so a slow server can be told apart from a slow disk or upload.
+# Safe to record into from the background upload threads
+class HarvestTelemetry:
+    def __init__(self, dataset_name):
+        self.dataset_name = dataset_name
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.hosts = {}
+        self.queue_depths = []
+
+    def record(self, phase, seconds, nbytes=0, host=None, first_byte=None):
+        with self.lock:
+            stats = self.phases.setdefault(
+                phase, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += nbytes
+
+            if host:
+                host_stats = self.hosts.setdefault(
+                    host, {'requests': 0, 'seconds': 0.0, 'bytes': 0, 'first_byte_seconds': []})
+                host_stats['requests'] += 1
+                host_stats['seconds'] += seconds
+                host_stats['bytes'] += nbytes
+                if first_byte is not None:
+                    host_stats['first_byte_seconds'].append(first_byte)
+
+    # Times the body of the with block as one operation of phase
+    # Bytes can be given up front or set on the yielded dict once known
+    @contextmanager
+    def phase(self, phase, nbytes=0, host=None):
+        op = {'bytes': nbytes, 'first_byte': None}
+        t0 = time.time()
+        try:
+            yield op
+        finally:
+            self.record(phase, time.time() - t0,
+                        op['bytes'], host, op['first_byte'])
+
+    def sample_queue_depth(self, depth):
+        with self.lock:
+            self.queue_depths.append(depth)
+
+    # urlretrieve, recording the transfer as a download from the url's host
+    def urlretrieve(self, url, local_fp):
+        with self.phase('download', host=urlparse(url).netloc) as op:
+            t0 = time.time()
+
+            # urlretrieve reports block 0 once the response headers are in
+            def reporthook(blocknum, blocksize, totalsize):
+                if op['first_byte'] is None:
+                    op['first_byte'] = time.time() - t0
+
+            result = urlretrieve(url, local_fp, reporthook)
+            op['bytes'] = os.path.getsize(local_fp)
+        return result
+
+    # ftp.retrbinary, recording the transfer as a download from the ftp host
+    def retrbinary(self, ftp, cmd, callback, blocksize=8192):
+        with self.phase('download', host=ftp.host) as op:
+            t0 = time.time()
+
+            def counting_callback(data):
+                if op['first_byte'] is None:
+                    op['first_byte'] = time.time() - t0
+                op['bytes'] += len(data)
+                callback(data)
+
+            return ftp.retrbinary(cmd, counting_callback, blocksize)
+
+    # Adds the counters of another harvest's summary, such as a shard of this one
+    # The summary only keeps each host's mean time to first byte, so that stands in for its requests
+    def add_summary(self, summary):
+        with self.lock:
+            for phase, stats in summary['phases'].items():
+                totals = self.phases.setdefault(
+                    phase, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                totals['count'] += stats['count']
+                totals['seconds'] += stats['seconds']
+                totals['bytes'] += stats['bytes']
+
+            for host, stats in summary['hosts'].items():
+                totals = self.hosts.setdefault(
+                    host, {'requests': 0, 'seconds': 0.0, 'bytes': 0, 'first_byte_seconds': []})
+                totals['requests'] += stats['requests']
+                totals['seconds'] += stats['seconds']
+                totals['bytes'] += stats['bytes']
+                if stats['mean_first_byte_seconds'] is not None:
+                    totals['first_byte_seconds'].extend(
+                        [stats['mean_first_byte_seconds']] * stats['requests'])
+
+            if summary['upload_queue_depth']['samples']:
+                self.queue_depths.append(summary['upload_queue_depth']['max'])
+
+    def summary(self):
+        with self.lock:
+            phases = {}
+            for phase, stats in self.phases.items():
+                phases[phase] = dict(stats)
+                phases[phase]['seconds'] = round(stats['seconds'], 3)
+                phases[phase]['mb_per_second'] = round(
+                    stats['bytes'] / 1e6 / stats['seconds'], 3) if stats['seconds'] else None
+
+            hosts = {}
+            for host, stats in self.hosts.items():
+                first_bytes = stats['first_byte_seconds']
+                hosts[host] = {
+                    'requests': stats['requests'],
+                    'seconds': round(stats['seconds'], 3),
+                    'bytes': stats['bytes'],
+                    'mb_per_second': round(stats['bytes'] / 1e6 / stats['seconds'], 3) if stats['seconds'] else None,
+                    'mean_first_byte_seconds': round(sum(first_bytes) / len(first_bytes), 3) if first_bytes else None,
+                    'max_first_byte_seconds': round(max(first_bytes), 3) if first_bytes else None
+                }
+
+            queue_depth = {
+                'samples': len(self.queue_depths),
+                'max': max(self.queue_depths) if self.queue_depths else 0,
+                'mean': round(sum(self.queue_depths) / len(self.queue_depths), 2) if self.queue_depths else 0
+            }
+
+        return {
+            'dataset': self.dataset_name,
+            'finished_dt': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'wall_seconds': round(time.time() - self.started, 3),
+            'phases': phases,
+            'hosts': hosts,
+            'upload_queue_depth': queue_depth
+        }
+
+    def write(self, report_path):
+        report_dir = os.path.dirname(report_path)
+        if report_dir and not os.path.exists(report_dir):
+            os.makedirs(report_dir)
+
+        with open(report_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+# Combines the per-dataset reports written by the harvesters into a single report
+def merge_reports(report_paths, merged_path):
+    reports = {}
+    for report_path in report_paths:
+        if not os.path.exists(report_path):
+            continue
+        with open(report_path, 'r') as f:
+            report = json.load(f)
+        reports[report['dataset']] = report
+
+    with open(merged_path, 'w') as f:
+        json.dump(reports, f, indent=2)
+
+    return reports
@@ -30,6 +30,17 @@ except ImportError:
     from urlparse import urlparse
     from urllib2 import urlopen, Request, HTTPError, URLError, build_opener, HTTPCookieProcessor
 
+# Shared harvester utilities live two directories up
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+import s3_uploads  # pylint: disable=import-error
+import harvest_plan  # pylint: disable=import-error
+import granule_store  # pylint: disable=import-error
+import harvest_telemetry  # pylint: disable=import-error
+import granule_validation  # pylint: disable=import-error
+import granule_decompression  # pylint: disable=import-error
+import granule_manifest  # pylint: disable=import-error
+import rate_limiter  # pylint: disable=import-error
+
 
 CMR_URL = 'https://cmr.earthdata.nasa.gov'
 URS_URL = 'https://urs.earthdata.nasa.gov'
@@ -240,6 +251,86 @@ def cmr_search(short_name, version, time_start, time_end,
         quit()
 
 
+# Picks the end of month granule for each month in the configured date range from the CMR url listing
+# Returns a list of granule entries (filename, url, date and file date)
+def seaice_granule_listing(config, url_list):
+    granules = []
+
+    start_year = config['start'][:4]
+    end_year = config['end'][:4]
+    years = np.arange(int(start_year), int(end_year) + 1)
+    start_time = datetime.datetime.strptime(
+        config['start'], config['date_regex'])
+    end_time = datetime.datetime.strptime(config['end'], config['date_regex'])
+
+    for year in years:
+
+        iso_dates_at_end_of_month = []
+
+        # pull one record per month
+        for month in range(1, 13):
+            # to find the last day of the month, we go up one month,
+            # and back one day
+            #   if Jan-Nov, then we'll go forward one month to Feb-Dec
+
+            if month < 12:
+                cur_mon_year = np.datetime64(
+                    str(year) + '-' + str(month+1).zfill(2))
+            # for december we go up one year, and set month to january
+            else:
+                cur_mon_year = np.datetime64(str(year+1) + '-' + str('01'))
+
+            # then back one day
+            last_day_of_month = cur_mon_year - np.timedelta64(1, 'D')
+
+            iso_dates_at_end_of_month.append(
+                (str(last_day_of_month)).replace('-', ''))
+
+        url_dict = {}
+
+        for file_date in iso_dates_at_end_of_month:
+            end_of_month_url = [url for url in url_list if file_date in url]
+
+            if end_of_month_url:
+                url_dict[file_date] = end_of_month_url[0]
+
+        for file_date, url in url_dict.items():
+
+            # Date in filename is end date of 30 day period
+            filename = url.split('/')[-1]
+
+            date = getdate(config['regex'], filename)
+            date_time = datetime.datetime.strptime(date, "%Y%m%d")
+            new_date_format = f'{date[:4]}-{date[4:6]}-{date[6:]}T00:00:00Z'
+
+            # check if file in download date range
+            if (start_time <= date_time) and (end_time >= date_time):
+                granules.append({
+                    'filename': filename,
+                    'source': url,
+                    'date': new_date_format,
+                    'file_date': file_date
+                })
+
+    return granules
+
+
+# Gets the size of a remote granule from a HEAD request, or None if the server doesn't report it
+def remote_file_size(url):
+    try:
+        credentials = get_credentials(url)
+        req = Request(url, method='HEAD')
+        req.add_header('Authorization',
+                       'Basic {0}'.format(credentials))
+        opener = build_opener(HTTPCookieProcessor())
+        length = opener.open(req).headers.get('Content-Length')
+        return int(length) if length else None
+    except Exception as e:
+        print('Unable to get size of ' + url, e)
+        return None
+
+
+
 def md5(fname):
     hash_md5 = hashlib.md5()
     with open(fname, 'rb') as f:
@@ -255,6 +346,41 @@ def getdate(regex, fname):
     return date
 
 
+def aws_upload_failed(item, descendants_item):
+    item['message_s'] = 'aws upload unsuccessful'
+    item['harvest_success_b'] = False
+    item['filename_s'] = ''
+    item['pre_transformation_file_path_s'] = ''
+    item['file_size_l'] = 0
+
+    descendants_item['harvest_success_b'] = False
+    descendants_item['pre_transformation_file_path_s'] = ''
+
+
+def decompressed(item, descendants_item, cache_fp, checksum, size):
+    item['compressed_file_path_s'] = item['pre_transformation_file_path_s']
+    item['pre_transformation_file_path_s'] = cache_fp
+    item['decompressed_checksum_s'] = checksum
+    item['decompressed_file_size_l'] = size
+
+    descendants_item['pre_transformation_file_path_s'] = cache_fp
+
+
+def validation_failed(item, descendants_item, message):
+    item['message_s'] = f'validation unsuccessful: {message}'
+    item['harvest_success_b'] = False
+
+    descendants_item['harvest_success_b'] = False
+
+
+# returns the last granule in meta that was harvested successfully, or {} if none was
+# only final once upload, decompression and validation queues have been joined
+def last_successful_item(meta):
+    successes = [entry for entry in meta
+                 if entry.get('type_s') == 'harvested' and entry.get('harvest_success_b')]
+    return successes[-1] if successes else {}
+
+
 def solr_query(config, solr_host, fq):
     solr_collection_name = config['solr_collection_name']
 
@@ -267,19 +393,39 @@ def solr_query(config, solr_host, fq):
     return response.json()['response']['docs']
 
 
-def solr_update(config, update_body, r=False):
+def solr_update(config, update_body, r=False, telemetry=None):
     solr_host = config['solr_host']
     solr_collection_name = config['solr_collection_name']
 
     url = solr_host + solr_collection_name + '/update?commit=true'
 
-    if r:
-        return requests.post(url, json=update_body)
+    if telemetry:
+        with telemetry.phase('solr'):
+            response = requests.post(url, json=update_body)
     else:
-        requests.post(url, json=update_body)
+        response = requests.post(url, json=update_body)
+
+    if r:
+        return response
 
 
-def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
+# merges the harvest's granule metadata into the dataset's local granule manifest
+# a dataset without a manifest yet is seeded from all of its harvested docs in solr
+def update_granule_manifest(config, solr_host, meta, output_path):
+    dataset_name = config['ds_name']
+    fq = ['dataset_s:' + dataset_name, 'type_s:harvested']
+    manifest_fp = granule_manifest.manifest_path(output_path, dataset_name)
+    try:
+        granule_manifest.update_manifest(
+            manifest_fp, meta, seed=lambda: solr_query(config, solr_host, fq))
+    except Exception as e:
+        print(e)
+        print('Unable to update granule manifest ' + manifest_fp)
+
+
+# In plan mode, only lists granules and writes a manifest of what a harvest would transfer
+# A manifest from plan mode can be given as manifest_path to skip searching CMR again
+def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False, plan=False, manifest_path=''):
     # =====================================================
     # Read configurations from YAML file
     # =====================================================
@@ -297,6 +443,19 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
         target_bucket_name = config['target_bucket_name']
         target_bucket = s3.Bucket(target_bucket_name)
 
+    # timers and byte counters for the harvest, reported once it finishes
+    telemetry = harvest_telemetry.HarvestTelemetry(config['ds_name'])
+
+    # pace requests to each remote host, shared with other harvests writing to output_path
+    limiter = rate_limiter.from_config(config, output_path)
+
+    # upload in the background while the next granules download
+    upload_queue = None
+    if on_aws and config.get('upload_workers', 0) and not plan:
+        upload_queue = s3_uploads.UploadQueue(target_bucket, config['upload_workers'],
+                                              int(config.get('s3_part_size_mb', 8) * 1024 * 1024),
+                                              telemetry=telemetry)
+
     # =====================================================
     # Download raw data files
     # =====================================================
@@ -304,6 +463,31 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
     target_dir = f'{output_path}{dataset_name}/harvested_granules/'
     folder = f'/tmp/{dataset_name}/'
     data_time_scale = config['data_time_scale']
+    stream_to_s3 = on_aws and config.get('stream_to_s3', False)
+    s3_part_size = int(config.get('s3_part_size_mb', 8) * 1024 * 1024)
+
+    # decompress .gz and .bz2 granules once at harvest instead of at every transformation
+    # the cache is only kept for local harvests
+    decompression_queue = None
+    if config.get('decompress', False) and not on_aws and not plan:
+        decompression_queue = granule_decompression.DecompressionQueue(target_dir, f'{output_path}{dataset_name}/decompressed_granules/',
+                                                                       config.get('decompress_workers', 2),
+                                                                       config.get('decompress_complevel', 0))
+
+    # check and summarise each downloaded granule's header in the background so bad downloads
+    # are marked as failed before they reach transformation, and transformation can plan from
+    # the summary without opening the file
+    # RDEFT4 granules carry their date in the filename, not a time dimension
+    validation_queue = None
+    if not plan:
+        validation_queue = granule_validation.ValidationQueue([field['name'] for field in config['fields']],
+                                                              config.get('validation_workers', 1),
+                                                              time_dim=config.get('validation_time_dim'),
+                                                              validate=config.get('validate_granules', True))
+
+    # shared content addressed store of harvested files, only used for local harvests
+    store = granule_store.GranuleStore(config['granule_store_dir']) \
+        if config.get('granule_store_dir') and not on_aws else None
 
     short_name = 'RDEFT4'
     solr_host = config['solr_host']
@@ -362,187 +546,267 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
     updating = False
     aws_upload = False
 
-    start_year = config['start'][:4]
-    end_year = config['end'][:4]
-    years = np.arange(int(start_year), int(end_year) + 1)
-    start_time = datetime.datetime.strptime(
-        config['start'], config['date_regex'])
-    end_time = datetime.datetime.strptime(config['end'], config['date_regex'])
+    # reuse the listing from a previous plan if given, otherwise search CMR
+    if manifest_path:
+        granules = harvest_plan.read_harvest_plan(manifest_path, config)
+        if granules is None:
+            return
+    else:
+        url_list = cmr_search(short_name, version,
+                              config['start'], config['end'])
+        granules = seaice_granule_listing(config, url_list)
+
+    # decide what to do with each granule against the current harvested docs
+    # there is no last modified time for these granules, so only new or failed granules are fetched
+    for granule in granules:
+        granule['action'] = harvest_plan.granule_action(
+            docs, granule['filename'])
+        granule['local_path'] = f'{target_dir}{granule["date"][:4]}/{granule["filename"]}'
+        granule['transfer'] = on_aws or harvest_plan.needs_transfer(
+            granule['local_path'], parser.parse(granule['file_date']))
+
+        # granules already in the granule store are linked, not transferred
+        if store and store.lookup(granule['source']):
+            granule['transfer'] = False
+
+    # in plan mode, write out the manifest without downloading or touching Solr
+    if plan:
+        for granule in granules:
+            granule['size'] = None
+            if granule['action'] != 'skip' and granule['transfer']:
+                granule['size'] = remote_file_size(granule['source'])
+
+        harvest_plan_doc = harvest_plan.make_harvest_plan(
+            config, 'seaice', granules)
+        harvest_plan.write_harvest_plan(
+            harvest_plan_doc, f'{output_path}{dataset_name}/harvest_plan.json')
+        return harvest_plan_doc
+
+    for granule in granules:
+        filename = granule['filename']
+        url = granule['source']
+        file_date = granule['file_date']
+        new_date_format = granule['date']
+        date = new_date_format[:10].replace('-', '')
+
+        local_fp = f'{folder}{config["ds_name"]}_granule.nc' if on_aws else f'{target_dir}{date[:4]}/{filename}'
+
+        # queued uploads need their own scratch file per granule
+        if upload_queue:
+            local_fp = f'{folder}{filename}'
+
+        if not os.path.exists(f'{target_dir}{date[:4]}/'):
+            os.makedirs(f'{target_dir}{date[:4]}/')
+
+        start.append(datetime.datetime.strptime(
+            new_date_format, config['date_regex']))
+        end.append(datetime.datetime.strptime(
+            new_date_format, config['date_regex']))
+
+        item = {}
+        item['type_s'] = 'harvested'
+        item['date_s'] = new_date_format
+        item['dataset_s'] = config['ds_name']
+        item['source_s'] = url
+
+        # descendants metadta setup to be populated for each granule
+        descendants_item = {}
+        descendants_item['type_s'] = 'descendants'
+
+        # Create or modify descendants entry in Solr
+        descendants_item['dataset_s'] = item['dataset_s']
+        descendants_item['date_s'] = item["date_s"]
+        descendants_item['source_s'] = item['source_s']
+
+        updating = False
+        aws_upload = False
 
-    url_list = cmr_search(short_name, version, config['start'], config['end'])
+        try:
 
-    for year in years:
+            # TODO: find a way to get last modified (see line 436 as well)
+            # get last modified date
+            # timestamp = ftp.voidcmd("MDTM "+url)[4:]    # string
+            # time = parser.parse(timestamp)              # datetime object
+            # timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ") # string
+            # item['modified_time_dt'] = timestamp
 
-        iso_dates_at_end_of_month = []
+            # compare modified timestamp or if granule previously downloaded
+            # updating = (not newfile in docs.keys()) or (not docs[newfile]['harvest_success_b']) or (datetime.datetime.strptime(docs[newfile]['download_time_dt'], "%Y-%m-%dT%H:%M:%SZ") <= time)
+            updating = granule['action'] != 'skip'
 
-        # pull one record per month
-        for month in range(1, 13):
-            # to find the last day of the month, we go up one month,
-            # and back one day
-            #   if Jan-Nov, then we'll go forward one month to Feb-Dec
+            # If streaming, pipe the download straight into S3
+            if updating and stream_to_s3:
+                aws_upload = True
+                output_filename = config['ds_name'] + '/' + filename
+                print('Streaming: ' + filename + ' to ' + target_bucket_name)
 
-            if month < 12:
-                cur_mon_year = np.datetime64(
-                    str(year) + '-' + str(month+1).zfill(2))
-            # for december we go up one year, and set month to january
-            else:
-                cur_mon_year = np.datetime64(str(year+1) + '-' + str('01'))
+                credentials = get_credentials(url)
+                req = Request(url)
+                req.add_header('Authorization',
+                               'Basic {0}'.format(credentials))
+                opener = build_opener(HTTPCookieProcessor())
+                with telemetry.phase('download', host=urlparse(url).netloc) as op:
+                    s3_stream = s3_uploads.upload_stream(
+                        limiter.call(urlparse(url).netloc, opener.open, req),
+                        target_bucket, output_filename, s3_part_size)
+                    op['bytes'] = s3_stream.size
+
+                item['checksum_s'] = s3_stream.md5
+                item['pre_transformation_file_path_s'] = s3_stream.s3_path
+                item['harvest_success_b'] = True
+                item['filename_s'] = filename
+                item['file_size_l'] = s3_stream.size
+
+            elif updating:
+                # link an identical granule from the granule store instead of downloading it
+                if store and store.checkout(url, None, local_fp):
+                    print('Linked from granule store: ' + local_fp)
+
+                elif not os.path.exists(local_fp):
+
+                    print('Downloading: ' + local_fp)
+
+                    credentials = get_credentials(url)
+                    req = Request(url)
+                    req.add_header('Authorization',
+                                   'Basic {0}'.format(credentials))
+                    opener = build_opener(HTTPCookieProcessor())
+                    with telemetry.phase('download', host=urlparse(url).netloc) as op:
+                        data = limiter.call(urlparse(url).netloc,
+                                            lambda: opener.open(req).read())
+                        op['bytes'] = len(data)
+                    open(local_fp, 'wb').write(data)
+
+                # elif datetime.datetime.fromtimestamp(os.path.getmtime(local_fp)) <= time:
+                elif datetime.datetime.fromtimestamp(os.path.getmtime(local_fp)) <= parser.parse(file_date):
+
+                    print('Updating: ' + local_fp)
+
+                    credentials = get_credentials(url)
+                    req = Request(url)
+                    req.add_header('Authorization',
+                                   'Basic {0}'.format(credentials))
+                    opener = build_opener(HTTPCookieProcessor())
+                    with telemetry.phase('download', host=urlparse(url).netloc) as op:
+                        data = limiter.call(urlparse(url).netloc,
+                                            lambda: opener.open(req).read())
+                        op['bytes'] = len(data)
+                    open(local_fp, 'wb').write(data)
 
-            # then back one day
-            last_day_of_month = cur_mon_year - np.timedelta64(1, 'D')
+                else:
+                    print('File already downloaded and up to date')
+
+                # calculate checksum and expected file size
+                item['checksum_s'] = md5(local_fp)
+                item['file_size_l'] = os.path.getsize(local_fp)
+
+                # keep the granule in the granule store so later harvests can link it
+                if store:
+                    store.checkin(local_fp, url, None, item['checksum_s'])
+
+                # decompressed granules are validated once they're decompressed
+                decompression = None
+                if decompression_queue and granule_decompression.is_compressed(local_fp):
+                    decompression = decompression_queue.submit(local_fp, on_done=lambda cache_fp, checksum, size, item=item, descendants_item=descendants_item:
+                                                               decompressed(item, descendants_item, cache_fp, checksum, size))
+
+                # uploads wait for the granule's validation so bad granules never reach s3
+                validation = None
+                if validation_queue:
+                    validation = validation_queue.submit(local_fp, on_failure=lambda message, item=item, descendants_item=descendants_item:
+                                                         validation_failed(item, descendants_item, message),
+                                                         on_summary=lambda summary, item=item: item.update({'header_summary_s': summary}),
+                                                         after=decompression)
+
+                # =====================================================
+                # ### Push data to s3 bucket
+                # =====================================================
+                output_filename = config['ds_name'] + \
+                    '/' + filename if on_aws else filename
+                item['pre_transformation_file_path_s'] = local_fp
+
+                # queued uploads wait for their validation on the upload thread, so the
+                # harvester can go on downloading
+                if on_aws and upload_queue:
+                    print('Queueing ' + filename + ' for upload')
+                    upload_queue.submit(local_fp, output_filename, remove_after=True,
+                                        on_failure=lambda e, item=item, descendants_item=descendants_item:
+                                        aws_upload_failed(item, descendants_item),
+                                        skip=validation and (lambda validation=validation: validation.result()[0]))
+                    item['pre_transformation_file_path_s'] = 's3://' + \
+                        config['target_bucket_name'] + \
+                        '/'+output_filename
+
+                elif on_aws and validation and validation.result()[0]:
+                    print('Not uploading ' + filename + ', it failed validation')
+
+                elif on_aws:
+                    aws_upload = True
+                    print("=========uploading file=========")
+                    # print('uploading '+output_filename)
+                    with telemetry.phase('upload', os.path.getsize(local_fp)):
+                        target_bucket.upload_file(
+                            local_fp, output_filename)
+                    item['pre_transformation_file_path_s'] = 's3://' + \
+                        config['target_bucket_name'] + \
+                        '/'+output_filename
+                    print("======uploading file DONE=======")
+
+                item['harvest_success_b'] = True
+                item['filename_s'] = filename
+
+        except Exception as e:
+            print('error', e)
+            if updating:
+                if aws_upload:
+                    print("======aws upload unsuccessful=======")
+                    item['message_s'] = 'aws upload unsuccessful'
 
-            iso_dates_at_end_of_month.append(
-                (str(last_day_of_month)).replace('-', ''))
+                else:
+                    print("Download "+filename+" failed.")
+                    print("======file not successful=======")
 
-        url_dict = {}
+                item['harvest_success_b'] = False
+                item['filename'] = ''
+                item['pre_transformation_file_path_s'] = ''
+                item['file_size_l'] = 0
 
-        for file_date in iso_dates_at_end_of_month:
-            end_of_month_url = [url for url in url_list if file_date in url]
+        if updating:
+            item['download_time_dt'] = chk_time
 
-            if end_of_month_url:
-                url_dict[file_date] = end_of_month_url[0]
+            # Update Solr entry using id if it exists
 
-        for file_date, url in url_dict.items():
+            key = descendants_item['date_s']
 
-            # Date in filename is end date of 30 day period
-            filename = url.split('/')[-1]
+            if key in descendants_docs.keys():
+                descendants_item['id'] = descendants_docs[key]['id']
 
-            date = getdate(config['regex'], filename)
-            date_time = datetime.datetime.strptime(date, "%Y%m%d")
-            new_date_format = f'{date[:4]}-{date[4:6]}-{date[6:]}T00:00:00Z'
+            descendants_item['harvest_success_b'] = item['harvest_success_b']
+            descendants_item['pre_transformation_file_path_s'] = item['pre_transformation_file_path_s']
+            meta.append(descendants_item)
 
-            local_fp = f'{folder}{config["ds_name"]}_granule.nc' if on_aws else f'{target_dir}{date[:4]}/{filename}'
+            # add item to metadata json
+            meta.append(item)
 
-            if not os.path.exists(f'{target_dir}{date[:4]}/'):
-                os.makedirs(f'{target_dir}{date[:4]}/')
+    # wait for background uploads so granule metadata reflects their outcome
+    if upload_queue:
+        print('Waiting for queued uploads to finish')
+        upload_queue.join()
 
-            start.append(datetime.datetime.strptime(
-                new_date_format, config['date_regex']))
-            end.append(datetime.datetime.strptime(
-                new_date_format, config['date_regex']))
+    # wait for decompression so granule metadata points at the decompressed copies
+    if decompression_queue:
+        failures = decompression_queue.join()
+        if failures:
+            print(str(failures) + ' granules could not be decompressed')
 
-            # check if file in download date range
-            if (start_time <= date_time) and (end_time >= date_time):
-                item = {}
-                item['type_s'] = 'harvested'
-                item['date_s'] = new_date_format
-                item['dataset_s'] = config['ds_name']
-                item['source_s'] = url
-
-                # descendants metadta setup to be populated for each granule
-                descendants_item = {}
-                descendants_item['type_s'] = 'descendants'
-
-                # Create or modify descendants entry in Solr
-                descendants_item['dataset_s'] = item['dataset_s']
-                descendants_item['date_s'] = item["date_s"]
-                descendants_item['source_s'] = item['source_s']
-
-                updating = False
-                aws_upload = False
-
-                try:
-
-                    # TODO: find a way to get last modified (see line 436 as well)
-                    # get last modified date
-                    # timestamp = ftp.voidcmd("MDTM "+url)[4:]    # string
-                    # time = parser.parse(timestamp)              # datetime object
-                    # timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ") # string
-                    # item['modified_time_dt'] = timestamp
-
-                    # compare modified timestamp or if granule previously downloaded
-                    # updating = (not newfile in docs.keys()) or (not docs[newfile]['harvest_success_b']) or (datetime.datetime.strptime(docs[newfile]['download_time_dt'], "%Y-%m-%dT%H:%M:%SZ") <= time)
-                    updating = (not filename in docs.keys()) or (
-                        not docs[filename]['harvest_success_b'])
-
-                    if updating:
-                        if not os.path.exists(local_fp):
-
-                            print('Downloading: ' + local_fp)
-
-                            credentials = get_credentials(url)
-                            req = Request(url)
-                            req.add_header('Authorization',
-                                           'Basic {0}'.format(credentials))
-                            opener = build_opener(HTTPCookieProcessor())
-                            data = opener.open(req).read()
-                            open(local_fp, 'wb').write(data)
-
-                        # elif datetime.datetime.fromtimestamp(os.path.getmtime(local_fp)) <= time:
-                        elif datetime.datetime.fromtimestamp(os.path.getmtime(local_fp)) <= parser.parse(file_date):
-
-                            print('Updating: ' + local_fp)
-
-                            credentials = get_credentials(url)
-                            req = Request(url)
-                            req.add_header('Authorization',
-                                           'Basic {0}'.format(credentials))
-                            opener = build_opener(HTTPCookieProcessor())
-                            data = opener.open(req).read()
-                            open(local_fp, 'wb').write(data)
-
-                        else:
-                            print('File already downloaded and up to date')
-
-                        # calculate checksum and expected file size
-                        item['checksum_s'] = md5(local_fp)
-
-                        # =====================================================
-                        # ### Push data to s3 bucket
-                        # =====================================================
-                        output_filename = config['ds_name'] + \
-                            '/' + filename if on_aws else filename
-                        item['pre_transformation_file_path_s'] = local_fp
-
-                        if on_aws:
-                            aws_upload = True
-                            print("=========uploading file=========")
-                            # print('uploading '+output_filename)
-                            target_bucket.upload_file(
-                                local_fp, output_filename)
-                            item['pre_transformation_file_path_s'] = 's3://' + \
-                                config['target_bucket_name'] + \
-                                '/'+output_filename
-                            print("======uploading file DONE=======")
-
-                        item['harvest_success_b'] = True
-                        item['filename_s'] = filename
-                        item['file_size_l'] = os.path.getsize(local_fp)
-
-                except Exception as e:
-                    print('error', e)
-                    if updating:
-                        if aws_upload:
-                            print("======aws upload unsuccessful=======")
-                            item['message_s'] = 'aws upload unsuccessful'
-
-                        else:
-                            print("Download "+filename+" failed.")
-                            print("======file not successful=======")
-
-                        item['harvest_success_b'] = False
-                        item['filename'] = ''
-                        item['pre_transformation_file_path_s'] = ''
-                        item['file_size_l'] = 0
-
-                if updating:
-                    item['download_time_dt'] = chk_time
-
-                    # Update Solr entry using id if it exists
-
-                    key = descendants_item['date_s']
-
-                    if key in descendants_docs.keys():
-                        descendants_item['id'] = descendants_docs[key]['id']
-
-                    descendants_item['harvest_success_b'] = item['harvest_success_b']
-                    descendants_item['pre_transformation_file_path_s'] = item['pre_transformation_file_path_s']
-                    meta.append(descendants_item)
-
-                    # add item to metadata json
-                    meta.append(item)
-                    # store meta for last successful download
-                    last_success_item = item
+    # wait for header checks so granule metadata reflects their outcome
+    if validation_queue:
+        failures = validation_queue.join()
+        if failures:
+            print(str(failures) + ' granules failed validation')
+
+    # granules whose queued work failed were marked so by the joins above
+    last_success_item = last_successful_item(meta)
 
     # =====================================================
     # ### writing metadata to file
@@ -617,7 +881,8 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
 
         # if no ds entry yet and no qualifying downloads, still create ds entry without download time
         if updating:
-            ds_meta['last_download_dt'] = last_success_item['download_time_dt']
+            if last_success_item:
+                ds_meta['last_download_dt'] = last_success_item['download_time_dt']
             ds_meta['status_s'] = "harvested"
         else:
             ds_meta['status_s'] = "nodata"
@@ -626,7 +891,7 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
         body.append(ds_meta)
 
         # Post document
-        r = solr_update(config, body, r=True)
+        r = solr_update(config, body, r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully created Solr dataset document')
@@ -647,7 +912,7 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
             body.append(field_obj)
 
         # post document
-        r = solr_update(config, body, r=True)
+        r = solr_update(config, body, r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully created Solr field documents')
@@ -687,7 +952,7 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
                     "set": overall_end.strftime("%Y-%m-%dT%H:%M:%SZ")}
 
         body = [update_doc]
-        r = solr_update(config, body, r=True)
+        r = solr_update(config, body, r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully updated Solr dataset document')
@@ -695,10 +960,17 @@ def seaice_harvester(config_path='', output_path='', s3=None, on_aws=False):
             print('Failed to update Solr dataset document')
 
     # post granule metadata documents for downloaded granules
-    r = solr_update(config, meta, r=True)
+    r = solr_update(config, meta, r=True, telemetry=telemetry)
 
     if r.status_code == 200:
         print('granule metadata post to Solr success')
     else:
         print('granule metadata post to Solr failed')
     print("=========posted meta==========")
+
+    # keep the local manifest of harvested granules in step with solr
+    if not on_aws:
+        update_granule_manifest(config, solr_host, meta, output_path)
+
+    # write the harvest's timers and byte counters next to its granules
+    telemetry.write(f'{output_path}{dataset_name}/harvest_telemetry.json')
@@ -3,11 +3,11 @@ import sys
 import importlib
 
 
-def main(config_path='', output_path=''):
+def main(config_path='', output_path='', plan=False, manifest_path=''):
     import nsidc_ftp_harvester
     nsidc_ftp_harvester = importlib.reload(nsidc_ftp_harvester)
-    nsidc_ftp_harvester.nsidc_ftp_harvester(
-        config_path=config_path, output_path=output_path, on_aws=False)
+    return nsidc_ftp_harvester.nsidc_ftp_harvester(
+        config_path=config_path, output_path=output_path, on_aws=False, plan=plan, manifest_path=manifest_path)
 
 
 if __name__ == '__main__':
@@ -14,6 +14,18 @@ from datetime import datetime
 from xml.etree.ElementTree import parse
 from urllib.request import urlopen, urlcleanup, urlretrieve
 
+# Shared harvester utilities live one directory up
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import s3_uploads  # pylint: disable=import-error
+import harvest_plan  # pylint: disable=import-error
+import granule_store  # pylint: disable=import-error
+import harvest_telemetry  # pylint: disable=import-error
+import granule_validation  # pylint: disable=import-error
+import granule_decompression  # pylint: disable=import-error
+import granule_manifest  # pylint: disable=import-error
+import rate_limiter  # pylint: disable=import-error
+import harvest_shards  # pylint: disable=import-error
+
 
 # Creates checksum from filename
 def md5(fname):
@@ -32,6 +44,57 @@ def getdate(regex, fname):
     return date
 
 
+# Marks a harvested granule and its descendants entry as failed after an unsuccessful AWS upload
+def aws_upload_failed(item, descendants_item):
+    item['message_s'] = 'aws upload unsuccessful'
+    item['harvest_success_b'] = False
+    item['filename_s'] = ''
+    item['pre_transformation_file_path_s'] = ''
+    item['file_size_l'] = 0
+
+    descendants_item['harvest_success_b'] = False
+    descendants_item['pre_transformation_file_path_s'] = ''
+
+
+# Points a harvested granule and its descendants entry at the granule's decompressed copy
+def decompressed(item, descendants_item, cache_fp, checksum, size):
+    item['compressed_file_path_s'] = item['pre_transformation_file_path_s']
+    item['pre_transformation_file_path_s'] = cache_fp
+    item['decompressed_checksum_s'] = checksum
+    item['decompressed_file_size_l'] = size
+
+    descendants_item['pre_transformation_file_path_s'] = cache_fp
+
+
+# Marks a harvested granule and its descendants entry as failed after its header didn't validate
+def validation_failed(item, descendants_item, message):
+    item['message_s'] = f'validation unsuccessful: {message}'
+    item['harvest_success_b'] = False
+
+    descendants_item['harvest_success_b'] = False
+
+
+# Returns the last granule in meta that was harvested successfully, or {} if none was
+# Only final once upload, decompression and validation queues have been joined
+def last_successful_item(meta):
+    successes = [entry for entry in meta
+                 if entry.get('type_s') == 'harvested' and entry.get('harvest_success_b')]
+    return successes[-1] if successes else {}
+
+
+# Retrieves url over ftp into local_fp, replacing any partial file from an earlier attempt
+def ftp_download(ftp, url, local_fp, telemetry):
+    with open(local_fp, 'wb') as f:
+        telemetry.retrbinary(ftp, 'RETR '+url, f.write)
+
+
+# Reopens an ftp connection the server dropped, e.g. after a 421 reply
+def ftp_reconnect(ftp, config):
+    ftp.close()
+    ftp.connect(config['host'], config.get('port', 0))
+    ftp.login(config['user'])
+
+
 # Queries Solr based on config information and filter query
 # Returns list of Solr entries (docs)
 def solr_query(config, solr_host, fq):
@@ -48,99 +111,25 @@ def solr_query(config, solr_host, fq):
 
 # Posts update to Solr with provided update body
 # Optional return of posting status code
-def solr_update(config, solr_host, update_body, r=False):
+def solr_update(config, solr_host, update_body, r=False, telemetry=None):
     solr_collection_name = config['solr_collection_name']
 
     url = f'{solr_host}{solr_collection_name}/update?commit=true'
 
-    if r:
-        return requests.post(url, json=update_body)
+    if telemetry:
+        with telemetry.phase('solr'):
+            response = requests.post(url, json=update_body)
     else:
-        requests.post(url, json=update_body)
-
+        response = requests.post(url, json=update_body)
 
-# Pulls data files for given ftp source and date range
-# If not on_aws, saves locally, else saves to s3 bucket
-# Creates Solr entries for dataset, harvested granule, fields, and descendants
-def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False):
-    # =====================================================
-    # Read configurations from YAML file
-    # =====================================================
-    if not config_path:
-        print('No path for configuration file. Can not run harvester.')
-        return
-
-    with open(config_path, "r") as stream:
-        config = yaml.load(stream, yaml.Loader)
-
-    # =====================================================
-    # Setup AWS Target Bucket
-    # =====================================================
-    if on_aws:
-        target_bucket_name = config['target_bucket_name']
-        target_bucket = s3.Bucket(target_bucket_name)
-        solr_host = config['solr_host_aws']
-    else:
-        solr_host = config['solr_host_local']
-
-    # =====================================================
-    # Initializing required values
-    # =====================================================
-    dataset_name = config['ds_name']
-    target_dir = f'{output_path}{dataset_name}/harvested_granules/'
-    folder = f'/tmp/{dataset_name}/'
-
-    ftp = FTP(config['host'])
-    ftp.login(config['user'])
-
-    if not on_aws:
-        print(f'!!downloading files to {target_dir}')
-    else:
-        print(
-            f'!!downloading files to {folder} and uploading to {target_bucket_name}/{dataset_name}')
-
-    # if target path doesn't exist, make them
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-
-    docs = {}
-    descendants_docs = {}
-
-    # Query for existing harvested docs
-    fq = ['type_s:harvested', f'dataset_s:{dataset_name}']
-    query_docs = solr_query(config, solr_host, fq)
-
-    if len(query_docs) > 0:
-        for doc in query_docs:
-            docs[doc['filename_s']] = doc
-
-    fq = ['type_s:dataset', f'dataset_s:{dataset_name}']
-    query_docs = solr_query(config, solr_host, fq)
-
-    # Query for existing descendants docs
-    fq = ['type_s:descendants', f'dataset_s:{dataset_name}']
-    existing_descendants_docs = solr_query(config, solr_host, fq)
+    if r:
+        return response
 
-    if len(existing_descendants_docs) > 0:
-        for doc in existing_descendants_docs:
-            if doc['hemisphere_s']:
-                key = (doc['date_s'], doc['hemisphere_s'])
-            else:
-                key = doc['date_s']
-            descendants_docs[key] = doc
 
-    # setup metadata
-    meta = []
-    item = {}
-    last_success_item = {}
-    granule_dates = []
-    chk_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    now = datetime.utcnow()
-    updating = False
-    aws_upload = False
+# Lists the granules on the ftp server for the configured date range and regions
+# Returns a list of granule entries (filename, path, date, hemisphere, modified time and size)
+def osisaf_ftp_granule_listing(ftp, config):
+    granules = []
 
     start_time = datetime.strptime(
         config['start'], "%Y%m%dT%H:%M:%SZ")
@@ -162,9 +151,17 @@ def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False):
 
         # build source urlbase
         urlbase = f'{config["ddir"]}{year}/{month}/'
+        files = []
+        sizes = {}
         try:
-            files = []
             ftp.dir(urlbase, files.append)
+
+            # Keep file sizes from the listing when it is in unix ls format
+            for e in files:
+                parts = e.split()
+                if len(parts) >= 9 and parts[4].isdigit():
+                    sizes[parts[-1]] = int(parts[4])
+
             files = [e.split()[-1] for e in files]
         except:
             print(f'Error finding files at {urlbase}')
@@ -200,137 +197,42 @@ def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False):
                     if (end_time < date_time):
                         break
 
-                    granule_dates.append(datetime.strptime(
-                        new_date_format, config['date_regex']))
-
-                    # granule metadata setup to be populated for each granule
-                    item = {}
-                    item['type_s'] = 'harvested'
-                    item['date_s'] = new_date_format
-                    item['dataset_s'] = config['ds_name']
-                    item['hemisphere_s'] = hemi
-                    item['source_s'] = f'ftp://{config["host"]}/{url}'
-
-                    # descendants metadta setup to be populated for each granule
-                    descendants_item = {}
-                    descendants_item['type_s'] = 'descendants'
-
-                    # Create or modify descendants entry in Solr
-                    descendants_item['dataset_s'] = item['dataset_s']
-                    descendants_item['date_s'] = item["date_s"]
-                    descendants_item['hemisphere_s'] = hemi
-                    descendants_item['source_s'] = item['source_s']
-
-                    updating = False
-                    aws_upload = False
-
                     # Attempt to get last modified time of file
                     try:
                         mod_time = ftp.voidcmd("MDTM "+url)[4:]
                         mod_date_time = parser.parse(mod_time)
-                        mod_time = mod_date_time.strftime(
+                        modified_dt = mod_date_time.strftime(
                             "%Y-%m-%dT%H:%M:%SZ")
-                        item['modified_time_dt'] = mod_time
                     except:
                         print(
                             'Cannot find last modified time. Downloading granule.')
-                        mod_date_time = now
-
-                    # If granule doesn't exist or previously failed or has been updated since last harvest
-                    updating = (not newfile in docs.keys()) or (not docs[newfile]['harvest_success_b']) \
-                        or (datetime.strptime(docs[newfile]['download_time_dt'], "%Y-%m-%dT%H:%M:%SZ") <= mod_date_time)
-
-                    # If updating, download file
-                    if updating:
-                        local_fp = f'{folder}{config["ds_name"]}_granule.nc' if on_aws else f'{target_dir}{date[:4]}/{newfile}'
-
-                        if not os.path.exists(f'{target_dir}{date[:4]}/'):
-                            os.makedirs(f'{target_dir}{date[:4]}/')
-
-                        # If file doesn't exist locally, download it
-                        if not os.path.exists(local_fp):
-                            print(f'Downloading: {local_fp}')
-
-                            # new ftp retrieval
-                            with open(local_fp, 'wb') as f:
-                                ftp.retrbinary('RETR '+url, f.write)
-
-                        # If file exists, but is out of date, download it
-                        elif datetime.fromtimestamp(os.path.getmtime(local_fp)) <= mod_date_time:
-                            print(f'Updating: {local_fp}')
-
-                            # new ftp retrieval
-                            with open(local_fp, 'wb') as f:
-                                ftp.retrbinary('RETR '+url, f.write)
-
-                        else:
-                            print(
-                                f'{newfile} already downloaded and up to date')
-
-                        # Create checksum for file
-                        item['checksum_s'] = md5(local_fp)
-
-                        output_filename = f'{dataset_name}/{newfile}' if on_aws else newfile
-
-                        item['pre_transformation_file_path_s'] = local_fp
-
-                        # =====================================================
-                        # Push data to s3 bucket
-                        # =====================================================
-
-                        if on_aws:
-                            aws_upload = True
-                            print("=========uploading file to s3=========")
-                            target_bucket.upload_file(
-                                local_fp, output_filename)
-                            item['pre_transformation_file_path_s'] = f's3://{config["target_bucket_name"]}/{output_filename}'
-                            print("======uploading file to s3 DONE=======")
-
-                        item['harvest_success_b'] = True
-                        item['filename_s'] = newfile
-                        item['file_size_l'] = os.path.getsize(local_fp)
+                        modified_dt = None
+
+                    granules.append({
+                        'filename': newfile,
+                        'source': f'ftp://{config["host"]}/{url}',
+                        'url': url,
+                        'date': new_date_format,
+                        'hemisphere': hemi,
+                        'modified_dt': modified_dt,
+                        'size': sizes.get(newfile)
+                    })
 
                 except Exception as e:
                     print(e)
-                    if updating:
-                        if aws_upload:
-                            print("======aws upload unsuccessful=======")
-                            item['message_s'] = 'aws upload unsuccessful'
-
-                        else:
-                            print(f'Download {newfile} failed.')
-                            print("======file not successful=======")
-
-                        item['harvest_success_b'] = False
-                        item['filename'] = ''
-                        item['pre_transformation_file_path_s'] = ''
-                        item['file_size_l'] = 0
+                    print(f'Unable to list {newfile}')
 
-                if updating:
-                    item['download_time_dt'] = chk_time
+    return granules
 
-                    # Update Solr entry using id if it exists
-                    if hemi:
-                        key = (descendants_item['date_s'], hemi)
-                    else:
-                        key = descendants_item['date_s']
 
-                    if key in descendants_docs.keys():
-                        descendants_item['id'] = descendants_docs[key]['id']
 
-                    descendants_item['harvest_success_b'] = item['harvest_success_b']
-                    descendants_item['pre_transformation_file_path_s'] = item['pre_transformation_file_path_s']
-                    meta.append(descendants_item)
-
-                    # add item to metadata json
-                    meta.append(item)
-                    # store meta for last successful download
-                    last_success_item = item
-
-    ftp.quit()
+# Posts harvested granule metadata to Solr, and creates or updates the dataset's coverage
+# granule_dates are the dates of the granules covered by the harvest
+def update_solr_metadata(config, solr_host, meta, granule_dates, last_success_item, updating, chk_time, telemetry=None):
+    dataset_name = config['ds_name']
 
     # post granule metadata documents for downloaded granules
-    r = solr_update(config, solr_host, meta, r=True)
+    r = solr_update(config, solr_host, meta, r=True, telemetry=telemetry)
 
     if meta:
         if r.status_code == 200:
@@ -380,7 +282,8 @@ def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False):
 
         # if no ds entry yet and no qualifying downloads, still create ds entry without download time
         if updating:
-            ds_meta['last_download_dt'] = last_success_item['download_time_dt']
+            if last_success_item:
+                ds_meta['last_download_dt'] = last_success_item['download_time_dt']
             ds_meta['status_s'] = "harvested"
         else:
             ds_meta['status_s'] = "nodata"
@@ -389,7 +292,7 @@ def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False):
         body.append(ds_meta)
 
         # Update Solr with dataset metadata
-        r = solr_update(config, solr_host, body, r=True)
+        r = solr_update(config, solr_host, body, r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully created Solr dataset document')
@@ -411,7 +314,7 @@ def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False):
             body.append(field_obj)
 
         # Update Solr with dataset fields metadata
-        r = solr_update(config, solr_host, body, r=True)
+        r = solr_update(config, solr_host, body, r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully created Solr field documents')
@@ -449,9 +352,420 @@ def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False):
                     "set": overall_end.strftime("%Y-%m-%dT%H:%M:%SZ")}
 
         # Update Solr with modified dataset entry
-        r = solr_update(config, solr_host, [update_doc], r=True)
+        r = solr_update(config, solr_host, [update_doc], r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully updated Solr dataset document')
         else:
             print('Failed to update Solr dataset document')
+
+
+# Merges the harvest's granule metadata into the dataset's local granule manifest
+# A dataset without a manifest yet is seeded from all of its harvested docs in Solr
+def update_granule_manifest(config, solr_host, meta, output_path):
+    dataset_name = config['ds_name']
+    fq = [f'dataset_s:{dataset_name}', 'type_s:harvested']
+    manifest_fp = granule_manifest.manifest_path(output_path, dataset_name)
+    try:
+        granule_manifest.update_manifest(
+            manifest_fp, meta, seed=lambda: solr_query(config, solr_host, fq))
+    except Exception as e:
+        print(e)
+        print(f'Unable to update granule manifest {manifest_fp}')
+
+
+# Pulls data files for given ftp source and date range
+# If not on_aws, saves locally, else saves to s3 bucket
+# Creates Solr entries for dataset, harvested granule, fields, and descendants
+# In plan mode, only lists granules and writes a manifest of what a harvest would transfer
+# A manifest from plan mode can be given as manifest_path to skip listing granules again
+# With shard_workers set, the date range is split by year and region and harvested across that many processes
+# Each shard is itself a call with shard=True, which returns its metadata instead of posting it
+def osisaf_ftp_harvester(config_path='', output_path='', s3=None, on_aws=False, plan=False, manifest_path='', shard=False):
+    # =====================================================
+    # Read configurations from YAML file
+    # =====================================================
+    if not config_path:
+        print('No path for configuration file. Can not run harvester.')
+        return
+
+    with open(config_path, "r") as stream:
+        config = yaml.load(stream, yaml.Loader)
+
+    # =====================================================
+    # Setup AWS Target Bucket
+    # =====================================================
+    if on_aws:
+        target_bucket_name = config['target_bucket_name']
+        target_bucket = s3.Bucket(target_bucket_name)
+        solr_host = config['solr_host_aws']
+    else:
+        solr_host = config['solr_host_local']
+
+    # Timers and byte counters for the harvest, reported once it finishes
+    telemetry = harvest_telemetry.HarvestTelemetry(config['ds_name'])
+
+    # Pace requests to each remote host, shared with other harvests writing to output_path
+    limiter = rate_limiter.from_config(config, output_path)
+
+    # Harvest the date range in shards across processes, then post their merged metadata at once
+    shard_workers = config.get('shard_workers', 0)
+    if shard_workers > 1 and not (shard or plan or manifest_path or on_aws):
+        chk_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        results = harvest_shards.run_shards(
+            osisaf_ftp_harvester, config, output_path, shard_workers, by_region=True)
+        merged = harvest_shards.merge_shard_results(results, telemetry)
+
+        update_solr_metadata(config, solr_host, merged['meta'], merged.get('granule_dates', []),
+                             merged['last_success_item'], merged['updating'], chk_time, telemetry)
+        update_granule_manifest(config, solr_host, merged['meta'], output_path)
+        telemetry.write(
+            f'{output_path}{config["ds_name"]}/harvest_telemetry.json')
+        return
+
+    # Upload in the background while the next granules download
+    upload_queue = None
+    if on_aws and config.get('upload_workers', 0) and not plan:
+        upload_queue = s3_uploads.UploadQueue(target_bucket, config['upload_workers'],
+                                              int(config.get('s3_part_size_mb', 8) * 1024 * 1024),
+                                              telemetry=telemetry)
+
+    # =====================================================
+    # Initializing required values
+    # =====================================================
+    dataset_name = config['ds_name']
+    target_dir = f'{output_path}{dataset_name}/harvested_granules/'
+    folder = f'/tmp/{dataset_name}/'
+    stream_to_s3 = on_aws and config.get('stream_to_s3', False)
+    s3_part_size = int(config.get('s3_part_size_mb', 8) * 1024 * 1024)
+
+    # Decompress .gz and .bz2 granules once at harvest instead of at every transformation
+    # The cache is only kept for local harvests
+    decompression_queue = None
+    if config.get('decompress', False) and not on_aws and not plan:
+        decompression_queue = granule_decompression.DecompressionQueue(target_dir, f'{output_path}{dataset_name}/decompressed_granules/',
+                                                                       config.get('decompress_workers', 2),
+                                                                       config.get('decompress_complevel', 0))
+
+    # Check and summarise each downloaded granule's header in the background so bad downloads
+    # are marked as failed before they reach transformation, and transformation can plan from
+    # the summary without opening the file
+    validation_queue = None
+    if not plan:
+        validation_queue = granule_validation.ValidationQueue([field['name'] for field in config['fields']],
+                                                              config.get('validation_workers', 1),
+                                                              time_dim=config.get('validation_time_dim'),
+                                                              validate=config.get('validate_granules', True))
+
+    # Shared content addressed store of harvested files, only used for local harvests
+    store = granule_store.GranuleStore(config['granule_store_dir']) \
+        if config.get('granule_store_dir') and not on_aws else None
+
+    ftp = FTP()
+    ftp.connect(config['host'], config.get('port', 0))
+    ftp.login(config['user'])
+
+    if not on_aws:
+        print(f'!!downloading files to {target_dir}')
+    else:
+        print(
+            f'!!downloading files to {folder} and uploading to {target_bucket_name}/{dataset_name}')
+
+    # if target path doesn't exist, make them
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    docs = {}
+    descendants_docs = {}
+
+    # Query for existing harvested docs
+    fq = ['type_s:harvested', f'dataset_s:{dataset_name}']
+    query_docs = solr_query(config, solr_host, fq)
+
+    if len(query_docs) > 0:
+        for doc in query_docs:
+            docs[doc['filename_s']] = doc
+
+    fq = ['type_s:dataset', f'dataset_s:{dataset_name}']
+    query_docs = solr_query(config, solr_host, fq)
+
+    # Query for existing descendants docs
+    fq = ['type_s:descendants', f'dataset_s:{dataset_name}']
+    existing_descendants_docs = solr_query(config, solr_host, fq)
+
+    if len(existing_descendants_docs) > 0:
+        for doc in existing_descendants_docs:
+            if doc['hemisphere_s']:
+                key = (doc['date_s'], doc['hemisphere_s'])
+            else:
+                key = doc['date_s']
+            descendants_docs[key] = doc
+
+    # setup metadata
+    meta = []
+    item = {}
+    last_success_item = {}
+    granule_dates = []
+    chk_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    now = datetime.utcnow()
+    updating = False
+    aws_upload = False
+
+    # Reuse the listing from a previous plan if given, otherwise list available granules
+    if manifest_path:
+        granules = harvest_plan.read_harvest_plan(manifest_path, config)
+        if granules is None:
+            ftp.quit()
+            return
+    else:
+        granules = osisaf_ftp_granule_listing(ftp, config)
+
+    # Decide what to do with each granule against the current harvested docs
+    for granule in granules:
+        mod_date_time = harvest_plan.modified_date_time(granule, now)
+        granule['action'] = harvest_plan.granule_action(
+            docs, granule['filename'], mod_date_time)
+        granule['local_path'] = f'{target_dir}{granule["date"][:4]}/{granule["filename"]}'
+        granule['transfer'] = on_aws or harvest_plan.needs_transfer(
+            granule['local_path'], mod_date_time)
+
+        # Granules already in the granule store are linked, not transferred
+        if store and store.lookup(granule['source'], granule['modified_dt']):
+            granule['transfer'] = False
+
+    # In plan mode, write out the manifest without downloading or touching Solr
+    if plan:
+        ftp.quit()
+        harvest_plan_doc = harvest_plan.make_harvest_plan(
+            config, 'osisaf_ftp', granules)
+        harvest_plan.write_harvest_plan(
+            harvest_plan_doc, f'{output_path}{dataset_name}/harvest_plan.json')
+        return harvest_plan_doc
+
+    for granule in granules:
+        try:
+            newfile = granule['filename']
+            url = granule['url']
+            hemi = granule['hemisphere']
+            new_date_format = granule['date']
+            date = new_date_format[:10].replace('-', '')
+
+            granule_dates.append(datetime.strptime(
+                new_date_format, config['date_regex']))
+
+            # granule metadata setup to be populated for each granule
+            item = {}
+            item['type_s'] = 'harvested'
+            item['date_s'] = new_date_format
+            item['dataset_s'] = config['ds_name']
+            item['hemisphere_s'] = hemi
+            item['source_s'] = granule['source']
+
+            # descendants metadta setup to be populated for each granule
+            descendants_item = {}
+            descendants_item['type_s'] = 'descendants'
+
+            # Create or modify descendants entry in Solr
+            descendants_item['dataset_s'] = item['dataset_s']
+            descendants_item['date_s'] = item["date_s"]
+            descendants_item['hemisphere_s'] = hemi
+            descendants_item['source_s'] = item['source_s']
+
+            updating = False
+            aws_upload = False
+
+            if granule['modified_dt']:
+                item['modified_time_dt'] = granule['modified_dt']
+            mod_date_time = harvest_plan.modified_date_time(granule, now)
+
+            # If granule doesn't exist or previously failed or has been updated since last harvest
+            updating = granule['action'] != 'skip'
+
+            # If updating and streaming, pipe the download straight into S3
+            if updating and stream_to_s3:
+                aws_upload = True
+                output_filename = f'{dataset_name}/{newfile}'
+                print(f'Streaming: {newfile} to {target_bucket_name}')
+
+                with telemetry.phase('download', host=config['host']) as op:
+                    try:
+                        s3_stream = limiter.call(config['host'], s3_uploads.upload_ftp_file,
+                                                 ftp, url, target_bucket, output_filename, s3_part_size,
+                                                 on_retry=lambda: ftp_reconnect(ftp, config))
+                    except Exception:
+                        # A transfer given up part way leaves the connection unusable for the next granule
+                        ftp_reconnect(ftp, config)
+                        raise
+                    op['bytes'] = s3_stream.size
+
+                item['checksum_s'] = s3_stream.md5
+                item['pre_transformation_file_path_s'] = s3_stream.s3_path
+                item['harvest_success_b'] = True
+                item['filename_s'] = newfile
+                item['file_size_l'] = s3_stream.size
+
+            # If updating, download file
+            elif updating:
+                local_fp = f'{folder}{config["ds_name"]}_granule.nc' if on_aws else f'{target_dir}{date[:4]}/{newfile}'
+
+                # Queued uploads need their own scratch file per granule
+                if upload_queue:
+                    local_fp = f'{folder}{newfile}'
+
+                if not os.path.exists(f'{target_dir}{date[:4]}/'):
+                    os.makedirs(f'{target_dir}{date[:4]}/')
+
+                # Link an identical granule from the granule store instead of downloading it
+                if store and store.checkout(granule['source'], granule['modified_dt'], local_fp):
+                    print(f'Linked from granule store: {local_fp}')
+
+                # If file doesn't exist locally, download it
+                elif not os.path.exists(local_fp):
+                    print(f'Downloading: {local_fp}')
+
+                    # new ftp retrieval
+                    limiter.call(config['host'], ftp_download, ftp, url, local_fp, telemetry,
+                                 on_retry=lambda: ftp_reconnect(ftp, config))
+
+                # If file exists, but is out of date, download it
+                elif datetime.fromtimestamp(os.path.getmtime(local_fp)) <= mod_date_time:
+                    print(f'Updating: {local_fp}')
+
+                    # new ftp retrieval
+                    limiter.call(config['host'], ftp_download, ftp, url, local_fp, telemetry,
+                                 on_retry=lambda: ftp_reconnect(ftp, config))
+
+                else:
+                    print(
+                        f'{newfile} already downloaded and up to date')
+
+                # Create checksum for file
+                item['checksum_s'] = md5(local_fp)
+                item['file_size_l'] = os.path.getsize(local_fp)
+
+                # Keep the granule in the granule store so later harvests can link it
+                if store:
+                    store.checkin(local_fp, granule['source'],
+                                  granule['modified_dt'], item['checksum_s'])
+
+                # Decompressed granules are validated once they're decompressed
+                decompression = None
+                if decompression_queue and granule_decompression.is_compressed(local_fp):
+                    decompression = decompression_queue.submit(local_fp, on_done=lambda cache_fp, checksum, size, item=item, descendants_item=descendants_item:
+                                                               decompressed(item, descendants_item, cache_fp, checksum, size))
+
+                # Uploads wait for the granule's validation so bad granules never reach s3
+                validation = None
+                if validation_queue:
+                    validation = validation_queue.submit(local_fp, on_failure=lambda message, item=item, descendants_item=descendants_item:
+                                                         validation_failed(item, descendants_item, message),
+                                                         on_summary=lambda summary, item=item: item.update({'header_summary_s': summary}),
+                                                         after=decompression)
+
+                output_filename = f'{dataset_name}/{newfile}' if on_aws else newfile
+
+                item['pre_transformation_file_path_s'] = local_fp
+
+                # =====================================================
+                # Push data to s3 bucket
+                # =====================================================
+
+                # Queued uploads wait for their validation on the upload thread, so the
+                # harvester can go on downloading
+                if on_aws and upload_queue:
+                    print(f'Queueing {newfile} for upload to s3')
+                    upload_queue.submit(local_fp, output_filename, remove_after=True,
+                                        on_failure=lambda e, item=item, descendants_item=descendants_item:
+                                        aws_upload_failed(item, descendants_item),
+                                        skip=validation and (lambda validation=validation: validation.result()[0]))
+                    item['pre_transformation_file_path_s'] = f's3://{config["target_bucket_name"]}/{output_filename}'
+
+                elif on_aws and validation and validation.result()[0]:
+                    print(f'Not uploading {newfile} to s3, it failed validation')
+
+                elif on_aws:
+                    aws_upload = True
+                    print("=========uploading file to s3=========")
+                    with telemetry.phase('upload', os.path.getsize(local_fp)):
+                        target_bucket.upload_file(
+                            local_fp, output_filename)
+                    item['pre_transformation_file_path_s'] = f's3://{config["target_bucket_name"]}/{output_filename}'
+                    print("======uploading file to s3 DONE=======")
+
+                item['harvest_success_b'] = True
+                item['filename_s'] = newfile
+
+        except Exception as e:
+            print(e)
+            if updating:
+                if aws_upload:
+                    print("======aws upload unsuccessful=======")
+                    item['message_s'] = 'aws upload unsuccessful'
+
+                else:
+                    print(f'Download {newfile} failed.')
+                    print("======file not successful=======")
+
+                item['harvest_success_b'] = False
+                item['filename'] = ''
+                item['pre_transformation_file_path_s'] = ''
+                item['file_size_l'] = 0
+
+        if updating:
+            item['download_time_dt'] = chk_time
+
+            # Update Solr entry using id if it exists
+            if hemi:
+                key = (descendants_item['date_s'], hemi)
+            else:
+                key = descendants_item['date_s']
+
+            if key in descendants_docs.keys():
+                descendants_item['id'] = descendants_docs[key]['id']
+
+            descendants_item['harvest_success_b'] = item['harvest_success_b']
+            descendants_item['pre_transformation_file_path_s'] = item['pre_transformation_file_path_s']
+            meta.append(descendants_item)
+
+            # add item to metadata json
+            meta.append(item)
+
+    ftp.quit()
+
+    # Wait for background uploads so granule metadata reflects their outcome
+    if upload_queue:
+        print('Waiting for queued s3 uploads to finish')
+        upload_queue.join()
+
+    # Wait for decompression so granule metadata points at the decompressed copies
+    if decompression_queue:
+        failures = decompression_queue.join()
+        if failures:
+            print(f'{failures} granules could not be decompressed')
+
+    # Wait for header checks so granule metadata reflects their outcome
+    if validation_queue:
+        failures = validation_queue.join()
+        if failures:
+            print(f'{failures} granules failed validation')
+
+    # Granules whose queued work failed were marked so by the joins above
+    last_success_item = last_successful_item(meta)
+
+    # Shards hand their granule metadata back to the sharded harvest to post
+    if shard:
+        return {'meta': meta, 'granule_dates': granule_dates, 'last_success_item': last_success_item,
+                'updating': updating, 'telemetry': telemetry.summary()}
+
+    update_solr_metadata(config, solr_host, meta, granule_dates,
+                         last_success_item, updating, chk_time, telemetry)
+
+    # Keep the local manifest of harvested granules in step with Solr
+    if not on_aws:
+        update_granule_manifest(config, solr_host, meta, output_path)
+
+    # Write the harvest's timers and byte counters next to its granules
+    telemetry.write(f'{output_path}{dataset_name}/harvest_telemetry.json')
@@ -3,11 +3,11 @@ import sys
 import importlib
 
 
-def main(config_path='', output_path=''):
+def main(config_path='', output_path='', plan=False, manifest_path=''):
     import osisaf_ftp_harvester
     osisaf_ftp_harvester = importlib.reload(osisaf_ftp_harvester)
-    osisaf_ftp_harvester.osisaf_ftp_harvester(
-        config_path=config_path, output_path=output_path, on_aws=False)
+    return osisaf_ftp_harvester.osisaf_ftp_harvester(
+        config_path=config_path, output_path=output_path, on_aws=False, plan=plan, manifest_path=manifest_path)
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@ import yaml
 import shutil
 import hashlib
 import logging
+import importlib.util
 import requests
 import numpy as np
 import xarray as xr
@@ -12,7 +13,21 @@ import xarray as xr
 from pathlib import Path
 from xml.etree.ElementTree import parse
 from datetime import datetime, timedelta
-from urllib.request import urlopen, urlcleanup, urlretrieve
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from urllib.parse import urlparse
+from urllib.request import urlopen, urlcleanup
+
+# Shared harvester utilities live one directory up
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import s3_uploads  # pylint: disable=import-error
+import harvest_plan  # pylint: disable=import-error
+import granule_store  # pylint: disable=import-error
+import harvest_telemetry  # pylint: disable=import-error
+import granule_validation  # pylint: disable=import-error
+import granule_decompression  # pylint: disable=import-error
+import granule_manifest  # pylint: disable=import-error
+import rate_limiter  # pylint: disable=import-error
+import harvest_shards  # pylint: disable=import-error
 
 log = logging.getLogger(__name__)
 
@@ -26,8 +41,56 @@ def md5(fname):
     return hash_md5.hexdigest()
 
 
+# Marks a harvested granule and its descendants entry as failed after an unsuccessful AWS upload
+def aws_upload_failed(item, descendants_item):
+    item['message_s'] = {"set": 'aws upload unsuccessful'}
+    item['harvest_success_b'] = {"set": False}
+    item['pre_transformation_file_path_s'] = {"set": ''}
+    item['filename_s'] = {"set": ''}
+    item['file_size_l'] = {"set": 0}
+
+    descendants_item['harvest_success_b'] = {"set": False}
+    descendants_item['pre_transformation_file_path_s'] = {"set": ''}
+
+
+# Points a harvested granule and its descendants entry at the granule's decompressed copy
+def decompressed(item, descendants_item, cache_fp, checksum, size):
+    item['compressed_file_path_s'] = item['pre_transformation_file_path_s']
+    item['pre_transformation_file_path_s'] = {"set": cache_fp}
+    item['decompressed_checksum_s'] = {"set": checksum}
+    item['decompressed_file_size_l'] = {"set": size}
+
+    descendants_item['pre_transformation_file_path_s'] = {"set": cache_fp}
+
+
+# Marks a harvested granule and its descendants entry as failed after its header didn't validate
+def validation_failed(item, descendants_item, message):
+    item['message_s'] = {"set": f'validation unsuccessful: {message}'}
+    item['harvest_success_b'] = {"set": False}
+
+    descendants_item['harvest_success_b'] = {"set": False}
+
+
+# Returns the last granule in meta that was harvested successfully, or {} if none was
+# Only final once upload, decompression and validation queues have been joined
+def last_successful_item(meta):
+    successes = [entry for entry in meta
+                 if entry.get('type_s', {}).get('set') == 'harvested'
+                 and entry.get('harvest_success_b', {}).get('set')]
+    return successes[-1] if successes else {}
+
+
 # Creates metadata entry for a harvested granule and uploads to AWS if needed
-def metadata_maker(config, date, link, mod_time, on_aws, target_bucket, local_fp, file_name, chk_time, descendants_docs, item_id):
+# checksum, file_size and s3_path can be given for granules already streamed to S3
+# If an upload_queue is given, the upload happens in the background and the
+# entry is marked as failed when the queue is joined if the upload didn't succeed
+# If a decompression_queue is given, .gz and .bz2 granules are decompressed in the background
+# and the entry is pointed at the decompressed copy when the queue is joined
+# If a validation_queue is given, the granule's header is checked and summarised in the background,
+# and the entry gets the summary and is marked as failed when the queue is joined if it didn't pass
+def metadata_maker(config, date, link, mod_time, on_aws, target_bucket, local_fp, file_name, chk_time, descendants_docs, item_id,
+                   checksum='', file_size=None, s3_path='', upload_queue=None, telemetry=None, validation_queue=None,
+                   decompression_queue=None):
     dataset_name = config['ds_name']
     harvest_success = False
 
@@ -59,18 +122,52 @@ def metadata_maker(config, date, link, mod_time, on_aws, target_bucket, local_fp
     item['filename_s'] = {"set": file_name}
 
     try:
-        item['file_size_l'] = {"set": os.path.getsize(local_fp)}
-        item['checksum_s'] = {"set": md5(local_fp)}
+        if file_size is None:
+            file_size = os.path.getsize(local_fp)
+        item['file_size_l'] = {"set": file_size}
+        item['checksum_s'] = {"set": checksum or md5(local_fp)}
     except Exception as e:
         log.debug(e)
         print(f'Failed updating file_size and checksum for {file_name}')
         print('=======failed file_size and checksum======')
 
+    # Decompressed granules are validated once they're decompressed
+    decompression = None
+    if decompression_queue and local_fp and granule_decompression.is_compressed(local_fp):
+        decompression = decompression_queue.submit(
+            local_fp, on_done=lambda cache_fp, checksum, size: decompressed(item, descendants_item, cache_fp, checksum, size))
+
+    # Uploads wait for the granule's validation so bad granules never reach s3
+    validation = None
+    if validation_queue and local_fp:
+        validation = validation_queue.submit(
+            local_fp, on_failure=lambda message: validation_failed(item, descendants_item, message),
+            on_summary=lambda summary: item.update({'header_summary_s': {"set": summary}}),
+            after=decompression)
+
     try:
-        if on_aws:
+        if on_aws and s3_path:
+            item['pre_transformation_file_path_s'] = {"set": s3_path}
+        # Queued uploads wait for their validation on the upload thread, so the
+        # harvester can go on downloading
+        elif on_aws and upload_queue:
+            output_filename = f'{dataset_name}/{file_name}'
+            print(f'Queueing {file_name} for upload to s3')
+            upload_queue.submit(local_fp, output_filename,
+                                on_failure=lambda e: aws_upload_failed(item, descendants_item),
+                                skip=validation and (lambda: validation.result()[0]))
+            item['pre_transformation_file_path_s'] = {
+                "set": f's3://{config["target_bucket_name"]}/{output_filename}'}
+        elif on_aws and validation and validation.result()[0]:
+            print(f'Not uploading {file_name} to s3, it failed validation')
+        elif on_aws:
             output_filename = f'{dataset_name}/{file_name}'
             print("=========uploading file to s3=========")
-            target_bucket.upload_file(local_fp, output_filename)
+            if telemetry:
+                with telemetry.phase('upload', os.path.getsize(local_fp)):
+                    target_bucket.upload_file(local_fp, output_filename)
+            else:
+                target_bucket.upload_file(local_fp, output_filename)
             item['pre_transformation_file_path_s'] = {
                 "set": f's3://{config["target_bucket_name"]}/{output_filename}'}
             print("======uploading file to s3 DONE=======")
@@ -80,11 +177,7 @@ def metadata_maker(config, date, link, mod_time, on_aws, target_bucket, local_fp
         print("======aws upload unsuccessful=======")
 
         harvest_success = False
-        item['message_s'] = {"set": 'aws upload unsuccessful'}
-        item['harvest_success_b'] = {"set": harvest_success}
-        item['pre_transformation_file_path_s'] = {"set": ''}
-        item['filename_s'] = {"set": ''}
-        item['file_size_l'] = {"set": 0}
+        aws_upload_failed(item, descendants_item)
 
     descendants_item['harvest_success_b'] = {"set": harvest_success}
     pre_transformation_file_path_s = item['pre_transformation_file_path_s']["set"]
@@ -109,60 +202,30 @@ def solr_query(config, solr_host, fq):
 
 # Posts update to Solr with provided update body
 # Optional return of posting status code
-def solr_update(config, solr_host, update_body, r=False):
+def solr_update(config, solr_host, update_body, r=False, telemetry=None):
     solr_collection_name = config['solr_collection_name']
 
     url = f'{solr_host}{solr_collection_name}/update?commit=true'
 
-    if r:
-        return requests.post(url, json=update_body)
+    if telemetry:
+        with telemetry.phase('solr'):
+            response = requests.post(url, json=update_body)
     else:
-        requests.post(url, json=update_body)
-
-
-# Pulls data files for given PODAAC id and date range
-# If not on_aws, saves locally, else saves to s3 bucket
-# Creates Solr entries for dataset, harvested granule, fields, and descendants
-def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False):
-    # =====================================================
-    # Read configurations from YAML file
-    # =====================================================
-    if not config_path:
-        print('No path for configuration file. Can not run harvester.')
-        return
-
-    with open(config_path, "r") as stream:
-        config = yaml.load(stream, yaml.Loader)
+        response = requests.post(url, json=update_body)
 
-    # =====================================================
-    # Setup AWS Target Bucket
-    # =====================================================
-    if on_aws:
-        target_bucket_name = config['target_bucket_name']
-        target_bucket = s3.Bucket(target_bucket_name)
-        solr_host = config['solr_host_aws']
-    else:
-        target_bucket = None
-        solr_host = config['solr_host_local']
+    if r:
+        return response
 
-    # =====================================================
-    # Initializing required values
-    # =====================================================
-    dataset_name = config['ds_name']
 
-    target_dir = f'{output_path}{dataset_name}/harvested_granules/'
+# Lists the granules PODAAC has for the configured dataset and date range
+# Returns a list of granule entries (filename, source link, dates and modified time)
+def podaac_granule_listing(config, now):
     date_regex = config['date_regex']
     aggregated = config['aggregated']
     start_time = config['start']
     end_time = config['end']
 
-    if not on_aws:
-        print(f'!!downloading files to {target_dir}')
-    else:
-        print(
-            f'!!downloading files and uploading to {target_bucket_name}/{dataset_name}')
-
-    if config['aggregated']:
+    if aggregated:
         url = f'{config["host"]}&datasetId={config["podaac_id"]}'
     else:
         url = f'{config["host"]}&datasetId={config["podaac_id"]}&endTime={end_time}&startTime={start_time}'
@@ -177,38 +240,7 @@ def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False):
 
     next = None
     more = True
-
-    # if target paths don't exist, make them
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-
-    docs = {}
-    descendants_docs = {}
-
-    # Query for existing harvested docs
-    fq = ['type_s:harvested', f'dataset_s:{dataset_name}']
-    harvested_docs = solr_query(config, solr_host, fq)
-
-    if len(harvested_docs) > 0:
-        for doc in harvested_docs:
-            docs[doc['filename_s']] = doc
-
-    # Query for existing descendants docs
-    fq = ['type_s:descendants', f'dataset_s:{dataset_name}']
-    existing_descendants_docs = solr_query(config, solr_host, fq)
-
-    if len(existing_descendants_docs) > 0:
-        for doc in existing_descendants_docs:
-            descendants_docs[doc['date_s']] = doc
-
-    # setup metadata
-    meta = []
-    last_success_item = {}
-    start = []
-    end = []
-    chk_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    now = datetime.utcnow()
-    updating = False
+    granules = []
 
     # While available granules exist
     while more:
@@ -216,10 +248,8 @@ def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False):
 
         items = xml.findall('{%(atom)s}entry' % namespace)
 
-        # Loops through available granules to download
+        # Loops through available granules
         for elem in items:
-            updating = False
-
             # Prepares information necessary for download and metadata
             try:
                 # download link
@@ -244,123 +274,206 @@ def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False):
                 if len(date_end_str) > 19:
                     date_end_str = date_end_str[:19] + 'Z'
 
-                start_datetime = datetime.strptime(date_start_str, date_regex)
-                end_datetime = datetime.strptime(date_end_str, date_regex)
-
-                if not aggregated:
-                    start.append(start_datetime)
-                    end.append(end_datetime)
-
                 # Attempt to get last modified time of file on podaac
                 # Not all PODAAC datasets contain last modified time
                 try:
                     mod_time = elem.find("{%(atom)s}updated" % namespace).text
                     mod_date_time = datetime.strptime(
                         mod_time, date_regex)
+                    modified_dt = mod_date_time.strftime("%Y-%m-%dT%H:%M:%SZ")
 
                 except:
                     print('Cannot find last modified time.  Downloading granule.')
                     mod_time = str(now)
-                    mod_date_time = now
-
-                # If granule doesn't exist or previously failed or has been updated since last harvest
-                updating = (not newfile in docs.keys()) or (not docs[newfile]['harvest_success_b']) \
-                    or (datetime.strptime(docs[newfile]['download_time_dt'], "%Y-%m-%dT%H:%M:%SZ") <= mod_date_time)
+                    modified_dt = None
 
-                # If updating, download file
-                if updating:
-                    local_fp = f'{target_dir}{date_start_str[:4]}/{newfile}'
+                granules.append({
+                    'filename': newfile,
+                    'source': link,
+                    'date': date_start_str,
+                    'date_end': date_end_str,
+                    'modified_time': mod_time,
+                    'modified_dt': modified_dt
+                })
 
-                    if not os.path.exists(f'{target_dir}{date_start_str[:4]}'):
-                        os.makedirs(f'{target_dir}{date_start_str[:4]}')
-
-                    if newfile in docs.keys():
-                        item_id = docs[newfile]['id']
-                    else:
-                        item_id = None
-
-                    # If file doesn't exist locally, download it
-                    if not os.path.exists(local_fp):
-                        print(f'Downloading: {local_fp}')
+            except Exception as e:
+                print(e)
+                print(f'Unable to read granule entry from {url}')
 
-                        urlcleanup()
-                        urlretrieve(link, local_fp)
+        # Check if more granules are available
+        next = xml.find("{%(atom)s}link[@rel='next']" % namespace)
+        if next is None:
+            more = False
+        else:
+            url = next.attrib['href']
 
-                    # If file exists, but is out of date, download it
-                    elif datetime.fromtimestamp(os.path.getmtime(local_fp)) <= mod_date_time:
-                        print(f'Updating: {local_fp}')
+    return granules
 
-                        urlcleanup()
-                        urlretrieve(link, local_fp)
 
-                    else:
-                        print('File already downloaded and up to date')
+# Gets the size in bytes of a remote file without downloading it
+# Returns None if the server doesn't report it
+def remote_file_size(link):
+    try:
+        r = requests.head(link, allow_redirects=True)
+        return int(r.headers['Content-Length'])
+    except Exception as e:
+        log.debug(e)
+        return None
+
+
+# Builds an OPeNDAP request for only the configured fields and the coordinates they need
+# If subset_bbox ([lat_min, lat_max, lon_min, lon_max]) is set, only that region is requested
+# Returns the url of the subset as a netCDF-4 file
+def opendap_subset_url(link, config):
+    field_names = [field['name'] for field in config['fields']]
+    bbox = config.get('subset_bbox', [])
+
+    # Only the dataset structure and coordinate values are read here, not the data
+    with xr.open_dataset(link, decode_times=False, mask_and_scale=False) as ds:
+        variables = []
+        for name in field_names:
+            for var in [name] + list(ds[name].coords):
+                if var not in variables:
+                    variables.append(var)
+
+        # Full index range for every dimension unless narrowed by the bounding box
+        slices = {dim: (0, size - 1) for dim, size in ds.sizes.items()}
+
+        if bbox:
+            lat_min, lat_max, lon_min, lon_max = bbox
+            lat_name = [c for c in ['lat', 'latitude'] if c in ds.dims]
+            lon_name = [c for c in ['lon', 'longitude'] if c in ds.dims]
+
+            if lat_name:
+                lats = ds[lat_name[0]].values
+                idx = np.where((lats >= lat_min) & (lats <= lat_max))[0]
+                if not idx.size:
+                    raise ValueError(f'No latitudes of {link} within {bbox}')
+                slices[lat_name[0]] = (idx.min(), idx.max())
+
+            if lon_name:
+                lons = ds[lon_name[0]].values
+
+                # Match the bounding box to datasets using 0 to 360 longitudes
+                if lons.max() > 180:
+                    lon_min, lon_max = lon_min % 360, lon_max % 360
+
+                # A box crossing the edge of the longitude range can't be one hyperslab,
+                # so the full longitude range is requested instead
+                if lon_min <= lon_max:
+                    idx = np.where((lons >= lon_min) & (lons <= lon_max))[0]
+                    if not idx.size:
+                        raise ValueError(
+                            f'No longitudes of {link} within {bbox}')
+                    slices[lon_name[0]] = (idx.min(), idx.max())
+
+        projections = []
+        for var in variables:
+            hyperslab = ''.join(
+                [f'[{slices[dim][0]}:1:{slices[dim][1]}]' for dim in ds[var].dims])
+            projections.append(f'{var}{hyperslab}')
+
+    return f'{link}.nc4?{",".join(projections)}'
+
+
+# Whether a granule is requested as an OPeNDAP subset
+# Subset responses are netCDF, so compressed granules are still fetched whole
+def subsets_granule(config, filename):
+    return config.get('subset', False) and filename.endswith('.nc')
+
+
+# Source the granule store keeps a granule under
+# Subsets are kept apart from the full granule at link, under the fields and region requested,
+# so they can be found without reading the granule's structure over OPeNDAP
+def granule_store_source(link, filename, config):
+    if not subsets_granule(config, filename):
+        return link
+
+    field_names = ','.join([field['name'] for field in config['fields']])
+    bbox = ','.join([str(value) for value in config.get('subset_bbox', [])])
+    return f'{link}.nc4?{field_names}' + (f'&bbox={bbox}' if bbox else '')
+
+
+# Returns the link to download a granule from: its OPeNDAP subset, or link itself if the
+# granule isn't subset or the subset can't be built
+# The granule's structure is read through the limiter, holding the netCDF lock shared with
+# the validation and decompression threads
+def granule_download_link(link, filename, config, limiter):
+    if not subsets_granule(config, filename):
+        return link
+
+    def locked_subset_url():
+        with granule_validation.netcdf_lock:
+            return opendap_subset_url(link, config)
 
-                    if aggregated:
-                        # Break up into granules
-                        print(
-                            f'Extracting individual data granules from aggregated data file')
-                        ds = xr.open_dataset(local_fp)
+    try:
+        return limiter.call(urlparse(link).netloc, locked_subset_url)
+    except Exception as e:
+        print(e)
+        print(f'Unable to subset {filename}, downloading full granule')
+        return link
 
-                        ds_times = [time for time in np.datetime_as_string(
-                            ds.time.values) if start_time[:9] <= time.replace('-', '')[:9] <= end_time[:9]]
 
-                        for time in ds_times:
-                            new_ds = ds.sel(time=time)
-                            file_name = f'{dataset_name}_{time.replace("-","")[:8]}.nc'
-                            local_fp = f'{target_dir}{time[:4]}/{file_name}'
+# Opens an aggregated file with each time step as its own dask chunk, so only the
+# time steps (and coordinates) actually used are read from disk
+# Without dask the file is opened plainly, which still reads variables lazily on selection
+def open_aggregated_file(aggregated_fp):
+    if importlib.util.find_spec('dask') is None:
+        return xr.open_dataset(aggregated_fp)
+    return xr.open_dataset(aggregated_fp, chunks={'time': 1})
 
-                            if not os.path.exists(f'{target_dir}{time[:4]}'):
-                                os.makedirs(
-                                    f'{target_dir}{time[:4]}')
 
-                            new_ds.to_netcdf(path=local_fp)
-                            time_s = f'{time[:-10]}Z'
+# Writes the given time steps of an aggregated file to individual granule files
+# Runs in worker processes, each reading only the time steps it writes
+# Returns (time, file_name, local_fp, checksum, file_size) for each written granule
+def split_aggregated_times(aggregated_fp, times, target_dir, dataset_name):
+    results = []
 
-                            if file_name in docs.keys():
-                                item_id = docs[newfile]['id']
-                            else:
-                                item_id = None
+    with open_aggregated_file(aggregated_fp) as ds:
+        for time in times:
+            file_name = f'{dataset_name}_{time.replace("-","")[:8]}.nc'
+            local_fp = f'{target_dir}{time[:4]}/{file_name}'
 
-                            item, descendants_item = metadata_maker(config, time_s, link, time_s, on_aws, target_bucket,
-                                                                    local_fp, file_name, mod_time, descendants_docs, item_id)
+            if not os.path.exists(f'{target_dir}{time[:4]}'):
+                os.makedirs(f'{target_dir}{time[:4]}', exist_ok=True)
 
-                            meta.append(item)
-                            meta.append(descendants_item)
+            ds.sel(time=time).to_netcdf(path=local_fp)
+            results.append((time, file_name, local_fp,
+                            md5(local_fp), os.path.getsize(local_fp)))
 
-                            if item['harvest_success_b']:
-                                last_success_item = item
+    return results
 
-                            start.append(datetime.strptime(
-                                time[:-3], '%Y-%m-%dT%H:%M:%S.%f'))
-                            end.append(datetime.strptime(
-                                time[:-3], '%Y-%m-%dT%H:%M:%S.%f'))
 
-                        local_fp = f'{target_dir}{date_start_str[:4]}/{newfile}'
+# Splits an aggregated file into individual granule files across a pool of worker processes
+# Yields the results of each batch of time steps as it finishes
+# Without workers the file is split in this process, holding the netCDF lock shared with the
+# validation and decompression threads
+def split_aggregated_file(aggregated_fp, times, target_dir, dataset_name, workers):
+    if workers <= 1:
+        with granule_validation.netcdf_lock:
+            results = split_aggregated_times(aggregated_fp, times, target_dir, dataset_name)
+        yield results
+        return
 
-                    else:
-                        item, descendants_item = metadata_maker(config, date_start_str, link, mod_time, on_aws,
-                                                                target_bucket, local_fp, newfile, chk_time, descendants_docs, item_id)
-                        meta.append(descendants_item)
-                        meta.append(item)
+    # Several small batches per worker keep the pool busy when some time steps are slower to write
+    batch_size = max(1, -(-len(times) // (workers * 4)))
+    batches = [times[i:i + batch_size]
+               for i in range(0, len(times), batch_size)]
 
-                        if item['harvest_success_b']:
-                            last_success_item = item
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(split_aggregated_times, aggregated_fp, batch, target_dir, dataset_name)
+                   for batch in batches]
+        for future in as_completed(futures):
+            yield future.result()
 
-            except Exception as e:
-                print(e)
-                print(f'{file_name} unsuccessful')
 
-        # Check if more granules are available
-        next = xml.find("{%(atom)s}link[@rel='next']" % namespace)
-        if next is None:
-            more = False
-            print(f'{dataset_name} done')
-        else:
-            url = next.attrib['href']
+# Posts harvested granule metadata to Solr, and creates or updates the dataset's coverage
+# start and end are the granule start and end times covered by the harvest
+def update_solr_metadata(config, solr_host, meta, start, end, last_success_item, updating, chk_time, telemetry=None):
+    dataset_name = config['ds_name']
 
     # Update Solr with downloaded granule metadata entries
-    r = solr_update(config, solr_host, meta, r=True)
+    r = solr_update(config, solr_host, meta, r=True, telemetry=telemetry)
 
     if r.status_code == 200:
         print('granule metadata post to Solr success')
@@ -417,7 +530,7 @@ def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False):
         body.append(ds_meta)
 
         # Update Solr with dataset metadata
-        r = solr_update(config, solr_host, body, r=True)
+        r = solr_update(config, solr_host, body, r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully created Solr dataset document')
@@ -439,7 +552,7 @@ def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False):
             body.append(field_obj)
 
         # Update Solr with dataset fields metadata
-        r = solr_update(config, solr_host, body, r=True)
+        r = solr_update(config, solr_host, body, r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully created Solr field documents')
@@ -477,9 +590,377 @@ def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False):
                     "set": overall_end.strftime("%Y-%m-%dT%H:%M:%SZ")}
 
         # Update Solr with modified dataset entry
-        r = solr_update(config, solr_host, [update_doc], r=True)
+        r = solr_update(config, solr_host, [update_doc], r=True, telemetry=telemetry)
 
         if r.status_code == 200:
             print('Successfully updated Solr dataset document')
         else:
             print('Failed to update Solr dataset document')
+
+
+# Merges the harvest's granule metadata into the dataset's local granule manifest
+# A dataset without a manifest yet is seeded from all of its harvested docs in Solr
+def update_granule_manifest(config, solr_host, meta, output_path):
+    dataset_name = config['ds_name']
+    fq = [f'dataset_s:{dataset_name}', 'type_s:harvested']
+    manifest_fp = granule_manifest.manifest_path(output_path, dataset_name)
+    try:
+        granule_manifest.update_manifest(
+            manifest_fp, meta, seed=lambda: solr_query(config, solr_host, fq))
+    except Exception as e:
+        print(e)
+        print(f'Unable to update granule manifest {manifest_fp}')
+
+
+# Pulls data files for given PODAAC id and date range
+# If not on_aws, saves locally, else saves to s3 bucket
+# Creates Solr entries for dataset, harvested granule, fields, and descendants
+# In plan mode, only lists granules and writes a manifest of what a harvest would transfer
+# A manifest from plan mode can be given as manifest_path to skip listing granules again
+# With shard_workers set, the date range is split by year and harvested across that many processes
+# Each shard is itself a call with shard=True, which returns its metadata instead of posting it
+def podaac_harvester(config_path='', output_path='', s3=None, on_aws=False, plan=False, manifest_path='', shard=False):
+    # =====================================================
+    # Read configurations from YAML file
+    # =====================================================
+    if not config_path:
+        print('No path for configuration file. Can not run harvester.')
+        return
+
+    with open(config_path, "r") as stream:
+        config = yaml.load(stream, yaml.Loader)
+
+    # =====================================================
+    # Setup AWS Target Bucket
+    # =====================================================
+    if on_aws:
+        target_bucket_name = config['target_bucket_name']
+        target_bucket = s3.Bucket(target_bucket_name)
+        solr_host = config['solr_host_aws']
+    else:
+        target_bucket = None
+        solr_host = config['solr_host_local']
+
+    # Timers and byte counters for the harvest, reported once it finishes
+    telemetry = harvest_telemetry.HarvestTelemetry(config['ds_name'])
+
+    # Pace requests to each remote host, shared with other harvests writing to output_path
+    limiter = rate_limiter.from_config(config, output_path)
+
+    # Harvest the date range in shards across processes, then post their merged metadata at once
+    # Aggregated files span the whole range, so they aren't sharded
+    shard_workers = config.get('shard_workers', 0)
+    if shard_workers > 1 and not (shard or plan or manifest_path or on_aws or config['aggregated']):
+        chk_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        results = harvest_shards.run_shards(
+            podaac_harvester, config, output_path, shard_workers)
+        merged = harvest_shards.merge_shard_results(results, telemetry)
+
+        update_solr_metadata(config, solr_host, merged['meta'], merged.get('start', []), merged.get('end', []),
+                             merged['last_success_item'], merged['updating'], chk_time, telemetry)
+        update_granule_manifest(config, solr_host, merged['meta'], output_path)
+        telemetry.write(
+            f'{output_path}{config["ds_name"]}/harvest_telemetry.json')
+        return
+
+    # Upload in the background while the next granules download
+    upload_queue = None
+    if on_aws and config.get('upload_workers', 0) and not plan:
+        upload_queue = s3_uploads.UploadQueue(target_bucket, config['upload_workers'],
+                                              int(config.get('s3_part_size_mb', 8) * 1024 * 1024),
+                                              telemetry=telemetry)
+
+    # =====================================================
+    # Initializing required values
+    # =====================================================
+    dataset_name = config['ds_name']
+
+    target_dir = f'{output_path}{dataset_name}/harvested_granules/'
+    date_regex = config['date_regex']
+    aggregated = config['aggregated']
+    start_time = config['start']
+    end_time = config['end']
+
+    # Aggregated files have to be split locally, so they can't be streamed
+    stream_to_s3 = on_aws and config.get('stream_to_s3', False) and not aggregated
+    s3_part_size = int(config.get('s3_part_size_mb', 8) * 1024 * 1024)
+
+    # Worker processes used to split aggregated files into individual granules
+    split_workers = config.get('split_workers', 4)
+
+    # Decompress .gz and .bz2 granules once at harvest instead of at every transformation
+    # The cache is only kept for local harvests
+    decompression_queue = None
+    if config.get('decompress', False) and not on_aws and not plan:
+        decompression_queue = granule_decompression.DecompressionQueue(target_dir, f'{output_path}{dataset_name}/decompressed_granules/',
+                                                                       config.get('decompress_workers', 2),
+                                                                       config.get('decompress_complevel', 0))
+
+    # Check and summarise each downloaded granule's header in the background so bad downloads
+    # are marked as failed before they reach transformation, and transformation can plan from
+    # the summary without opening the file
+    validation_queue = None
+    if not plan:
+        validation_queue = granule_validation.ValidationQueue([field['name'] for field in config['fields']],
+                                                              config.get('validation_workers', 1),
+                                                              time_dim=config.get('validation_time_dim'),
+                                                              validate=config.get('validate_granules', True))
+
+    # Shared content addressed store of harvested files, only used for local harvests
+    store = granule_store.GranuleStore(config['granule_store_dir']) \
+        if config.get('granule_store_dir') and not on_aws else None
+
+    if not on_aws:
+        print(f'!!downloading files to {target_dir}')
+    else:
+        print(
+            f'!!downloading files and uploading to {target_bucket_name}/{dataset_name}')
+
+    # if target paths don't exist, make them
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    docs = {}
+    descendants_docs = {}
+
+    # Query for existing harvested docs
+    fq = ['type_s:harvested', f'dataset_s:{dataset_name}']
+    harvested_docs = solr_query(config, solr_host, fq)
+
+    if len(harvested_docs) > 0:
+        for doc in harvested_docs:
+            docs[doc['filename_s']] = doc
+
+    # Query for existing descendants docs
+    fq = ['type_s:descendants', f'dataset_s:{dataset_name}']
+    existing_descendants_docs = solr_query(config, solr_host, fq)
+
+    if len(existing_descendants_docs) > 0:
+        for doc in existing_descendants_docs:
+            descendants_docs[doc['date_s']] = doc
+
+    # setup metadata
+    meta = []
+    last_success_item = {}
+    start = []
+    end = []
+    chk_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    now = datetime.utcnow()
+    updating = False
+
+    # Reuse the listing from a previous plan if given, otherwise list available granules
+    if manifest_path:
+        granules = harvest_plan.read_harvest_plan(manifest_path, config)
+        if granules is None:
+            return
+    else:
+        granules = podaac_granule_listing(config, now)
+
+    # Decide what to do with each granule against the current harvested docs
+    for granule in granules:
+        mod_date_time = harvest_plan.modified_date_time(granule, now)
+        granule['action'] = harvest_plan.granule_action(
+            docs, granule['filename'], mod_date_time)
+        granule['local_path'] = f'{target_dir}{granule["date"][:4]}/{granule["filename"]}'
+        granule['transfer'] = stream_to_s3 or harvest_plan.needs_transfer(
+            granule['local_path'], mod_date_time)
+
+        # Granules already in the granule store are linked, not transferred
+        if store and store.lookup(granule_store_source(granule['source'], granule['filename'], config),
+                                  granule['modified_dt']):
+            granule['transfer'] = False
+
+    # In plan mode, write out the manifest without downloading or touching Solr
+    if plan:
+        for granule in granules:
+            granule['size'] = remote_file_size(granule['source']) \
+                if granule['action'] != 'skip' and granule['transfer'] else None
+
+            # Subsets are sized by their full granule, without reading each one's structure
+            if granule['size'] is not None and subsets_granule(config, granule['filename']):
+                granule['size_upper_bound'] = True
+
+        harvest_plan_doc = harvest_plan.make_harvest_plan(
+            config, 'podaac', granules)
+        harvest_plan.write_harvest_plan(
+            harvest_plan_doc, f'{output_path}{dataset_name}/harvest_plan.json')
+        return harvest_plan_doc
+
+    # Loops through available granules to download
+    for granule in granules:
+        updating = False
+
+        try:
+            link = granule['source']
+            newfile = granule['filename']
+            date_start_str = granule['date']
+            date_end_str = granule['date_end']
+            mod_time = granule['modified_time']
+            mod_date_time = harvest_plan.modified_date_time(granule, now)
+
+            if not aggregated:
+                start.append(datetime.strptime(date_start_str, date_regex))
+                end.append(datetime.strptime(date_end_str, date_regex))
+
+            # If granule doesn't exist or previously failed or has been updated since last harvest
+            updating = granule['action'] != 'skip'
+
+            # If updating and streaming, pipe the download straight into S3
+            if updating and stream_to_s3:
+                item_id = docs[newfile]['id'] if newfile in docs.keys() else None
+                output_filename = f'{dataset_name}/{newfile}'
+                print(f'Streaming: {newfile} to {target_bucket_name}')
+
+                download_link = granule_download_link(link, newfile, config, limiter)
+                urlcleanup()
+                host = urlparse(download_link).netloc
+                with telemetry.phase('download', host=host) as op, \
+                        limiter.call(host, urlopen, download_link) as response:
+                    s3_stream = s3_uploads.upload_stream(
+                        response, target_bucket, output_filename, s3_part_size)
+                    op['bytes'] = s3_stream.size
+
+                item, descendants_item = metadata_maker(config, date_start_str, link, mod_time, on_aws,
+                                                        target_bucket, '', newfile, chk_time, descendants_docs, item_id,
+                                                        checksum=s3_stream.md5, file_size=s3_stream.size,
+                                                        s3_path=s3_stream.s3_path)
+                meta.append(descendants_item)
+                meta.append(item)
+
+            # If updating, download file
+            elif updating:
+                local_fp = f'{target_dir}{date_start_str[:4]}/{newfile}'
+
+                if not os.path.exists(f'{target_dir}{date_start_str[:4]}'):
+                    os.makedirs(f'{target_dir}{date_start_str[:4]}')
+
+                if newfile in docs.keys():
+                    item_id = docs[newfile]['id']
+                else:
+                    item_id = None
+
+                # Link an identical granule from the granule store instead of downloading it
+                # Subsets are stored apart from the full granule
+                store_source = granule_store_source(link, newfile, config)
+                if store and store.checkout(store_source, granule['modified_dt'], local_fp):
+                    print(f'Linked from granule store: {local_fp}')
+
+                # If file doesn't exist locally, download it
+                elif not os.path.exists(local_fp):
+                    print(f'Downloading: {local_fp}')
+
+                    download_link = granule_download_link(link, newfile, config, limiter)
+                    urlcleanup()
+                    limiter.call(urlparse(download_link).netloc,
+                                 telemetry.urlretrieve, download_link, local_fp)
+
+                    # A granule that couldn't be subset is stored as the full granule
+                    if download_link == link:
+                        store_source = link
+
+                # If file exists, but is out of date, download it
+                elif datetime.fromtimestamp(os.path.getmtime(local_fp)) <= mod_date_time:
+                    print(f'Updating: {local_fp}')
+
+                    download_link = granule_download_link(link, newfile, config, limiter)
+                    urlcleanup()
+                    limiter.call(urlparse(download_link).netloc,
+                                 telemetry.urlretrieve, download_link, local_fp)
+
+                    if download_link == link:
+                        store_source = link
+
+                else:
+                    print('File already downloaded and up to date')
+
+                # Keep the granule in the granule store so later harvests can link it
+                checksum = ''
+                if store:
+                    checksum = store.checkin(
+                        local_fp, store_source, granule['modified_dt'])
+
+                if aggregated:
+                    # Break up into granules
+                    print(
+                        f'Extracting individual data granules from aggregated data file')
+                    # The netCDF library isn't thread safe, and validation and decompression
+                    # threads may be reading other granules
+                    with granule_validation.netcdf_lock, open_aggregated_file(local_fp) as ds:
+                        ds_times = [time for time in np.datetime_as_string(
+                            ds.time.values) if start_time[:9] <= time.replace('-', '')[:9] <= end_time[:9]]
+
+                    for results in split_aggregated_file(local_fp, ds_times, target_dir, dataset_name, split_workers):
+                        for time, file_name, granule_fp, checksum, file_size in results:
+                            time_s = f'{time[:-10]}Z'
+
+                            if file_name in docs.keys():
+                                item_id = docs[file_name]['id']
+                            else:
+                                item_id = None
+
+                            item, descendants_item = metadata_maker(config, time_s, link, time_s, on_aws, target_bucket,
+                                                                    granule_fp, file_name, mod_time, descendants_docs, item_id,
+                                                                    checksum=checksum, file_size=file_size,
+                                                                    upload_queue=upload_queue, telemetry=telemetry,
+                                                                    validation_queue=validation_queue,
+                                                                    decompression_queue=decompression_queue)
+
+                            meta.append(item)
+                            meta.append(descendants_item)
+
+                            start.append(datetime.strptime(
+                                time[:-3], '%Y-%m-%dT%H:%M:%S.%f'))
+                            end.append(datetime.strptime(
+                                time[:-3], '%Y-%m-%dT%H:%M:%S.%f'))
+
+                    local_fp = f'{target_dir}{date_start_str[:4]}/{newfile}'
+
+                else:
+                    item, descendants_item = metadata_maker(config, date_start_str, link, mod_time, on_aws,
+                                                            target_bucket, local_fp, newfile, chk_time, descendants_docs, item_id,
+                                                            checksum=checksum, upload_queue=upload_queue,
+                                                            telemetry=telemetry, validation_queue=validation_queue,
+                                                            decompression_queue=decompression_queue)
+                    meta.append(descendants_item)
+                    meta.append(item)
+
+        except Exception as e:
+            print(e)
+            print(f'{newfile} unsuccessful')
+
+    print(f'{dataset_name} done')
+
+    # Wait for background uploads so granule metadata reflects their outcome
+    if upload_queue:
+        print('Waiting for queued s3 uploads to finish')
+        upload_queue.join()
+
+    # Wait for decompression so granule metadata points at the decompressed copies
+    if decompression_queue:
+        failures = decompression_queue.join()
+        if failures:
+            print(f'{failures} granules could not be decompressed')
+
+    # Wait for header checks so granule metadata reflects their outcome
+    if validation_queue:
+        failures = validation_queue.join()
+        if failures:
+            print(f'{failures} granules failed validation')
+
+    # Granules whose queued work failed were marked so by the joins above
+    last_success_item = last_successful_item(meta)
+
+    # Shards hand their granule metadata back to the sharded harvest to post
+    if shard:
+        return {'meta': meta, 'start': start, 'end': end, 'last_success_item': last_success_item,
+                'updating': updating, 'telemetry': telemetry.summary()}
+
+    update_solr_metadata(config, solr_host, meta, start, end,
+                         last_success_item, updating, chk_time, telemetry)
+
+    # Keep the local manifest of harvested granules in step with Solr
+    if not on_aws:
+        update_granule_manifest(config, solr_host, meta, output_path)
+
+    # Write the harvest's timers and byte counters next to its granules
+    telemetry.write(f'{output_path}{dataset_name}/harvest_telemetry.json')
@@ -3,11 +3,11 @@ import sys
 import importlib
 
 
-def main(config_path='', output_path=''):
+def main(config_path='', output_path='', plan=False, manifest_path=''):
     import podaac_harvester
     podaac_harvester = importlib.reload(podaac_harvester)
-    podaac_harvester.podaac_harvester(
-        config_path=config_path, output_path=output_path, on_aws=False)
+    return podaac_harvester.podaac_harvester(
+        config_path=config_path, output_path=output_path, on_aws=False, plan=plan, manifest_path=manifest_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import fcntl
+import random
+import socket
+import hashlib
+import ftplib
+from contextlib import contextmanager
+from urllib.error import HTTPError, URLError
+
+# Responses that mean the host wants fewer requests
+THROTTLE_HTTP_CODES = [429, 503]
+THROTTLE_FTP_CODES = ['421']
+
+
+# Checks whether an exception from a request means the host is throttling or overloaded
+# Timeouts and reset connections count, as overloaded servers tend to drop requests that way
+def is_throttled(e):
+    if isinstance(e, HTTPError):
+        return e.code in THROTTLE_HTTP_CODES
+    if isinstance(e, ftplib.error_temp):
+        return str(e)[:3] in THROTTLE_FTP_CODES
+    if isinstance(e, (socket.timeout, TimeoutError, ConnectionResetError)):
+        return True
+    if isinstance(e, URLError):
+        return isinstance(e.reason, (socket.timeout, TimeoutError))
+    return False
+
+
+# Returns the seconds a throttled HTTP response asked to wait for, or None
+def retry_after(e):
+    if isinstance(e, HTTPError) and e.headers:
+        try:
+            return float(e.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+# Token bucket per remote host, with the rate adjusted by additive increase and
+# multiplicative decrease: every request that goes through raises the host's rate a little,
+# and every throttled or timed out request halves it
+# Each host's bucket is a small json file under state_dir, locked with flock while it's
+# updated, so harvester processes and threads sharing state_dir share the same pace per host
+class HostRateLimiter:
+    def __init__(self, state_dir, rate=10.0, burst=10, min_rate=0.1, max_rate=100.0,
+                 increase=0.5, decrease=0.5, retries=5):
+        self.state_dir = state_dir
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.retries = retries
+
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir, exist_ok=True)
+
+    def _state_path(self, host):
+        host_hash = hashlib.sha1(host.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.state_dir, f'{host_hash}.json')
+
+    # Yields the host's bucket, refilled up to now, and writes it back on exit
+    # Holds an exclusive lock on the bucket file for the duration
+    @contextmanager
+    def _bucket(self, host):
+        with open(self._state_path(host), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {'host': host, 'rate': self.rate, 'tokens': float(self.burst),
+                             'updated': time.time(), 'blocked_until': 0}
+
+                now = time.time()
+                state['tokens'] = min(self.burst, state['tokens'] +
+                                      (now - state['updated']) * state['rate'])
+                state['updated'] = now
+
+                yield state
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Blocks until a request to host is allowed
+    def acquire(self, host):
+        while True:
+            with self._bucket(host) as state:
+                wait = state['blocked_until'] - state['updated']
+                if wait <= 0:
+                    if state['tokens'] >= 1:
+                        state['tokens'] -= 1
+                        return
+                    wait = (1 - state['tokens']) / state['rate']
+            time.sleep(wait)
+
+    # Raises the host's rate after a request went through
+    def succeeded(self, host):
+        with self._bucket(host) as state:
+            state['rate'] = min(self.max_rate, state['rate'] + self.increase)
+
+    # Cuts the host's rate after it throttled or timed out a request, and holds off all
+    # requests to it for delay seconds if given
+    def throttled(self, host, delay=None):
+        with self._bucket(host) as state:
+            state['rate'] = max(self.min_rate, state['rate'] * self.decrease)
+            state['tokens'] = 0.0
+            if delay:
+                state['blocked_until'] = max(
+                    state['blocked_until'], state['updated'] + delay)
+
+    # Calls fn(*args, **kwargs) once the host allows it, retrying throttled or timed out
+    # calls with jittered exponential backoff on top of the bucket's own pacing
+    # on_retry is called before each retry, e.g. to reopen a dropped connection
+    # Returns what fn returns, or raises its last exception
+    def call(self, host, fn, *args, on_retry=None, **kwargs):
+        for attempt in range(self.retries):
+            self.acquire(host)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_throttled(e) or attempt == self.retries - 1:
+                    raise
+
+                # Every caller of the host holds off until the backoff is over
+                backoff = retry_after(e) or min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+                self.throttled(host, backoff)
+                print(f'{host} throttled or timed out ({e}), retrying in {backoff:.1f}s')
+
+                if on_retry:
+                    on_retry()
+                continue
+
+            self.succeeded(host)
+            return result
+
+
+# Builds the rate limiter for a harvest from its config
+# Harvests sharing an output directory share their per-host rates unless rate_limit_dir says otherwise
+def from_config(config, output_path):
+    return HostRateLimiter(config.get('rate_limit_dir') or f'{output_path}rate_limits/',
+                           rate=config.get('rate_limit_per_second', 10),
+                           burst=config.get('rate_limit_burst', 10),
+                           min_rate=config.get('rate_limit_min_per_second', 0.1),
+                           max_rate=config.get('rate_limit_max_per_second', 100),
+                           retries=config.get('rate_limit_retries', 5))
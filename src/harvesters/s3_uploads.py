@@ -0,0 +1,175 @@
+import os
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# S3 requires every part of a multipart upload, except the last, to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+# File-like writer that sends everything written to it to S3 as a multipart upload
+# The md5 checksum and size of the object are computed as the bytes go by,
+# so the granule never has to be written to local disk
+class S3MultipartStream:
+    def __init__(self, target_bucket, key, part_size=MIN_PART_SIZE):
+        self.client = target_bucket.meta.client
+        self.bucket_name = target_bucket.name
+        self.key = key
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+
+        self.size = 0
+        self.parts = []
+        self.buffer = bytearray()
+        self.hash_md5 = hashlib.md5()
+
+        response = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key)
+        self.upload_id = response['UploadId']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    @property
+    def md5(self):
+        return self.hash_md5.hexdigest()
+
+    @property
+    def s3_path(self):
+        return f's3://{self.bucket_name}/{self.key}'
+
+    def write(self, data):
+        self.hash_md5.update(data)
+        self.size += len(data)
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+        return len(data)
+
+    def _upload_part(self, body):
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket_name, Key=self.key, PartNumber=part_number,
+                                           UploadId=self.upload_id, Body=body)
+        self.parts.append({'ETag': response['ETag'],
+                           'PartNumber': part_number})
+
+    # Uploads whatever is left in the buffer as the last part and completes the upload
+    def close(self):
+        # S3 needs at least one part, even for an empty object
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+
+    # Discards the parts uploaded so far so they aren't billed as orphaned storage
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                           UploadId=self.upload_id)
+
+
+# Copies a readable file-like object (ex: an HTTP response) straight into S3
+# Returns the completed S3MultipartStream, which holds the checksum, size and s3 path
+def upload_stream(source, target_bucket, key, part_size=MIN_PART_SIZE):
+    with S3MultipartStream(target_bucket, key, part_size) as s3_stream:
+        shutil.copyfileobj(source, s3_stream, 1024 * 1024)
+    return s3_stream
+
+
+# Retrieves a file over an open FTP connection straight into S3
+# Returns the completed S3MultipartStream, which holds the checksum, size and s3 path
+def upload_ftp_file(ftp, path, target_bucket, key, part_size=MIN_PART_SIZE):
+    with S3MultipartStream(target_bucket, key, part_size) as s3_stream:
+        ftp.retrbinary(f'RETR {path}', s3_stream.write, 1024 * 1024)
+    return s3_stream
+
+
+# Uploads local files to S3 on background threads so the harvester can move on to the next download
+# Callbacks are run from join(), once every upload has finished, so harvest metadata
+# is finalized in the harvester's own thread
+# If a HarvestTelemetry is given, upload times and queue depth are recorded in it
+class UploadQueue:
+    def __init__(self, target_bucket, concurrency=4, part_size=MIN_PART_SIZE, telemetry=None):
+        from boto3.s3.transfer import TransferConfig
+
+        part_size = max(int(part_size), MIN_PART_SIZE)
+        self.target_bucket = target_bucket
+        self.transfer_config = TransferConfig(multipart_threshold=part_size,
+                                              multipart_chunksize=part_size)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.pending = []
+        self.telemetry = telemetry
+
+        # Bound the number of queued files so scratch space can't fill up
+        # when downloads outpace uploads
+        self.slots = threading.BoundedSemaphore(2 * concurrency)
+
+    # Number of uploads queued or in flight
+    @property
+    def depth(self):
+        return len([future for future, _, _ in self.pending if not future.done()])
+
+    def _upload(self, local_fp, key, remove_after, skip):
+        try:
+            reason = skip() if skip else ''
+            if reason:
+                print(f'Not uploading {os.path.basename(local_fp)} to s3: {reason}')
+                return None
+
+            if self.telemetry:
+                with self.telemetry.phase('upload', os.path.getsize(local_fp)):
+                    self.target_bucket.upload_file(
+                        local_fp, key, Config=self.transfer_config)
+            else:
+                self.target_bucket.upload_file(
+                    local_fp, key, Config=self.transfer_config)
+        finally:
+            if remove_after and os.path.exists(local_fp):
+                os.remove(local_fp)
+            self.slots.release()
+        return f's3://{self.target_bucket.name}/{key}'
+
+    # Queues local_fp for upload to key, blocking while the queue is full
+    # skip is called on the upload thread before uploading (ex: to wait for the granule's
+    # validation), and the upload is skipped if it returns a reason
+    # on_success(s3_path) and on_failure(exception) are called from join(), neither for a skipped upload
+    def submit(self, local_fp, key, on_success=None, on_failure=None, remove_after=False, skip=None):
+        self.slots.acquire()
+        future = self.executor.submit(
+            self._upload, local_fp, key, remove_after, skip)
+        self.pending.append((future, on_success, on_failure))
+
+        if self.telemetry:
+            self.telemetry.sample_queue_depth(self.depth)
+
+    # Waits for all queued uploads and runs their callbacks
+    # Returns the number of failed uploads
+    def join(self):
+        failures = 0
+        for future, on_success, on_failure in self.pending:
+            try:
+                s3_path = future.result()
+            except Exception as e:
+                print(e)
+                print("======aws upload unsuccessful=======")
+                failures += 1
+                if on_failure:
+                    on_failure(e)
+            else:
+                if s3_path and on_success:
+                    on_success(s3_path)
+
+        self.pending = []
+        self.executor.shutdown()
+        return failures
@@ -0,0 +1,78 @@
+import sys
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import factor_store
+
+# Model grid points mapped per chunk, unless the config's factors_chunk_size says otherwise
+DEFAULT_CHUNK_SIZE = 20000
+
+# The source grid of the factors being built, sent once to each worker process
+_source = {}
+
+
+def import_ecco_cloud_utils():
+    generalized_functions_path = Path(
+        f'{Path(__file__).resolve().parents[4]}/ECCO-ACCESS/ecco-cloud-utils/')
+    sys.path.append(str(generalized_functions_path))
+    import ecco_cloud_utils as ea  # pylint: disable=import-error
+    return ea
+
+
+def init_factor_worker(source_grid, source_grid_min_L, source_grid_max_L):
+    _source['grid'] = source_grid
+    _source['min_L'] = source_grid_min_L
+    _source['max_L'] = source_grid_max_L
+
+
+# Maps the source grid to one chunk of model grid points with
+# ecco_cloud_utils.find_mappings_from_source_to_target
+# Returns the chunk's factors as factor store arrays, indexed from the chunk's first point
+def chunk_factors(target_lons, target_lats, target_grid_radius):
+    import pyresample as pr
+    ea = import_ecco_cloud_utils()
+
+    target_grid = pr.geometry.SwathDefinition(lons=target_lons, lats=target_lats)
+
+    factors = ea.find_mappings_from_source_to_target(_source['grid'],
+                                                     target_grid,
+                                                     target_grid_radius,
+                                                     _source['min_L'],
+                                                     _source['max_L'])
+    return factor_store.factors_to_arrays(factors)
+
+
+# Builds the factors mapping source_grid to the model grid points at target_lons, target_lats
+# The model grid points are split into chunks of chunk_size, each mapped on its own, across a pool
+# of worker processes if workers is above one. Every model grid point is mapped independently of
+# the others, so the merged chunks are the same factors as mapping all the points at once
+# Returns the factors as factor store arrays, for factor_store.save_factors
+def build_factors(source_grid, target_lons, target_lats, target_grid_radius, source_grid_min_L,
+                  source_grid_max_L, chunk_size=DEFAULT_CHUNK_SIZE, workers=1):
+    target_lons = np.asarray(target_lons).ravel()
+    target_lats = np.asarray(target_lats).ravel()
+    target_grid_radius = np.broadcast_to(target_grid_radius, target_lons.shape)
+
+    starts = range(0, len(target_lons), max(1, chunk_size))
+    chunks = [slice(start, start + chunk_size) for start in starts]
+
+    if workers <= 1 or len(chunks) <= 1:
+        init_factor_worker(source_grid, source_grid_min_L, source_grid_max_L)
+        chunk_arrays = [chunk_factors(target_lons[chunk], target_lats[chunk], target_grid_radius[chunk])
+                        for chunk in chunks]
+        return factor_store.concatenate_factor_arrays(chunk_arrays)
+
+    print(f'Mapping {len(target_lons)} model grid points in {len(chunks)} chunks across {workers} processes')
+
+    chunk_arrays = [None] * len(chunks)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_factor_worker,
+                             initargs=(source_grid, source_grid_min_L, source_grid_max_L)) as executor:
+        futures = {executor.submit(chunk_factors, target_lons[chunk], target_lats[chunk],
+                                   target_grid_radius[chunk]): i
+                   for i, chunk in enumerate(chunks)}
+
+        for future in as_completed(futures):
+            chunk_arrays[futures[future]] = future.result()
+
+    return factor_store.concatenate_factor_arrays(chunk_arrays)
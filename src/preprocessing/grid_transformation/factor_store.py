@@ -0,0 +1,256 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import numpy as np
+from datetime import datetime
+
+# Bump when the layout of the stored arrays changes
+FORMAT_VERSION = 1
+
+MANIFEST = 'factors.json'
+
+# offsets and indices hold the source indices within each target's radius in CSR layout:
+# target i's indices are indices[offsets[i]:offsets[i + 1]]
+# nearest holds each target's nearest source index, -1 where there isn't one
+ARRAYS = ['offsets', 'indices', 'nearest']
+
+
+def md5(fname):
+    hash_md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+# Per target view of the stored indices, indexed like the lists made by
+# ecco_cloud_utils.find_mappings_from_source_to_target
+class RaggedIndices:
+    def __init__(self, offsets, indices):
+        self.offsets = offsets
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if start == end:
+            return -1
+        return self.indices[start:end]
+
+
+# Grid mapping factors loaded from a factor store
+# Unpacks like the factors tuple of find_mappings_from_source_to_target:
+#   source_indices_within_target_radius_i, num_source_indices_within_target_radius_i,
+#   nearest_source_index_to_target_index_i = factors
+# The arrays are memory-mapped, so worker processes loading the same store share
+# one copy of them in the page cache
+class StoredFactors:
+    def __init__(self, store_dir, offsets, indices, nearest, manifest):
+        self.store_dir = store_dir
+        self.offsets = offsets
+        self.indices = indices
+        self.nearest = nearest
+        self.manifest = manifest
+        self.counts = np.diff(offsets)
+        self.source_indices = RaggedIndices(offsets, indices)
+
+    def as_tuple(self):
+        return (self.source_indices, self.counts, self.nearest)
+
+    def __iter__(self):
+        return iter(self.as_tuple())
+
+    def __len__(self):
+        return 3
+
+    def __getitem__(self, i):
+        return self.as_tuple()[i]
+
+
+# Converts the factors tuple made by find_mappings_from_source_to_target into the
+# stored arrays. Its per target entries can be in lists, dicts or object arrays,
+# with -1 (or no entry) where a target has no source indices or nearest index
+def factors_to_arrays(factors):
+    source_indices, num_source_indices, nearest_source_index = factors
+
+    counts = np.asarray(num_source_indices).astype(np.int64)
+    num_targets = len(counts)
+
+    chunks = []
+    offsets = np.zeros(num_targets + 1, dtype=np.int64)
+    for i in range(num_targets):
+        if counts[i] > 0:
+            target_indices = np.atleast_1d(
+                np.asarray(source_indices[i])).astype(np.int64)
+            chunks.append(target_indices)
+            offsets[i + 1] = offsets[i] + len(target_indices)
+        else:
+            offsets[i + 1] = offsets[i]
+
+    indices = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+
+    nearest = np.full(num_targets, -1, dtype=np.int64)
+    for i in range(num_targets):
+        if isinstance(nearest_source_index, dict):
+            value = nearest_source_index.get(i, -1)
+        else:
+            value = nearest_source_index[i] if i < len(nearest_source_index) else -1
+        try:
+            nearest[i] = int(value)
+        except (TypeError, ValueError):
+            nearest[i] = -1
+
+    # Source grids are far smaller than 2**31 points, so indices fit in int32
+    index_dtype = np.int32 if max(indices.max(initial=-1), nearest.max(initial=-1)) < 2 ** 31 \
+        else np.int64
+
+    return {'offsets': offsets,
+            'indices': indices.astype(index_dtype),
+            'nearest': nearest.astype(index_dtype)}
+
+
+# Joins the arrays of factors made for consecutive chunks of model grid points, in order,
+# into the arrays of the factors for all of them
+def concatenate_factor_arrays(chunk_arrays):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for arrays in chunk_arrays:
+        offsets.append(arrays['offsets'][1:] + offsets[-1][-1])
+
+    indices = np.concatenate([arrays['indices'] for arrays in chunk_arrays]).astype(np.int64)
+    nearest = np.concatenate([arrays['nearest'] for arrays in chunk_arrays]).astype(np.int64)
+
+    index_dtype = np.int32 if max(indices.max(initial=-1), nearest.max(initial=-1)) < 2 ** 31 \
+        else np.int64
+
+    return {'offsets': np.concatenate(offsets),
+            'indices': indices.astype(index_dtype),
+            'nearest': nearest.astype(index_dtype)}
+
+
+# Writes factors (a factors tuple or the dict of arrays from factors_to_arrays) to store_dir
+# metadata is recorded in the manifest, e.g. the transformation version they were made with
+# The store is written beside store_dir and moved into place, so it's never seen half written
+def save_factors(store_dir, factors, **metadata):
+    arrays = factors if isinstance(factors, dict) else factors_to_arrays(factors)
+    store_dir = store_dir.rstrip('/')
+
+    tmp_dir = f'{store_dir}.tmp{os.getpid()}'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'created_dt': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'num_targets': len(arrays['offsets']) - 1,
+        'arrays': {},
+        'metadata': metadata
+    }
+
+    for name in ARRAYS:
+        array_fp = os.path.join(tmp_dir, f'{name}.npy')
+        np.save(array_fp, np.ascontiguousarray(arrays[name]))
+        manifest['arrays'][name] = {'dtype': str(arrays[name].dtype),
+                                    'shape': list(arrays[name].shape),
+                                    'md5': md5(array_fp)}
+
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+
+    return store_dir
+
+
+# Hash naming the factors made from a source grid's parameters (data_res, data_max_lat,
+# area_extent, dims and proj_info), the model grid's checksum, how its radii are found and the
+# factors_version they were made for, which is bumped to make them again
+# Numbers are compared by value, so 90 and 90.0 name the same factors
+def source_grid_key(source_grid_params, grid_checksum, radius_method, factors_version):
+    def normalise(value):
+        if isinstance(value, dict):
+            return {str(k): normalise(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalise(v) for v in value]
+        if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+            return float(value)
+        return value
+
+    key = json.dumps({'source_grid': normalise(source_grid_params),
+                      'grid_checksum': grid_checksum,
+                      'radius_method': radius_method,
+                      'factors_version': factors_version,
+                      'format_version': FORMAT_VERSION}, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def is_factor_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+# Whether path is a factor store in the current format with factors made for factors_version
+def store_current(path, factors_version):
+    if not is_factor_store(path):
+        return False
+
+    with open(os.path.join(path, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+
+    return manifest['format_version'] == FORMAT_VERSION and \
+        manifest['metadata'].get('factors_version') == factors_version
+
+
+# Recomputes the checksums of a store's arrays against its manifest
+# Returns a list of the arrays that don't match
+def verify_factors(store_dir):
+    with open(os.path.join(store_dir, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+
+    return [name for name, entry in manifest['arrays'].items()
+            if md5(os.path.join(store_dir, f'{name}.npy')) != entry['md5']]
+
+
+# Loads factors from a factor store, memory-mapping its arrays
+# Only the manifest is read up front; verify also checks the arrays against their checksums
+# A factors pickle from before the store is converted into a store beside it on first load,
+# and that store is used from then on
+def load_factors(path, verify=False):
+    path = path.rstrip('/')
+
+    if not os.path.isdir(path):
+        store_dir = f'{path}_store'
+        if not is_factor_store(store_dir) or os.path.getmtime(store_dir) < os.path.getmtime(path):
+            print(f'Converting pickled factors {path} to a factor store')
+            with open(path, 'rb') as f:
+                save_factors(store_dir, pickle.load(f), converted_from=path)
+        path = store_dir
+
+    with open(os.path.join(path, MANIFEST), 'r') as f:
+        manifest = json.load(f)
+
+    if manifest['format_version'] != FORMAT_VERSION:
+        raise ValueError(
+            f'Factor store {path} is format {manifest["format_version"]}, expected {FORMAT_VERSION}')
+
+    if verify:
+        mismatched = verify_factors(path)
+        if mismatched:
+            raise ValueError(
+                f'Factor store {path} failed checksums for {", ".join(mismatched)}')
+
+    arrays = {}
+    for name, entry in manifest['arrays'].items():
+        # Empty arrays can't be memory-mapped
+        arrays[name] = np.load(os.path.join(path, f'{name}.npy'),
+                               mmap_mode='r' if np.prod(entry['shape']) else None)
+        if list(arrays[name].shape) != entry['shape']:
+            raise ValueError(
+                f'Factor store {path} has a truncated {name} array')
+
+    return StoredFactors(path, arrays['offsets'], arrays['indices'], arrays['nearest'], manifest)
@@ -0,0 +1,131 @@
+import os
+import pickle
+import shutil
+import hashlib
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+
+import factor_store
+
+# Model grids and factor sets each process keeps loaded, unless set_cache_size says otherwise
+DEFAULT_CACHE_SIZE = 4
+
+# A published model grid is a directory of one .npy per numeric variable and a pickled manifest
+# of the grid's dims, attributes and any variables that can't be memory-mapped
+GRID_MANIFEST = 'grid.pkl'
+
+
+# Least recently used cache of loaded objects, holding at most max_items of them
+class LRUCache:
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+
+    # Returns the object cached for key, calling load() to make it on a miss
+    def get(self, key, load):
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+
+        value = load()
+        self.items[key] = value
+        self.evict()
+        return value
+
+    def evict(self):
+        while len(self.items) > max(self.max_items, 0):
+            self.items.popitem(last=False)
+
+
+model_grids = LRUCache(DEFAULT_CACHE_SIZE)
+factors = LRUCache(DEFAULT_CACHE_SIZE)
+
+
+def set_cache_size(cache_size):
+    for cache in [model_grids, factors]:
+        cache.max_items = cache_size
+        cache.evict()
+
+
+# Writes the model grid at grid_path to grid_dir as memory-mappable arrays
+# Written beside grid_dir and moved into place, so it's never seen half written, and left
+# alone if another process published it first
+def publish_model_grid(grid_path, grid_dir):
+    grid_dir = grid_dir.rstrip('/')
+    tmp_dir = f'{grid_dir}.tmp{os.getpid()}'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    with xr.open_dataset(grid_path) as model_grid:
+        model_grid = model_grid.reset_coords()
+
+        manifest = {'attrs': model_grid.attrs, 'variables': {}}
+        for i, (name, variable) in enumerate(model_grid.variables.items()):
+            entry = {'dims': variable.dims, 'attrs': variable.attrs, 'coord': name in model_grid.coords}
+            values = variable.values
+            if values.dtype.kind in 'biuf':
+                entry['file'] = f'{i}.npy'
+                np.save(os.path.join(tmp_dir, entry['file']), values)
+            else:
+                entry['values'] = values
+            manifest['variables'][name] = entry
+
+    with open(os.path.join(tmp_dir, GRID_MANIFEST), 'wb') as f:
+        pickle.dump(manifest, f)
+
+    try:
+        os.replace(tmp_dir, grid_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)
+
+
+# Returns the model grid published in grid_dir, its arrays memory-mapped copy on write:
+# every process attached to it reads the same pages, and one changing an array gets its own copy
+def attach_model_grid(grid_dir):
+    with open(os.path.join(grid_dir, GRID_MANIFEST), 'rb') as f:
+        manifest = pickle.load(f)
+
+    data_vars, coords = {}, {}
+    for name, entry in manifest['variables'].items():
+        if 'file' in entry:
+            values = np.load(os.path.join(grid_dir, entry['file']), mmap_mode='c')
+        else:
+            values = entry['values']
+        variable = xr.Variable(entry['dims'], values, entry['attrs'])
+        if entry['coord']:
+            coords[name] = variable
+        else:
+            data_vars[name] = variable
+
+    return xr.Dataset(data_vars, coords=coords, attrs=manifest['attrs'])
+
+
+# Returns the model grid at grid_path, loaded once per process
+# Keyed on the grid's checksum, so a grid file replaced under the same path is read again
+# With shared_dir, the grid is published there once, under its checksum, and every process
+# maps that copy instead of holding its own
+def load_model_grid(grid_path, grid_checksum='', shared_dir=None):
+    def load():
+        if shared_dir:
+            grid_key = grid_checksum or hashlib.md5(grid_path.encode('utf-8')).hexdigest()
+            grid_dir = os.path.join(shared_dir, grid_key)
+            if not os.path.isfile(os.path.join(grid_dir, GRID_MANIFEST)):
+                if not os.path.exists(shared_dir):
+                    os.makedirs(shared_dir, exist_ok=True)
+                publish_model_grid(grid_path, grid_dir)
+            return attach_model_grid(grid_dir)
+
+        with xr.open_dataset(grid_path) as model_grid:
+            return model_grid.reset_coords().load()
+
+    return model_grids.get((grid_checksum, grid_path, shared_dir), load)
+
+
+# Returns the factors at factors_path, loaded once per process
+# Keyed on the model grid's checksum and the factors' version as well as their path, so
+# factors remade for a new grid or transformation version are loaded again
+def load_factors(factors_path, factors_version=None, grid_checksum=''):
+    return factors.get((grid_checksum, factors_version, factors_path),
+                       lambda: factor_store.load_factors(factors_path))
@@ -6,12 +6,18 @@ import pickle
 import hashlib
 import logging
 import requests
+import netCDF4
 import numpy as np
 import xarray as xr
 import pyresample as pr
 from pathlib import Path
 from datetime import datetime
 
+import remapping
+import grid_cache
+import factor_store
+import factor_builder
+
 np.warnings.filterwarnings('ignore')
 
 # Creates checksum from filename
@@ -52,6 +58,86 @@ def solr_update(config, solr_host, update_body, r=False):
         requests.post(url, json=update_body)
 
 
+# Returns the header summary the harvester recorded for a granule, or None if there isn't one
+# The summary holds the granule's dimension sizes, time range, and each field's shape, type,
+# fill value and valid range, read from its header at harvest time
+def granule_header_summary(harvested_metadata):
+    try:
+        return json.loads(harvested_metadata['header_summary_s'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Returns the variables in a granule's header that transforming field_names doesn't need
+# Kept are the fields, coordinate variables, what the kept variables name in their coordinates
+# and bounds attributes, time and bounds variables, and anything 1-D or smaller; only other
+# gridded variables are left out
+def unused_variables(source_file_path, field_names):
+    with netCDF4.Dataset(source_file_path, 'r') as nc:
+        variables = nc.variables
+
+        keep = set()
+        for name, variable in variables.items():
+            if name in field_names or name in nc.dimensions or variable.ndim <= 1 or \
+                    any(word in name.lower() for word in ['time', 'bnds', 'bounds']):
+                keep.add(name)
+
+        referenced = list(keep)
+        while referenced:
+            variable = variables[referenced.pop()]
+            for attr in ['coordinates', 'bounds']:
+                if attr in variable.ncattrs():
+                    for name in str(variable.getncattr(attr)).split():
+                        if name in variables and name not in keep:
+                            keep.add(name)
+                            referenced.append(name)
+
+        return [name for name in variables if name not in keep]
+
+
+# Opens a granule for transforming field_names, without the variables they don't need unless
+# selective is off. The variables kept are read lazily, each when it's first used
+# Falls back to opening every variable if the granule's header can't be read
+def open_granule(source_file_path, field_names, selective=True):
+    drop_variables = None
+    if selective:
+        try:
+            drop_variables = unused_variables(source_file_path, field_names) or None
+        except Exception as e:
+            print(f'Unable to read the variables of {source_file_path}, opening all of them: {e}')
+
+    return xr.open_dataset(source_file_path, decode_times=True, drop_variables=drop_variables)
+
+
+# Pre-transformations may use any variable, so granules are only opened selectively without them
+def selective_open(config):
+    return config.get('selective_open', True) and not config['pre_transformation_steps']
+
+
+# Returns the names of every field in remaining_transformations
+def transformation_field_names(remaining_transformations):
+    return sorted({field['name_s'] for fields in remaining_transformations.values() for field in fields})
+
+
+# Estimates the bytes of source data the remaining transformations of a granule will read,
+# from its header summary. Each field is read once however many grids it is transformed to
+# Returns None if the summary is missing or doesn't cover every field
+def transformation_size(header_summary, remaining_transformations):
+    if not header_summary:
+        return None
+
+    field_names = set([field['name_s'] for fields in remaining_transformations.values()
+                       for field in fields])
+
+    size = 0
+    for field_name in field_names:
+        if field_name not in header_summary['variables']:
+            return None
+        variable = header_summary['variables'][field_name]
+        size += int(np.prod(variable['shape'])) * np.dtype(variable['dtype']).itemsize
+    return size
+
+
 # Calls run_locally and catches any errors
 def run_locally_wrapper(source_file_path, remaining_transformations, output_dir, config_path=''):
     # try:
@@ -86,6 +172,8 @@ def run_locally(source_file_path, remaining_transformations, output_dir, config_
     # =====================================================
     # Set configuration options
     # =====================================================
+    grid_cache.set_cache_size(config.get('grid_cache_size', grid_cache.DEFAULT_CACHE_SIZE))
+
     file_name = source_file_path.split('/')[-1]
     dataset_name = config['ds_name']
     transformation_version = config['version']
@@ -101,6 +189,7 @@ def run_locally(source_file_path, remaining_transformations, output_dir, config_
     harvested_metadata = solr_query(config, solr_host, query_fq)[0]
     origin_checksum = harvested_metadata['checksum_s']
     date = harvested_metadata['date_s']
+    header_summary = granule_header_summary(harvested_metadata)
 
     # If data is stored in hemispheres, use that hemisphere when naming files and updating Solr
     # Otherwise, leave it blank
@@ -119,7 +208,8 @@ def run_locally(source_file_path, remaining_transformations, output_dir, config_
     # Load file to transform
     # =====================================================
     print(f'====== Loading {file_name} data =======')
-    ds = xr.open_dataset(source_file_path, decode_times=True)
+    ds = open_granule(source_file_path, transformation_field_names(remaining_transformations),
+                      selective=selective_open(config))
     ds.attrs['original_file_name'] = file_name
 
     # Iterate through grids in remaining_transformations
@@ -133,12 +223,14 @@ def run_locally(source_file_path, remaining_transformations, output_dir, config_
         grid_path = grid_metadata['grid_path_s']
         grid_type = grid_metadata['grid_type_s']
         grid_dir = grid_path.rsplit('/', 2)[0] + '/'
+        grid_checksum = grid_metadata.get('grid_checksum_s', '')
 
         # =====================================================
         # Load grid
         # =====================================================
         print(f'======Loading {grid_name} model grid=======')
-        model_grid = xr.open_dataset(grid_path).reset_coords()
+        shared_dir = f'{output_dir}model_grids/' if config.get('share_model_grids', True) else None
+        model_grid = grid_cache.load_model_grid(grid_path, grid_checksum, shared_dir)
 
         # =====================================================
         # Make model grid factors if not present locally
@@ -148,113 +240,27 @@ def run_locally(source_file_path, remaining_transformations, output_dir, config_
 
         # check to see if there is 'grid_factors_version' key in the
         # dataset and whether the transformation version matches with the
-        # current version
+        # current version, and that the factors weren't made for another factors_version
         if grid_factors_version in dataset_metadata.keys() and \
-            transformation_version == dataset_metadata[grid_factors_version]:
+            transformation_version == dataset_metadata[grid_factors_version] and \
+                not factors_outdated(config, dataset_metadata[grid_factors]):
 
             factors_path = dataset_metadata[grid_factors]
 
             print(f'===Loading {grid_name} factors===')
-            with open(factors_path, "rb") as f:
-                factors = pickle.load(f)
+            factors = grid_cache.load_factors(
+                factors_path, transformation_version, grid_checksum)
 
         else:
             print(f'===Creating {grid_name} factors===')
 
-            fq = [f'dataset_s:{dataset_name}', 'type_s:dataset']
-            short_name = dataset_metadata['short_name_s']
-
-            data_res = config['data_res']
-
-            # If data_res is fractional, convert from string to float
-            if type(data_res) is str and '/' in data_res:
-                num, den = data_res.replace(' ', '').split('/')
-                data_res = float(num) / float(den)
-
-            # Use hemisphere specific variables if data is hemisphere specific
-            if hemi:
-                hemi_dim = config[f'dims{hemi}']
-                hemi_area_extent = config[f'area_extent{hemi}']
-                hemi_proj_info = config[f'proj_info{hemi}']
-                hemi_data_max_lat = config[f'data_max_lat{hemi}']
-
-                source_grid_min_L, source_grid_max_L, source_grid, \
-                    data_grid_lons, data_grid_lats = ea.generalized_grid_product(short_name,
-                                                                                 data_res,
-                                                                                 hemi_data_max_lat,
-                                                                                 hemi_area_extent,
-                                                                                 hemi_dim,
-                                                                                 hemi_proj_info)
-            else:
-                source_grid_min_L, source_grid_max_L, source_grid, \
-                    data_grid_lons, data_grid_lats = ea.generalized_grid_product(short_name,
-                                                                                 data_res,
-                                                                                 config['data_max_lat'],
-                                                                                 config['area_extent'],
-                                                                                 config['dims'],
-                                                                                 config['proj_info'])
-
-            # Define the 'swath' as the lats/lon pairs of the model grid
-            target_grid = pr.geometry.SwathDefinition(lons=model_grid.XC.values.ravel(),
-                                                      lats=model_grid.YC.values.ravel())
-
-            # Retrieve target_grid_radius from model_grid file
-            if 'effective_grid_radius' in model_grid:
-                target_grid_radius = model_grid.effective_grid_radius.values.ravel()
-            elif 'effective_radius' in model_grid:
-                target_grid_radius = model_grid.effective_radius.values.ravel()
-            elif 'rA' in model_grid:
-                target_grid_radius = 0.5*np.sqrt(model_grid.rA.values.ravel())
-            else:
-                print(f'{grid_name} grid not supported')
-
-            # Compute the mapping between the data and model grid
-            source_indices_within_target_radius_i,\
-                num_source_indices_within_target_radius_i,\
-                nearest_source_index_to_target_index_i = \
-                ea.find_mappings_from_source_to_target(source_grid,
-                                                       target_grid,
-                                                       target_grid_radius,
-                                                       source_grid_min_L,
-                                                       source_grid_max_L)
-
-            factors = (source_indices_within_target_radius_i,
-                       num_source_indices_within_target_radius_i,
-                       nearest_source_index_to_target_index_i)
-
-            print(f'===Saving {grid_name} factors===')
-            factors_path = f'{output_dir}{dataset_name}/transformed_products/{grid_name}/'
-
-            # Create directory if needed and save factors
-            if not os.path.exists(factors_path):
-                os.makedirs(factors_path)
-
-            factors_path += f'{grid_name}{hemi}_factors'
-
-            with open(factors_path, 'wb') as f:
-                pickle.dump(factors, f)
+            factors_path = make_factors(config, hemi, dataset_metadata['short_name_s'], model_grid, grid_name,
+                                        grid_checksum or grid_path, output_dir, ea)
+            factors = grid_cache.load_factors(
+                factors_path, transformation_version, grid_checksum)
 
             print('===Updating Solr with factors===')
-            # Query Solr for dataset entry
-            query_fq = [f'dataset_s:{dataset_name}', 'type_s:dataset']
-            doc_id = solr_query(config, solr_host, query_fq)[0]['id']
-
-            # Update Solr dataset entry with factors metadata
-            update_body = [
-                {
-                    "id": doc_id,
-                    f'{grid_factors}': {"set": factors_path},
-                    f'{grid_name}{hemi}_factors_stored_dt': {"set": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")},
-                    f'{grid_factors_version}': {"set": transformation_version}
-                }
-            ]
-
-            r = solr_update(config, solr_host, update_body, r=True)
-
-            if r.status_code == 200:
-                print('Successfully updated Solr with factors information')
-            else:
-                print('Failed to update Solr with factors information')
+            register_factors(config, grid_name, hemi, factors_path)
 
         update_body = []
 
@@ -307,7 +313,8 @@ def run_locally(source_file_path, remaining_transformations, output_dir, config_
         # Returns list of transformed DAs, one for each field in fields
 
         field_DAs = run_in_any_env(
-            model_grid, grid_name, grid_type, fields, factors, ds, date, dataset_metadata, config)
+            model_grid, grid_name, grid_type, fields, factors, ds, date, dataset_metadata, config,
+            header_summary=header_summary)
 
         # =====================================================
         # Save the output in netCDF format
@@ -399,6 +406,128 @@ def run_locally(source_file_path, remaining_transformations, output_dir, config_
     return grids_updated, date[:4]
 
 
+# Returns the source grid parameters in config, hemi's if the data is stored by hemisphere
+def source_grid_parameters(config, hemi=''):
+    data_res = config['data_res']
+
+    # If data_res is fractional, convert from string to float
+    if type(data_res) is str and '/' in data_res:
+        num, den = data_res.replace(' ', '').split('/')
+        data_res = float(num) / float(den)
+
+    return {'data_res': data_res,
+            'data_max_lat': config[f'data_max_lat{hemi}'],
+            'area_extent': config[f'area_extent{hemi}'],
+            'dims': config[f'dims{hemi}'],
+            'proj_info': config[f'proj_info{hemi}']}
+
+
+# Returns the model grid variable the radius of each model grid point is taken from
+def target_grid_radius_method(model_grid, grid_name):
+    for radius_method in ['effective_grid_radius', 'effective_radius', 'rA']:
+        if radius_method in model_grid:
+            return radius_method
+    raise ValueError(f'{grid_name} grid not supported')
+
+
+# Returns the path factors mapping the source grid described by params to a model grid are kept at
+# Factors are kept in a directory shared by every dataset (factors_cache_dir, by default
+# {output_dir}grid_factors/), named by a hash of the source grid parameters, the model grid's
+# checksum, how its radii are found and the config's factors_version, so datasets on the same
+# source grid share them until factors_version is bumped
+def factors_store_path(config, grid_name, params, grid_checksum, radius_method, output_dir):
+    factors_dir = config.get('factors_cache_dir') or f'{output_dir}grid_factors/'
+    factors_key = factor_store.source_grid_key(params, grid_checksum, radius_method,
+                                               config.get('factors_version', 1))
+    return f'{factors_dir}{grid_name}_{factors_key}'
+
+
+# Whether factors_path is a factor store made for another factors_version than the config's
+def factors_outdated(config, factors_path):
+    return factor_store.is_factor_store(factors_path) and \
+        not factor_store.store_current(factors_path, config.get('factors_version', 1))
+
+
+# Returns the path of the factors mapping the dataset's source grid (hemi's if the data is stored
+# by hemisphere) to model_grid, making them if they haven't been yet
+def make_factors(config, hemi, short_name, model_grid, grid_name, grid_checksum, output_dir, ea):
+    params = source_grid_parameters(config, hemi)
+    radius_method = target_grid_radius_method(model_grid, grid_name)
+    factors_path = factors_store_path(config, grid_name, params, grid_checksum, radius_method, output_dir)
+
+    # A store from another format or factors_version is made again
+    if factor_store.store_current(factors_path, config.get('factors_version', 1)):
+        print(f'===Using {grid_name} factors made for the same source grid===')
+        return factors_path
+
+    source_grid_min_L, source_grid_max_L, source_grid, \
+        data_grid_lons, data_grid_lats = ea.generalized_grid_product(short_name,
+                                                                     params['data_res'],
+                                                                     params['data_max_lat'],
+                                                                     params['area_extent'],
+                                                                     params['dims'],
+                                                                     params['proj_info'])
+
+    # Retrieve target_grid_radius from model_grid file
+    if radius_method == 'rA':
+        target_grid_radius = 0.5*np.sqrt(model_grid.rA.values.ravel())
+    else:
+        target_grid_radius = model_grid[radius_method].values.ravel()
+
+    # Compute the mapping between the data and model grid
+    # The lats/lon pairs of the model grid are mapped in chunks, across processes if configured
+    factors = factor_builder.build_factors(source_grid,
+                                           model_grid.XC.values.ravel(),
+                                           model_grid.YC.values.ravel(),
+                                           target_grid_radius,
+                                           source_grid_min_L,
+                                           source_grid_max_L,
+                                           chunk_size=config.get(
+                                               'factors_chunk_size', factor_builder.DEFAULT_CHUNK_SIZE),
+                                           workers=config.get('factors_workers', 1))
+
+    print(f'===Saving {grid_name} factors===')
+    os.makedirs(os.path.dirname(factors_path), exist_ok=True)
+
+    factor_store.save_factors(factors_path, factors,
+                              grid_name=grid_name,
+                              grid_checksum=grid_checksum,
+                              radius_method=radius_method,
+                              factors_version=config.get('factors_version', 1),
+                              source_grid=params,
+                              made_for=config['ds_name'])
+    return factors_path
+
+
+# Records factors_path as the dataset's factors for grid_name (and hemi) in its Solr entry,
+# made for the config's transformation version
+def register_factors(config, grid_name, hemi, factors_path):
+    dataset_name = config['ds_name']
+    solr_host = config['solr_host_local']
+
+    # Query Solr for dataset entry
+    query_fq = [f'dataset_s:{dataset_name}', 'type_s:dataset']
+    doc_id = solr_query(config, solr_host, query_fq)[0]['id']
+
+    # Update Solr dataset entry with factors metadata
+    update_body = [
+        {
+            "id": doc_id,
+            f'{grid_name}{hemi}_factors_path_s': {"set": factors_path},
+            f'{grid_name}{hemi}_factors_stored_dt': {"set": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")},
+            f'{grid_name}{hemi}_factors_version_f': {"set": config['version']}
+        }
+    ]
+
+    r = solr_update(config, solr_host, update_body, r=True)
+
+    if r.status_code == 200:
+        print('Successfully updated Solr with factors information')
+    else:
+        print('Failed to update Solr with factors information')
+    return r.status_code == 200
+
+
 def run_using_aws_wrapper(s3, filename):
     try:
         run_using_aws(s3, filename)
@@ -439,6 +568,7 @@ def run_using_aws(s3, filename):
     source_file_path = harvested_metadata['pre_transformation_file_path_s']
     origin_checksum = harvested_metadata['checksum_s']
     date = harvested_metadata['date_s']
+    header_summary = granule_header_summary(harvested_metadata)
 
     if 'hemisphere_s' in harvested_metadata.keys():
         hemi = f'_{harvested_metadata["hemisphere_s"]}'
@@ -651,7 +781,8 @@ def run_using_aws(s3, filename):
     # Transform/remap data to grid
     # =====================================================
     field_DAs = run_in_any_env(
-        model_grid, grid_name, grid_type, fields, factors, ds, date, dataset_metadata, config)
+        model_grid, grid_name, grid_type, fields, factors, ds, date, dataset_metadata, config,
+        header_summary=header_summary)
 
     # =====================================================
     # ### Save the output in the model grid format
@@ -751,7 +882,77 @@ def run_using_aws(s3, filename):
             f'Failed to update Solr with descendants information for {dataset_name} on {date}')
 
 
-def run_in_any_env(model_grid, model_grid_name, model_grid_type, fields, factors, ds, record_date, dataset_metadata, config):
+# Notes generalized_transform_to_model_grid_solr gives a record whose field had no finite values
+EMPTY_RECORD_NOTES = ' -- empty record -- '
+
+
+# A field's values from ds, read as generalized_transform_to_model_grid_solr reads them
+def source_field_values(ds, field_name, extra_information):
+    if 'transpose' in extra_information:
+        return ds[field_name].values[0, :].T
+    return ds[field_name].values
+
+
+# Remaps the fields of a granule with operator, all fields of one size in one sparse mat-mat
+# product with a column per field
+# Returns the remapped values by field name shaped like target_grid_shape, or None for fields
+# without finite values. Fields that can't be read or remapped are left out, for ecco_cloud_utils
+def remap_fields(operator, ds, field_names, extra_information, target_grid_shape, logger):
+    sources = {}
+    for field_name in field_names:
+        try:
+            sources[field_name] = np.asarray(source_field_values(ds, field_name, extra_information),
+                                             dtype=np.float64).ravel()
+        except Exception:
+            continue
+
+    by_size = {}
+    for field_name, source in sources.items():
+        by_size.setdefault(source.size, []).append(field_name)
+
+    remapped_fields = {}
+    for names in by_size.values():
+        try:
+            remapped = operator.apply(np.column_stack([sources[name] for name in names]))
+        except Exception as e:
+            logger.error(f'Unable to remap {", ".join(names)} with the sparse operator: {e}')
+            continue
+
+        for i, name in enumerate(names):
+            if np.isfinite(sources[name]).any():
+                remapped_fields[name] = remapped[:, i].reshape(target_grid_shape)
+            else:
+                remapped_fields[name] = None
+    return remapped_fields
+
+
+# generalized_transform_to_model_grid_solr for a field already remapped by remap_fields
+# ecco_cloud_utils is handed the granule with that field all NaN, so it only builds the record
+# (its coordinates, times and attributes), and the remapped values are copied in where finite
+def sparse_transform_to_model_grid(ea, remapped, data_field_info, record_date, model_grid, model_grid_type,
+                                   array_precision, record_file_name, original_dataset_metadata, extra_information,
+                                   ds, factors, time_zone_included_with_time, model_grid_name):
+    field_name = data_field_info['name_s']
+    empty_ds = ds.assign({field_name: xr.full_like(ds[field_name], np.nan, dtype=np.float64)})
+    field_DA = ea.generalized_transform_to_model_grid_solr(data_field_info, record_date, model_grid, model_grid_type,
+                                                           array_precision, record_file_name, original_dataset_metadata,
+                                                           extra_information, empty_ds, factors,
+                                                           time_zone_included_with_time, model_grid_name)
+
+    if remapped is not None:
+        remapped = remapped.reshape(field_DA.shape)
+        np.copyto(field_DA.values, remapped, where=np.isfinite(remapped))
+
+        notes = field_DA.attrs.get('notes')
+        if isinstance(notes, str) and EMPTY_RECORD_NOTES in notes:
+            field_DA.attrs['notes'] = notes.replace(EMPTY_RECORD_NOTES, '')
+
+    return field_DA
+
+
+# header_summary is the granule's header summary from harvest, if there is one
+def run_in_any_env(model_grid, model_grid_name, model_grid_type, fields, factors, ds, record_date, dataset_metadata, config,
+                   header_summary=None):
     # =====================================================
     # Code to import ecco utils locally...
     # =====================================================
@@ -793,14 +994,50 @@ def run_in_any_env(model_grid, model_grid_name, model_grid_type, fields, factors
                 # print(f'Pre-transformation {func_to_run} failed.')
                 return []
 
+    # Fields the harvester found missing from the granule can only give empty records
+    # Pre-transformations may add fields, so the summary is only trusted without them
+    missing_fields = []
+    if header_summary and not pre_transformations:
+        missing_fields = [field['name_s'] for field in fields
+                          if field['name_s'] not in header_summary['variables']]
+
+    # Remap with one sparse operator built from the factors instead of a loop over model grid points
+    # Factors that can't build one are left to ecco_cloud_utils
+    operator = None
+    if config.get('sparse_remapping', True) and remapping.remappable(factors):
+        try:
+            operator = remapping.operator_for(factors)
+        except Exception as e:
+            logger.error(f'Unable to build sparse remapping operator, remapping point by point: {e}')
+
+    remapped_fields = {}
+    if operator is not None:
+        remapped_fields = remap_fields(operator, ds, [field['name_s'] for field in fields
+                                                      if field['name_s'] not in missing_fields],
+                                       extra_information, model_grid.XC.shape, logger)
+
     # fields is a list of dictionaries
     for data_field_info in fields:
+        if data_field_info['name_s'] in missing_fields:
+            logger.error(
+                f'{data_field_info["name_s"]} not in {record_file_name}')
+            field_DA = ea.make_empty_record(data_field_info['standard_name_s'], data_field_info['long_name_s'], data_field_info['units_s'],
+                                            record_date, model_grid, model_grid_type, array_precision)
+            field_DAs.append((field_DA, False))
+            continue
 
         try:
-            field_DA = ea.generalized_transform_to_model_grid_solr(data_field_info, record_date, model_grid, model_grid_type,
-                                                                   array_precision, record_file_name, original_dataset_metadata,
-                                                                   extra_information, ds, factors, time_zone_included_with_time,
-                                                                   model_grid_name)
+            if data_field_info['name_s'] in remapped_fields:
+                remapped = remapped_fields[data_field_info['name_s']]
+                field_DA = sparse_transform_to_model_grid(ea, remapped, data_field_info, record_date, model_grid, model_grid_type,
+                                                          array_precision, record_file_name, original_dataset_metadata,
+                                                          extra_information, ds, factors, time_zone_included_with_time,
+                                                          model_grid_name)
+            else:
+                field_DA = ea.generalized_transform_to_model_grid_solr(data_field_info, record_date, model_grid, model_grid_type,
+                                                                       array_precision, record_file_name, original_dataset_metadata,
+                                                                       extra_information, ds, factors, time_zone_included_with_time,
+                                                                       model_grid_name)
             success = True
 
             if post_transformations:
@@ -1,13 +1,18 @@
 import os
 import sys
 import yaml
+import logging
+import argparse
 import requests
 import importlib
 import itertools
+import multiprocessing
 import numpy as np
 import xarray as xr
 from pathlib import Path
 from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 # Determines grid/field combinations that have yet to be transformed for a given granule
@@ -103,7 +108,122 @@ def get_remaining_transformations(config, granule_file_path, grid_transformation
     return dict(grid_field_dict)
 
 
-def main(config_path='', output_path=''):
+# Runs the remaining transformations of each granule in planned, a list of
+# (source_file_path, remaining_transformations). Returns each granule's (grids_updated, year)
+# With logger, a granule that fails is logged and skipped instead of ending the run
+def transform_granules(planned, output_path, config_path, logger=None):
+    import grid_transformation
+
+    results = []
+    for f, remaining_transformations in planned:
+        try:
+            results.append(grid_transformation.run_locally_wrapper(
+                f, remaining_transformations, output_path, config_path=config_path))
+        except Exception as e:
+            if not logger:
+                raise
+            logger.error(f'Transformation failed for {f}: {e}')
+            print(f'Transformation failed for {f}: {e}')
+
+    return results
+
+
+# Makes and registers the factors of every grid and hemisphere the granules in planned need,
+# before any granule is transformed, so workers never stop to make the same factors at once
+# Factors already registered for the transformation version and current factors_version are kept.
+# Factors that can't be made are logged, and the granules needing them make them as they would alone
+def warm_planned_factors(planned, granule_hemispheres, config, output_path, logger):
+    import grid_cache
+    import factor_builder
+    import grid_transformation
+
+    solr_host = config['solr_host_local']
+    fq = [f'dataset_s:{config["ds_name"]}', 'type_s:dataset']
+    dataset_metadata = grid_transformation.solr_query(config, solr_host, fq)[0]
+
+    needed = set()
+    for f, remaining_transformations in planned:
+        hemi = f'_{granule_hemispheres[f]}' if granule_hemispheres[f] else ''
+        needed.update((grid_name, hemi) for grid_name in remaining_transformations)
+
+    ea = None
+    for grid_name, hemi in sorted(needed):
+        factors_path = dataset_metadata.get(f'{grid_name}{hemi}_factors_path_s')
+        if factors_path and dataset_metadata.get(f'{grid_name}{hemi}_factors_version_f') == config['version'] \
+                and not grid_transformation.factors_outdated(config, factors_path):
+            continue
+
+        try:
+            ea = ea or factor_builder.import_ecco_cloud_utils()
+
+            fq = ['type_s:grid', f'grid_name_s:{grid_name}']
+            grid_metadata = grid_transformation.solr_query(config, solr_host, fq)[0]
+            grid_path = grid_metadata['grid_path_s']
+            grid_checksum = grid_metadata.get('grid_checksum_s', '')
+
+            shared_dir = f'{output_path}model_grids/' if config.get('share_model_grids', True) else None
+            model_grid = grid_cache.load_model_grid(grid_path, grid_checksum, shared_dir)
+
+            print(f'===Creating {grid_name}{hemi} factors before transforming===')
+            factors_path = grid_transformation.make_factors(config, hemi, dataset_metadata['short_name_s'], model_grid,
+                                                            grid_name, grid_checksum or grid_path, output_path, ea)
+            grid_transformation.register_factors(config, grid_name, hemi, factors_path)
+        except Exception as e:
+            logger.error(f'Unable to make {grid_name}{hemi} factors: {e}')
+            print(f'Unable to make {grid_name}{hemi} factors: {e}')
+
+
+# Sends a transformation worker's pipeline log records back to the main process through
+# log_queue, and writes what the worker prints to its own log file in log_dir
+def init_transformation_worker(log_queue, log_dir):
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+    logger = logging.getLogger('pipeline')
+    logger.handlers = [QueueHandler(log_queue)]
+    logger.setLevel(logging.DEBUG)
+
+    sys.stdout = open(f'{log_dir}worker_{os.getpid()}.log', 'a', buffering=1)
+
+
+# Transforms each granule in planned in a pool of worker processes
+# Only the main process combines the results, returned as each granule's (grids_updated, year)
+# Workers' log records go through the pipeline logger's handlers in the main process, and what
+# each worker prints goes to {output_path}{dataset_name}/transformation_logs/worker_{pid}.log
+def transform_granules_concurrently(planned, output_path, config_path, dataset_name, workers):
+    logger = logging.getLogger(f'pipeline.{dataset_name}.transformation')
+
+    log_dir = f'{output_path}{dataset_name}/transformation_logs/'
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(
+        log_queue, *logging.getLogger('pipeline').handlers, respect_handler_level=True)
+    listener.start()
+
+    print(f'Transforming {len(planned)} granules across {workers} processes')
+
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_transformation_worker,
+                                 initargs=(log_queue, log_dir)) as executor:
+            futures = {executor.submit(transform_granules, [granule], output_path, config_path, logger): granule[0]
+                       for granule in planned}
+
+            for future in as_completed(futures):
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    logger.error(f'Transformation failed for {futures[future]}: {e}')
+                    print(f'Transformation failed for {futures[future]}: {e}')
+    finally:
+        listener.stop()
+
+    return results
+
+
+# workers overrides the config's transformation_workers
+def main(config_path='', output_path='', workers=None):
     import grid_transformation
     grid_transformation = importlib.reload(grid_transformation)
 
@@ -128,7 +248,13 @@ def main(config_path='', output_path=''):
 
     years_updated = {}
 
-    # For each harvested granule get remaining transformations and perform transformation
+    # Plan the work from the harvested docs before opening any granule
+    # The header summaries recorded at harvest time size each granule's transformations
+    planned_transformations = []
+    granule_hemispheres = {}
+    planned_bytes = 0
+    unsized_granules = 0
+
     for granule in harvested_granules:
         # f is file path to granule from solr
         f = granule.get('pre_transformation_file_path_s', '')
@@ -138,24 +264,53 @@ def main(config_path='', output_path=''):
             print("ERROR - pre transformation path doesn't exist")
             continue
 
+        # Skips granules that failed validation after download
+        if granule.get('harvest_success_b') is False:
+            print(f'ERROR - {granule.get("message_s", "harvest unsuccessful")}: {f}')
+            continue
+
         # Get transformations to be completed for this file
         remaining_transformations = get_remaining_transformations(
             config, f, grid_transformation)
 
-        # Perform remaining transformations
         if remaining_transformations:
-            grids_updated, year = grid_transformation.run_locally_wrapper(
-                f, remaining_transformations, output_path, config_path=config_path)
-
-            for grid in grids_updated:
-                if grid in years_updated.keys():
-                    if year not in years_updated[grid]:
-                        years_updated[grid].append(year)
-                else:
-                    years_updated[grid] = [year]
+            planned_transformations.append((f, remaining_transformations))
+            granule_hemispheres[f] = granule.get('hemisphere_s', '')
+
+            size = grid_transformation.transformation_size(
+                grid_transformation.granule_header_summary(granule), remaining_transformations)
+            if size is None:
+                unsized_granules += 1
+            else:
+                planned_bytes += size
         else:
             print(f'No new transformations for {granule["date_s"]}')
 
+    print(f'{len(planned_transformations)} granules to transform, reading {planned_bytes / 1e6:.1f} MB of source fields'
+          + (f' ({unsized_granules} granules without a header summary)' if unsized_granules else ''))
+
+    # Perform remaining transformations
+    workers = workers or config.get('transformation_workers', 1)
+
+    # A granule that fails is logged and skipped, one after another as in the pool
+    logger = logging.getLogger(f'pipeline.{dataset_name}.transformation')
+
+    results = []
+    if workers > 1 and len(planned_transformations) > 1:
+        warm_planned_factors(planned_transformations, granule_hemispheres, config, output_path, logger)
+        results.extend(transform_granules_concurrently(
+            planned_transformations, output_path, config_path, dataset_name, workers))
+    else:
+        results.extend(transform_granules(planned_transformations, output_path, config_path, logger))
+
+    for grids_updated, year in results:
+        for grid in grids_updated:
+            if grid in years_updated.keys():
+                if year not in years_updated[grid]:
+                    years_updated[grid].append(year)
+            else:
+                years_updated[grid] = [year]
+
     # Query Solr for dataset metadata
     fq = [f'dataset_s:{dataset_name}', 'type_s:dataset']
     dataset_metadata = grid_transformation.solr_query(config, solr_host, fq)[0]
@@ -191,4 +346,14 @@ def main(config_path='', output_path=''):
 
 ##################################################
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description='Transform the harvested granules of a dataset to its model grids')
+    parser.add_argument('--config_path', default='',
+                        help="the dataset's transformation_config.yaml")
+    parser.add_argument('--output_path', default='',
+                        help='pipeline output directory')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes transforming granules (overrides transformation_workers)')
+    args = parser.parse_args()
+
+    main(config_path=args.config_path, output_path=args.output_path, workers=args.workers)
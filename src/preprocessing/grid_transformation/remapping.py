@@ -0,0 +1,199 @@
+import os
+import shutil
+import hashlib
+import warnings
+import numpy as np
+import scipy.sparse as sp
+from collections import OrderedDict
+
+import factor_store
+
+# Operators built from factor stores, kept so granules sharing factors don't rebuild them
+MAX_CACHED_OPERATORS = 4
+_operators = OrderedDict()
+
+# NaN masks whose counts each operator keeps
+MAX_CACHED_COUNTS = 8
+
+# Directory in a factor store holding the sparse weight matrix built from its factors
+OPERATOR_DIR = 'operator'
+WEIGHT_ARRAYS = ['data', 'indices', 'indptr']
+
+
+
+# Grid mapping factors as one sparse weight matrix from the source grid to the model grid
+# Row i holds a weight of one for each source index within target i's radius or, for targets
+# with none, for its nearest source index. Remapping a field is then two sparse mat-vecs:
+# the sum of a target's finite sources divided by how many of them are finite, which is
+# the nanmean ecco_cloud_utils.transform_to_target_grid takes target by target
+class RemapOperator:
+    # Built from factors, or around an already built weights matrix
+    def __init__(self, factors=None, weights=None):
+        self.weights = weights if weights is not None else self._weights(factors)
+        self.num_sources = self.weights.shape[1]
+
+        # Finite source counts per target, by the NaN mask they were counted for
+        self.counts = OrderedDict()
+
+    @staticmethod
+    def _weights(factors):
+        if isinstance(factors, factor_store.StoredFactors):
+            offsets, indices, nearest = factors.offsets, factors.indices, factors.nearest
+        else:
+            arrays = factor_store.factors_to_arrays(factors)
+            offsets, indices, nearest = arrays['offsets'], arrays['indices'], arrays['nearest']
+
+        counts = np.diff(offsets)
+        num_targets = len(counts)
+        use_nearest = (counts == 0) & (nearest >= 0)
+        row_counts = np.where(counts > 0, counts, use_nearest)
+
+        indptr = np.zeros(num_targets + 1, dtype=np.int64)
+        np.cumsum(row_counts, out=indptr[1:])
+
+        # Radius indices move from their stored rows to the matching rows of the matrix,
+        # then each nearest row gets its single index
+        columns = np.empty(indptr[-1], dtype=indices.dtype)
+        shift = np.repeat(indptr[:-1] - offsets[:-1], counts)
+        columns[np.arange(len(indices)) + shift] = indices
+        nearest_rows = np.nonzero(use_nearest)[0]
+        columns[indptr[nearest_rows]] = nearest[nearest_rows]
+
+        num_sources = int(columns.max()) + 1 if len(columns) else 0
+        return sp.csr_matrix((np.ones(len(columns), dtype=np.float64), columns, indptr),
+                             shape=(num_targets, num_sources))
+
+    # Remaps the columns of sources, each a raveled source field, in one sparse mat-mat product
+    # Returns an array of num_targets rows, NaN where a target has no finite sources
+    def apply(self, sources):
+        sources = np.asarray(sources, dtype=np.float64)[:self.num_sources]
+        columns = sources.reshape(len(sources), -1)
+        finite = np.isfinite(columns)
+
+        remapped = self._remap(np.where(finite, columns, 0), finite)
+        return remapped[:, 0] if sources.ndim == 1 else remapped
+
+    # values holds source fields as contiguous columns with their NaNs zeroed, finite where they
+    # weren't NaN. Fields sharing a NaN mask, like the land of a source grid, share one count
+    # column, which is kept for the fields of later granules
+    def _remap(self, values, finite):
+        counts = np.empty((self.weights.shape[0], values.shape[1]))
+        for i in range(finite.shape[1]):
+            mask = hashlib.sha1(np.packbits(finite[:, i])).digest()
+            if mask in self.counts:
+                self.counts.move_to_end(mask)
+            else:
+                self.counts[mask] = self.weights @ finite[:, i].astype(np.float64)
+                while len(self.counts) > MAX_CACHED_COUNTS:
+                    self.counts.popitem(last=False)
+            counts[:, i] = self.counts[mask]
+
+        totals = self.weights @ values
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return totals / counts
+
+    # Drop in for ecco_cloud_utils.transform_to_target_grid with the mean operation
+    def transform_to_target_grid(self, source_field, target_grid_shape):
+        return self.apply(np.asarray(source_field).ravel()).reshape(target_grid_shape)
+
+
+# Writes operator's weights into the factor store at store_dir, for processes using the same
+# factors to memory-map instead of building their own copy
+# Written beside their place and moved in, so a process never sees them half written
+def save_operator(operator, store_dir):
+    weights = operator.weights
+    operator_dir = os.path.join(store_dir, OPERATOR_DIR)
+    tmp_dir = f'{operator_dir}.tmp{os.getpid()}'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    # scipy only leaves index arrays uncopied when both have the same type
+    index_dtype = np.int32 if max(weights.nnz, weights.shape[1]) < 2 ** 31 else np.int64
+    arrays = {'data': weights.data,
+              'indices': weights.indices.astype(index_dtype),
+              'indptr': weights.indptr.astype(index_dtype)}
+    for name in WEIGHT_ARRAYS:
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), arrays[name])
+    np.save(os.path.join(tmp_dir, 'shape.npy'), np.array(weights.shape))
+
+    try:
+        os.replace(tmp_dir, operator_dir)
+    except OSError:
+        # Another process saved them first
+        shutil.rmtree(tmp_dir)
+
+
+# Returns the operator saved in the factor store at store_dir, with its weights memory-mapped,
+# or None if there isn't one
+def load_operator(store_dir):
+    operator_dir = os.path.join(store_dir, OPERATOR_DIR)
+    if not os.path.isdir(operator_dir):
+        return None
+
+    # Empty arrays can't be memory-mapped
+    arrays = {}
+    for name in WEIGHT_ARRAYS:
+        array_fp = os.path.join(operator_dir, f'{name}.npy')
+        arrays[name] = np.load(array_fp, mmap_mode='r' if os.path.getsize(array_fp) > 128 else None)
+    shape = tuple(np.load(os.path.join(operator_dir, 'shape.npy')))
+
+    weights = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+    return RemapOperator(weights=weights)
+
+
+# Whether factors can build an operator: a factor store, or the (source indices, source index
+# counts, nearest source indices) triple built in memory. Anything else, like the flat buffers
+# read from S3 when running on AWS, is remapped by ecco_cloud_utils point by point
+def remappable(factors):
+    if isinstance(factors, factor_store.StoredFactors):
+        return True
+    return isinstance(factors, (tuple, list)) and len(factors) == 3
+
+
+# Returns the operator for factors, reusing the one built for the same factor store
+# For a factor store the operator is built once and saved in it, so every process using the
+# store maps the same weights. Factors that aren't from a store get a new operator each time
+def operator_for(factors):
+    if not isinstance(factors, factor_store.StoredFactors):
+        return RemapOperator(factors)
+
+    key = (factors.store_dir, factors.manifest.get('created_dt'))
+    if key in _operators:
+        _operators.move_to_end(key)
+        return _operators[key]
+
+    operator = load_operator(factors.store_dir) if factors.store_dir else None
+    if operator is None:
+        operator = RemapOperator(factors)
+        if factors.store_dir:
+            try:
+                save_operator(operator, factors.store_dir)
+                operator = load_operator(factors.store_dir)
+            except OSError as e:
+                print(f'Unable to save the remapping operator in {factors.store_dir}: {e}')
+
+    _operators[key] = operator
+    while len(_operators) > MAX_CACHED_OPERATORS:
+        _operators.popitem(last=False)
+    return operator
+
+
+# Reference remap that walks the factors target by target, as ecco_cloud_utils does
+# Only used to check RemapOperator against
+def transform_to_target_grid_loop(factors, source_field, target_grid_shape):
+    source_indices, num_source_indices, nearest_source_index = factors
+    source_field_r = np.asarray(source_field, dtype=np.float64).ravel()
+
+    target_field = np.full(len(num_source_indices), np.nan)
+    with warnings.catch_warnings():
+        # nanmean warns about targets whose sources are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i in range(len(num_source_indices)):
+            if num_source_indices[i] > 0:
+                target_field[i] = np.nanmean(source_field_r[source_indices[i]])
+            elif nearest_source_index[i] >= 0:
+                target_field[i] = source_field_r[nearest_source_index[i]]
+    return target_field.reshape(target_grid_shape)
+
@@ -0,0 +1,154 @@
+import os
+import yaml
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import grid_cache
+import factor_store
+import factor_builder
+import grid_transformation
+
+# Makes the factors every dataset needs for every model grid ahead of any transformation, so
+# transformation runs never stop on their first granule to make them
+# Reads datasets/*/transformation_config.yaml and the grid entries in Solr, makes the factors
+# that are missing or whose store was made for another factors_version across worker processes,
+# and records them on the datasets' Solr entries. Datasets on the same source grid share factors,
+# so each set is only made once
+#
+# ex: python warm_factors.py --output_dir /ecco/output/ --workers 8
+#     python warm_factors.py --output_dir /ecco/output/ --datasets sla_MEaSUREs_JPL1812 --grids ECCO_llc90
+
+
+# Hemisphere suffixes of a dataset's source grids: _nh and _sh if its config describes
+# hemispheres separately, otherwise just ''
+def config_hemispheres(config):
+    hemis = [hemi for hemi in ['_nh', '_sh'] if f'dims{hemi}' in config]
+    return hemis or ['']
+
+
+# Checks whether a dataset's Solr entry records factors_path for grid_name and hemi, and the
+# store there holds factors made for the config's factors_version
+def factors_current(config, dataset_metadata, grid_name, hemi, factors_path):
+    return dataset_metadata.get(f'{grid_name}{hemi}_factors_path_s') == factors_path and \
+        factor_store.store_current(factors_path, config.get('factors_version', 1))
+
+
+# Makes one set of factors in a worker process
+# Each worker maps its factors on its own, rather than starting a pool of its own
+def warm(config, hemi, short_name, grid_metadata, output_dir):
+    ea = factor_builder.import_ecco_cloud_utils()
+
+    grid_path = grid_metadata['grid_path_s']
+    grid_checksum = grid_metadata.get('grid_checksum_s', '')
+    model_grid = grid_cache.load_model_grid(grid_path, grid_checksum)
+
+    return grid_transformation.make_factors(dict(config, factors_workers=1), hemi, short_name, model_grid,
+                                            grid_metadata['grid_name_s'], grid_checksum or grid_path,
+                                            output_dir, ea)
+
+
+# Returns the factors to make or register, as {factors path: [(config, hemi, short_name, grid_metadata)]}
+# Every dataset, grid and hemisphere needing the same factors shares a path
+def plan_factors(datasets_dir, output_dir, datasets=None, grids=None):
+    planned = {}
+
+    for ds in sorted(os.listdir(datasets_dir)):
+        config_path = os.path.join(datasets_dir, ds, 'transformation_config.yaml')
+        if (datasets and ds not in datasets) or not os.path.exists(config_path):
+            continue
+
+        with open(config_path, 'r') as stream:
+            config = yaml.load(stream, yaml.Loader)
+        solr_host = config['solr_host_local']
+
+        fq = [f'dataset_s:{config["ds_name"]}', 'type_s:dataset']
+        dataset_docs = grid_transformation.solr_query(config, solr_host, fq)
+        if not dataset_docs:
+            print(f'{ds} has no dataset entry in Solr yet, skipping')
+            continue
+        dataset_metadata = dataset_docs[0]
+
+        grid_docs = grid_transformation.solr_query(config, solr_host, ['type_s:grid'])
+
+        for grid_metadata in grid_docs:
+            grid_name = grid_metadata['grid_name_s']
+            if grids and grid_name not in grids:
+                continue
+
+            grid_path = grid_metadata['grid_path_s']
+            grid_checksum = grid_metadata.get('grid_checksum_s', '')
+            model_grid = grid_cache.load_model_grid(grid_path, grid_checksum)
+
+            for hemi in config_hemispheres(config):
+                try:
+                    params = grid_transformation.source_grid_parameters(config, hemi)
+                    radius_method = grid_transformation.target_grid_radius_method(model_grid, grid_name)
+                except (KeyError, ValueError) as e:
+                    print(f'Unable to plan {grid_name}{hemi} factors for {ds}: {e}')
+                    continue
+
+                factors_path = grid_transformation.factors_store_path(config, grid_name, params,
+                                                                      grid_checksum or grid_path,
+                                                                      radius_method, output_dir)
+                if factors_current(config, dataset_metadata, grid_name, hemi, factors_path):
+                    continue
+
+                planned.setdefault(factors_path, []).append(
+                    (config, hemi, dataset_metadata['short_name_s'], grid_metadata))
+
+    return planned
+
+
+def main(output_dir, datasets=None, grids=None, workers=None, datasets_dir=None):
+    datasets_dir = datasets_dir or str(Path(__file__).resolve().parents[3] / 'datasets')
+    output_dir = output_dir.rstrip('/') + '/'
+
+    planned = plan_factors(datasets_dir, output_dir, datasets, grids)
+    if not planned:
+        print('All factors are up to date')
+        return
+
+    num_uses = sum(len(uses) for uses in planned.values())
+    workers = workers or os.cpu_count()
+    print(f'Making {len(planned)} sets of factors for {num_uses} dataset grids across {workers} processes')
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for factors_path, uses in planned.items():
+            config, hemi, short_name, grid_metadata = uses[0]
+            futures[executor.submit(warm, config, hemi, short_name, grid_metadata, output_dir)] = factors_path
+
+        for future in as_completed(futures):
+            uses = planned[futures[future]]
+            try:
+                factors_path = future.result()
+            except Exception as e:
+                failed += len(uses)
+                for config, hemi, _, grid_metadata in uses:
+                    print(f'Unable to make {grid_metadata["grid_name_s"]}{hemi} factors for {config["ds_name"]}: {e}')
+                continue
+
+            for config, hemi, _, grid_metadata in uses:
+                print(f'{config["ds_name"]} {grid_metadata["grid_name_s"]}{hemi} factors: {factors_path}')
+                if not grid_transformation.register_factors(config, grid_metadata['grid_name_s'], hemi, factors_path):
+                    failed += 1
+
+    print(f'Factors ready for {num_uses - failed} of {num_uses} dataset grids')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Make the factors of every dataset and model grid ahead of transformation')
+    parser.add_argument('--output_dir', required=True,
+                        help='pipeline output directory, where shared factors are kept unless a config sets factors_cache_dir')
+    parser.add_argument('--datasets', nargs='*',
+                        help='only these datasets')
+    parser.add_argument('--grids', nargs='*',
+                        help='only these model grids')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes making factors (default: one per core)')
+    args = parser.parse_args()
+
+    main(args.output_dir, datasets=args.datasets, grids=args.grids, workers=args.workers)
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import argparse
+import importlib
+from pathlib import Path
+from datetime import timedelta
+
+import standin_servers
+
+# Drives each harvester end to end against the local stand-in servers and reports
+# granules/sec and MB/s for a fresh harvest of a configurable number of synthetic granules
+#
+# ex: python harvester_benchmark.py --granules 200 --latency 0.05 --bandwidth 20
+#     python harvester_benchmark.py --harvesters podaac nsidc_ftp --repeat 3
+
+path_to_harvesters = Path(__file__).resolve().parents[2] / 'harvesters'
+
+HARVESTERS = {
+    'podaac': (path_to_harvesters / 'podaac_harvester', 'podaac_harvester', 'podaac_harvester'),
+    'nsidc_ftp': (path_to_harvesters / 'nsidc_ftp_harvester', 'nsidc_ftp_harvester', 'nsidc_ftp_harvester'),
+    'osisaf_ftp': (path_to_harvesters / 'osisaf_ftp_harvester', 'osisaf_ftp_harvester', 'osisaf_ftp_harvester'),
+    'seaice': (path_to_harvesters / 'nsidc_ftp_harvester' / 'RDEFT4_ftp_harvester', 'seaice_harvester', 'seaice_harvester')
+}
+
+FIELDS = ['field_a', 'field_b']
+START = '2000-01-01'
+
+
+def base_config(ds_name, http_url):
+    return {
+        'ds_name': ds_name,
+        'date_regex': '%Y-%m-%dT%H:%M:%SZ',
+        'data_time_scale': 'daily',
+        'date_format': 'yyyymmdd',
+        'regex': r'\d{8}',
+        'fields': [{'name': f, 'long_name': f, 'standard_name': f, 'units': '1'} for f in FIELDS],
+        'original_dataset_title': ds_name,
+        'original_dataset_short_name': ds_name,
+        'original_dataset_url': '',
+        'original_dataset_reference': '',
+        'original_dataset_doi': '',
+        'solr_host_local': f'{http_url}/solr/',
+        'solr_host_aws': f'{http_url}/solr/',
+        'solr_collection_name': 'ecco_datasets',
+        'target_bucket_name': ''
+    }
+
+
+# Sets up the stand-in data for a harvester and returns its config
+def setup_harvester(name, args, http, ftp_root, ftp_port, granule_fp):
+    dates = standin_servers.daily_dates(START, args.granules)
+    start = dates[0].strftime('%Y%m%dT00:00:00Z')
+    end = dates[-1].strftime('%Y%m%dT00:00:00Z')
+    config = base_config(f'bench_{name}', http.url)
+
+    if name == 'podaac':
+        granules = [(f'{d.strftime("%Y%m%d")}-bench-L4-v01.nc', d, d + timedelta(days=1))
+                    for d in dates]
+        http.add_podaac_dataset('BENCH-PODAAC', granules)
+        config.update({'host': f'{http.url}/opensearch?format=atom', 'podaac_id': 'BENCH-PODAAC',
+                       'aggregated': False, 'start': start, 'end': end})
+
+    elif name == 'nsidc_ftp':
+        ddir = 'pub/DATASETS/BENCH_NSIDC/'
+        standin_servers.build_nsidc_tree(
+            ftp_root, granule_fp, ddir, ['north'], 'daily', dates)
+        config.update({'host': '127.0.0.1', 'port': ftp_port, 'user': 'anonymous', 'ddir': ddir,
+                       'regions': ['north'], 'start': start, 'end': end})
+
+    elif name == 'osisaf_ftp':
+        ddir = 'archive/ice/bench/'
+        standin_servers.build_osisaf_tree(
+            ftp_root, granule_fp, ddir, ['north'], 'ice_conc', dates)
+        config.update({'host': '127.0.0.1', 'port': ftp_port, 'user': 'anonymous', 'ddir': ddir,
+                       'regions': ['north'], 'filename_filter': 'ice_conc', 'start': start, 'end': end})
+
+    elif name == 'seaice':
+        # The RDEFT4 harvester takes one granule per month, named by the month's last day
+        month_ends = sorted(set([(d.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+                                 for d in standin_servers.daily_dates(START, args.granules * 31)]))
+        month_ends = month_ends[:args.granules]
+        http.add_cmr_collection(
+            'RDEFT4', [f'RDEFT4_{d.strftime("%Y%m%d")}.nc' for d in month_ends])
+        config.update({'solr_host': f'{http.url}/solr/', 'regions': [],
+                       'start': month_ends[0].strftime('%Y-%m-01T00:00:00Z'),
+                       'end': month_ends[-1].strftime('%Y-%m-%dT00:00:00Z')})
+
+    return config
+
+
+# Runs one harvest and measures it from the files it leaves in harvested_granules
+def run_harvester(name, config, work_dir, http_url):
+    code_dir, module_name, function_name = HARVESTERS[name]
+    output_path = f'{work_dir}/output_{name}/'
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+
+    config_path = f'{work_dir}/{name}_config.yaml'
+    with open(config_path, 'w') as f:
+        yaml.dump(config, f)
+
+    sys.path.insert(0, str(code_dir))
+    try:
+        module = importlib.import_module(module_name)
+        module = importlib.reload(module)
+
+        if name == 'seaice':
+            module.CMR_FILE_URL = f'{http_url}/cmr/search/granules.json?provider=NSIDC_ECS&scroll=true'
+
+        t0 = time.time()
+        getattr(module, function_name)(
+            config_path=config_path, output_path=output_path)
+        seconds = time.time() - t0
+    finally:
+        sys.path.remove(str(code_dir))
+
+    granules = 0
+    total_bytes = 0
+    for dirpath, _, filenames in os.walk(f'{output_path}{config["ds_name"]}/harvested_granules'):
+        for filename in filenames:
+            if filename.endswith('.nc'):
+                granules += 1
+                total_bytes += os.path.getsize(os.path.join(dirpath, filename))
+
+    return {
+        'harvester': name,
+        'granules': granules,
+        'bytes': total_bytes,
+        'seconds': round(seconds, 3),
+        'granules_per_second': round(granules / seconds, 2) if seconds else None,
+        'mb_per_second': round(total_bytes / 1e6 / seconds, 2) if seconds else None
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the harvesters against local stand-in servers')
+    parser.add_argument('--harvesters', nargs='+', default=list(HARVESTERS.keys()),
+                        choices=list(HARVESTERS.keys()))
+    parser.add_argument('--granules', type=int, default=50,
+                        help='granules served per dataset')
+    parser.add_argument('--shape', type=int, nargs=2, default=[180, 360],
+                        help='lat/lon size of the synthetic granules')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added before every server response')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='MB/s per transfer, 0 for unthrottled')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='harvests per harvester, each starting from scratch')
+    parser.add_argument('--work_dir', default='/tmp/harvester_benchmark')
+    parser.add_argument('--output', default='',
+                        help='optional path to write the results as JSON')
+    args = parser.parse_args()
+
+    if os.path.exists(args.work_dir):
+        shutil.rmtree(args.work_dir)
+    os.makedirs(args.work_dir)
+
+    granule_fp = standin_servers.make_granule(
+        f'{args.work_dir}/granule.nc', FIELDS, tuple(args.shape))
+    bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
+
+    ftp_root = f'{args.work_dir}/ftp_root'
+    os.makedirs(ftp_root)
+
+    http = standin_servers.StandinHTTPServer(
+        granule_fp, args.latency, bandwidth).start()
+    ftp = standin_servers.StandinFTPServer(
+        ftp_root, args.latency, bandwidth).start()
+
+    print(f'Serving {args.granules} granules of {os.path.getsize(granule_fp) / 1e6:.2f} MB '
+          f'(latency {args.latency} s, bandwidth {args.bandwidth or "unthrottled"} MB/s)')
+
+    results = []
+    try:
+        for name in args.harvesters:
+            config = setup_harvester(
+                name, args, http, ftp_root, ftp.port, granule_fp)
+            for _ in range(args.repeat):
+                http.solr.reset()
+                results.append(run_harvester(
+                    name, config, args.work_dir, http.url))
+    finally:
+        http.stop()
+        ftp.stop()
+
+    print(f'\n{"harvester":<12}{"granules":>10}{"seconds":>10}{"granules/s":>12}{"MB/s":>10}')
+    for r in results:
+        print(f'{r["harvester"]:<12}{r["granules"]:>10}{r["seconds"]:>10}'
+              f'{r["granules_per_second"]:>12}{r["mb_per_second"]:>10}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
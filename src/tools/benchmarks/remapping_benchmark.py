@@ -0,0 +1,109 @@
+import sys
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'preprocessing' / 'grid_transformation'))
+import remapping  # pylint: disable=import-error
+import factor_store  # pylint: disable=import-error
+
+# Compares remapping fields point by point, as ecco_cloud_utils does, against the sparse
+# remapping operator on synthetic factors, checking both give the same model grid fields
+# The synthetic factors map each target to the source points in a small window around a
+# random source point, with some targets left to their nearest neighbour only
+#
+# ex: python remapping_benchmark.py --source 720 1440 --targets 105300 --fields 5
+#     python remapping_benchmark.py --targets 500000 --skip_loop
+
+
+def synthetic_factors(source_shape, num_targets, max_window, nearest_only, seed=0):
+    rng = np.random.default_rng(seed)
+    ny, nx = source_shape
+
+    centres_y = rng.integers(0, ny, num_targets)
+    centres_x = rng.integers(0, nx, num_targets)
+    windows = rng.integers(1, max_window + 1, num_targets)
+    windows[rng.random(num_targets) < nearest_only] = 0
+
+    source_indices = []
+    for cy, cx, w in zip(centres_y, centres_x, windows):
+        if w:
+            ys = np.clip(np.arange(cy - w // 2, cy - w // 2 + w), 0, ny - 1)
+            xs = np.arange(cx - w // 2, cx - w // 2 + w) % nx
+            source_indices.append((ys[:, None] * nx + xs[None, :]).ravel())
+        else:
+            source_indices.append(-1)
+
+    counts = np.array([0 if np.isscalar(s) else len(s) for s in source_indices])
+    nearest = centres_y * nx + centres_x
+    return source_indices, counts, nearest
+
+
+# Fields share the land mask of their source grid
+def synthetic_field(source_shape, rng, land):
+    field = rng.standard_normal(source_shape).astype(np.float32)
+    field[land] = np.nan
+    return field
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark point by point against sparse remapping of fields to a model grid')
+    parser.add_argument('--source', type=int, nargs=2, default=[720, 1440],
+                        help='source grid shape (lat, lon)')
+    parser.add_argument('--targets', type=int, default=105300,
+                        help='model grid points (llc90 has 105300)')
+    parser.add_argument('--fields', type=int, default=5,
+                        help='fields remapped per run')
+    parser.add_argument('--max_window', type=int, default=4,
+                        help='largest side of the source window mapped to a target')
+    parser.add_argument('--nearest_only', type=float, default=0.1,
+                        help='fraction of targets with only a nearest neighbour')
+    parser.add_argument('--nan_fraction', type=float, default=0.3,
+                        help='fraction of NaN (land) source points')
+    parser.add_argument('--skip_loop', action='store_true',
+                        help="don't time or check against the point by point remap")
+    args = parser.parse_args()
+
+    source_shape = tuple(args.source)
+    target_shape = (args.targets,)
+    rng = np.random.default_rng(1)
+
+    t0 = time.time()
+    factors = synthetic_factors(source_shape, args.targets, args.max_window, args.nearest_only)
+    print(f'synthetic factors: {args.targets} targets in {time.time() - t0:.2f}s')
+
+    t0 = time.time()
+    stored = factor_store.factors_to_arrays(factors)
+    stored = factor_store.StoredFactors('', stored['offsets'], stored['indices'], stored['nearest'], {})
+    operator = remapping.RemapOperator(stored)
+    build_seconds = time.time() - t0
+    print(f'sparse operator: {operator.weights.nnz} weights, built in {build_seconds:.2f}s')
+
+    land = rng.random(source_shape) < args.nan_fraction
+    fields = [synthetic_field(source_shape, rng, land) for _ in range(args.fields)]
+
+    t0 = time.time()
+    sparse_results = [operator.transform_to_target_grid(f, target_shape) for f in fields]
+    sparse_seconds = time.time() - t0
+    print(f'sparse: {args.fields} fields in {sparse_seconds:.3f}s '
+          f'({sparse_seconds / args.fields * 1000:.1f} ms/field)')
+
+    if not args.skip_loop:
+        t0 = time.time()
+        loop_results = [remapping.transform_to_target_grid_loop(factors, f, target_shape) for f in fields]
+        loop_seconds = time.time() - t0
+        print(f'point by point: {args.fields} fields in {loop_seconds:.3f}s '
+              f'({loop_seconds / args.fields * 1000:.1f} ms/field)')
+        print(f'speedup: {loop_seconds / sparse_seconds:.1f}x '
+              f'({loop_seconds / (sparse_seconds + build_seconds):.1f}x including the operator build)')
+
+        for loop_result, sparse_result in zip(loop_results, sparse_results):
+            if not np.array_equal(np.isnan(loop_result), np.isnan(sparse_result)):
+                sys.exit('sparse and point by point remaps differ in which targets are NaN')
+            finite = np.isfinite(loop_result)
+            max_diff = np.max(np.abs(loop_result[finite] - sparse_result[finite]), initial=0)
+            if max_diff > 1e-6:
+                sys.exit(f'sparse and point by point remaps differ by up to {max_diff}')
+        print('sparse and point by point remaps match')
@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+import xarray as xr
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local stand-ins for the servers the harvesters talk to (PODAAC OpenSearch, NSIDC CMR,
+# the NSIDC and OSI SAF FTP sites, and Solr), so harvesters can be benchmarked repeatably.
+# Every granule served is a copy of one synthetic netCDF file, under the names and
+# directory layouts the real servers use. Latency (seconds added before each response)
+# and bandwidth (bytes per second per transfer) can be injected.
+
+
+# Writes a synthetic netCDF granule with the given fields on a global lat/lon grid
+def make_granule(path, fields, shape=(180, 360)):
+    lat = np.linspace(-90, 90, shape[0])
+    lon = np.linspace(-180, 180, shape[1])
+    data_vars = {}
+    for field in fields:
+        data = np.random.rand(1, *shape).astype('float32')
+        data_vars[field] = (('time', 'lat', 'lon'), data,
+                            {'units': '1', '_FillValue': np.float32(-9999)})
+
+    ds = xr.Dataset(data_vars, coords={'time': [np.datetime64('2000-01-01')],
+                                       'lat': lat, 'lon': lon})
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    ds.to_netcdf(path)
+    return path
+
+
+# Minimal in memory Solr supporting the select and update calls the pipeline makes
+# Filter queries are exact matches on field:value, and updates understand atomic "set"
+class SolrStub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.docs = {}
+        self.next_id = 0
+
+    def reset(self):
+        with self.lock:
+            self.docs = {}
+
+    def select(self, fqs):
+        filters = [fq.split(':', 1) for fq in fqs]
+        with self.lock:
+            return [dict(doc) for doc in self.docs.values()
+                    if all(str(doc.get(k)) == v.strip('"') for k, v in filters)]
+
+    def update(self, body):
+        with self.lock:
+            for doc in body:
+                doc = {k: (v['set'] if isinstance(v, dict) and 'set' in v else v)
+                       for k, v in doc.items()}
+                if 'id' not in doc or doc['id'] not in self.docs:
+                    if 'id' not in doc:
+                        self.next_id += 1
+                        doc['id'] = str(self.next_id)
+                    self.docs[doc['id']] = doc
+                else:
+                    self.docs[doc['id']].update(doc)
+
+
+# HTTP server for PODAAC's OpenSearch feed and files, CMR granule search and a Solr stub
+#   /opensearch?datasetId=..&startTime=..&endTime=..  Atom feed of a dataset's granules
+#   /cmr/search/granules.json?short_name=..            CMR JSON, served as a single scroll page
+#   /data/<filename>                                   granule files (OPeNDAP links end in .html)
+#   /solr/<collection>/select and /update              SolrStub
+class StandinHTTPServer:
+    def __init__(self, granule_fp, latency=0, bandwidth=None, port=0, page_size=100):
+        self.granule_fp = granule_fp
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page_size = page_size
+        self.podaac_datasets = {}
+        self.cmr_collections = {}
+        self.solr = SolrStub()
+
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    # granules is a list of (filename, start datetime, end datetime)
+    def add_podaac_dataset(self, podaac_id, granules):
+        self.podaac_datasets[podaac_id] = granules
+
+    # granules is a list of filenames
+    def add_cmr_collection(self, short_name, granules):
+        self.cmr_collections[short_name] = granules
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _atom_feed(self, query):
+        podaac_id = query.get('datasetId', [''])[0]
+        start = query.get('startTime', [''])[0]
+        end = query.get('endTime', [''])[0]
+        start_index = int(query.get('startIndex', ['0'])[0])
+
+        granules = self.podaac_datasets.get(podaac_id, [])
+        if start:
+            start_dt = datetime.strptime(start, '%Y%m%dT%H:%M:%SZ')
+            granules = [g for g in granules if g[1] >= start_dt]
+        if end:
+            end_dt = datetime.strptime(end, '%Y%m%dT%H:%M:%SZ')
+            granules = [g for g in granules if g[1] <= end_dt]
+
+        page = granules[start_index:start_index + self.page_size]
+        updated = datetime.utcfromtimestamp(
+            os.path.getmtime(self.granule_fp)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        entries = []
+        for filename, start_dt, end_dt in page:
+            entries.append(
+                '<entry>'
+                f'<title>{filename}</title>'
+                f'<updated>{updated}</updated>'
+                f'<link href="{self.url}/data/{filename}.html" title="OPeNDAP URL"/>'
+                f'<time:start>{start_dt.strftime("%Y-%m-%dT%H:%M:%SZ")}</time:start>'
+                f'<time:end>{end_dt.strftime("%Y-%m-%dT%H:%M:%SZ")}</time:end>'
+                '</entry>')
+
+        next_link = ''
+        if start_index + self.page_size < len(granules):
+            next_query = dict(query)
+            next_query['startIndex'] = [str(start_index + self.page_size)]
+            params = '&amp;'.join([f'{k}={v[0]}' for k, v in next_query.items()])
+            next_link = f'<link rel="next" href="{self.url}/opensearch?{params}"/>'
+
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<feed xmlns="http://www.w3.org/2005/Atom" '
+                'xmlns:time="http://a9.com/-/opensearch/extensions/time/1.0/">'
+                f'{next_link}{"".join(entries)}</feed>').encode('utf-8')
+
+    def _cmr_feed(self, query, scrolled):
+        granules = [] if scrolled else self.cmr_collections.get(
+            query.get('short_name', [''])[0], [])
+        entries = [{'links': [{'href': f'{self.url}/data/{filename}',
+                               'rel': 'http://esipfed.org/ns/fedsearch/1.1/data#'}]}
+                   for filename in granules]
+        return json.dumps({'feed': {'entry': entries}}).encode('utf-8')
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, body, content_type, headers={}, head=False):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if not head:
+                    # Clients that only check a url (ex: credential checks) hang up early
+                    try:
+                        send_throttled(self.wfile, body, standin.bandwidth)
+                    except (BrokenPipeError, ConnectionResetError):
+                        self.close_connection = True
+
+            def _route(self, head=False):
+                time.sleep(standin.latency)
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+
+                if parsed.path == '/opensearch':
+                    self._send(standin._atom_feed(query),
+                               'application/atom+xml', head=head)
+
+                elif parsed.path == '/cmr/search/granules.json':
+                    scrolled = 'cmr-scroll-id' in self.headers
+                    hits = len(standin.cmr_collections.get(
+                        query.get('short_name', [''])[0], []))
+                    self._send(standin._cmr_feed(query, scrolled), 'application/json',
+                               {'CMR-Scroll-Id': 'standin', 'CMR-Hits': str(hits)}, head=head)
+
+                elif parsed.path.startswith('/data/'):
+                    with open(standin.granule_fp, 'rb') as f:
+                        body = f.read()
+                    self._send(body, 'application/x-netcdf', head=head)
+
+                elif parsed.path.startswith('/solr/') and parsed.path.endswith('/select'):
+                    docs = standin.solr.select(query.get('fq', []))
+                    self._send(json.dumps({'response': {'docs': docs}}).encode('utf-8'),
+                               'application/json', head=head)
+
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                self._route()
+
+            def do_HEAD(self):
+                self._route(head=True)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'[]')
+                if urlparse(self.path).path.endswith('/update'):
+                    standin.solr.update(body)
+                    self._send(b'{"responseHeader":{"status":0}}',
+                               'application/json')
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+
+# Writes data in chunks paced to the given bandwidth in bytes per second
+def send_throttled(wfile, data, bandwidth=None, chunk_size=64 * 1024):
+    if not bandwidth:
+        wfile.write(data)
+        return
+
+    t0 = time.time()
+    for i in range(0, len(data), chunk_size):
+        wfile.write(data[i:i + chunk_size])
+        ahead = (i + chunk_size) / bandwidth - (time.time() - t0)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+# FTP server serving a directory tree, with '.' and '..' in listings like the NSIDC site
+class StandinFTPServer:
+    def __init__(self, root_dir, latency=0, bandwidth=None, port=0):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.filesystems import AbstractedFS
+        from pyftpdlib.handlers import FTPHandler, DTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+
+        class DotEntriesFS(AbstractedFS):
+            def listdir(self, path):
+                return ['.', '..'] + sorted(super().listdir(path))
+
+        class DelayedFTPHandler(FTPHandler):
+            def ftp_RETR(self, file):
+                time.sleep(latency)
+                return super().ftp_RETR(file)
+
+            def ftp_LIST(self, path):
+                time.sleep(latency)
+                return super().ftp_LIST(path)
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(root_dir)
+
+        # Paces every chunk sent, since pyftpdlib's own throttling averages over whole seconds
+        # and lets small granules through unthrottled. Each connection has its own thread
+        # in a ThreadedFTPServer, so sleeping only holds up that transfer
+        class BandwidthDTPHandler(DTPHandler):
+            def send(self, data):
+                if bandwidth:
+                    time.sleep(len(data) / bandwidth)
+                return super().send(data)
+
+        DelayedFTPHandler.authorizer = authorizer
+        DelayedFTPHandler.abstracted_fs = DotEntriesFS
+        DelayedFTPHandler.dtp_handler = BandwidthDTPHandler
+        DelayedFTPHandler.use_sendfile = not bandwidth
+        DelayedFTPHandler.banner = 'stand-in ftp server'
+
+        self.server = ThreadedFTPServer(('127.0.0.1', port), DelayedFTPHandler)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'handle_exit': False}, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.close_all()
+
+
+# Places a copy of the granule at path, hardlinked when possible to save disk
+def place_granule(granule_fp, path):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    try:
+        os.link(granule_fp, path)
+    except OSError:
+        shutil.copy(granule_fp, path)
+
+
+# Daily granule dates starting at start
+def daily_dates(start, count):
+    return list(pd.date_range(start, periods=count, freq='D').to_pydatetime())
+
+
+# ddir/region/time_scale/year/ layout of the NSIDC sea ice FTP site
+def build_nsidc_tree(root_dir, granule_fp, ddir, regions, data_time_scale, dates):
+    for region in regions:
+        hemi = 'nh' if region == 'north' else 'sh'
+        for date in dates:
+            filename = f'seaice_conc_{data_time_scale}_{hemi}_{date.strftime("%Y%m%d")}_v04r00.nc'
+            place_granule(granule_fp, os.path.join(
+                root_dir, ddir, region, data_time_scale, str(date.year), filename))
+
+
+# ddir/year/month/ layout of the OSI SAF FTP site
+def build_osisaf_tree(root_dir, granule_fp, ddir, regions, filename_filter, dates):
+    for region in regions:
+        hemi = 'nh' if region == 'north' else 'sh'
+        for date in dates:
+            filename = f'{filename_filter}_{hemi}_polstere-100_multi_{date.strftime("%Y%m%d")}1200.nc'
+            place_granule(granule_fp, os.path.join(
+                root_dir, ddir, str(date.year), f'{date.month:02d}', filename))
@@ -3,18 +3,31 @@ import sys
 import yaml
 import logging
 import importlib
+import multiprocessing
 import numpy as np
 import tkinter as tk
 from pathlib import Path
 from shutil import copyfile
 from tkinter import filedialog
 from collections import defaultdict
+from contextlib import redirect_stdout
+from urllib.parse import urlparse
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
+# Shared harvester utilities
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'harvesters'))
+import harvest_telemetry  # pylint: disable=import-error
 
 # Hardcoded output directory path for pipeline files
 # Leave blank to be prompted for an output directory
 output_dir = ''
 
+# Number of datasets harvested at once, and the most of those harvesting from the same remote host
+# With 1 worker, datasets are harvested one after another
+harvest_workers = 1
+harvest_workers_per_host = 1
+
 
 def print_log(log_path):
     print('\n=========================================================')
@@ -65,64 +78,178 @@ def print_log(log_path):
                     print(f'\t\t\033[91m{message}\033[0m')
 
 
-def run_harvester(datasets, path_to_harvesters, output_dir):
-    print('\n=========================================================')
-    print(
-        '================== \033[36mRunning harvesters\033[0m ===================')
-    print('=========================================================\n')
-    for ds in datasets:
-        harv_logger = logging.getLogger(f'pipeline.{ds}.harvester')
-        try:
-            print(f'\033[93mRunning harvester for {ds}\033[0m')
-            print('=========================================================')
+# Remote host a dataset's harvester mostly waits on, used to cap concurrent harvests per host
+# Datasets without a host in their config are grouped by harvester type
+def harvest_host(ds):
+    config_path = Path(
+        f'{Path(__file__).resolve().parents[2]}/datasets/{ds}/harvester_config.yaml'
+    )
+    with open(config_path, 'r') as stream:
+        config = yaml.load(stream, yaml.Loader)
 
-            config_path = Path(
-                f'{Path(__file__).resolve().parents[2]}/datasets/{ds}/harvester_config.yaml'
-            )
+    host = config.get('host', '') or config.get('harvester_type', '')
+    return urlparse(host).netloc or host
 
-            with open(config_path, 'r') as stream:
-                config = yaml.load(stream, yaml.Loader)
 
-            if 'harvester_type' in config.keys():
-                harvester_type = config['harvester_type']
+# Runs the local harvester of a single dataset
+# If stdout_path is given, the harvester's printed output is written there instead of the console
+# Returns whether the harvest succeeded
+def harvest_dataset(ds, path_to_harvesters, output_dir, stdout_path=''):
+    harv_logger = logging.getLogger(f'pipeline.{ds}.harvester')
+    path_to_code = None
+    try:
+        config_path = Path(
+            f'{Path(__file__).resolve().parents[2]}/datasets/{ds}/harvester_config.yaml'
+        )
 
-                if harvester_type not in ['podaac', 'osisaf_ftp', 'nsidc_ftp']:
-                    print(f'{harvester_type} is not a supported harvester type.')
-                    break
+        with open(config_path, 'r') as stream:
+            config = yaml.load(stream, yaml.Loader)
+
+        if 'harvester_type' in config.keys():
+            harvester_type = config['harvester_type']
+
+            if harvester_type not in ['podaac', 'osisaf_ftp', 'nsidc_ftp']:
+                raise ValueError(
+                    f'{harvester_type} is not a supported harvester type.')
+
+            path_to_code = Path(
+                f'{path_to_harvesters}/{harvester_type}_harvester/')
 
+            if 'RDEFT4' in ds:
                 path_to_code = Path(
-                    f'{path_to_harvesters}/{harvester_type}_harvester/')
+                    f'{path_to_harvesters}/{harvester_type}_harvester/RDEFT4_ftp_harvester/'
+                )
+                harvester = 'seaice_harvester_local'
+            elif harvester_type == 'podaac':
+                harvester = 'podaac_harvester_local'
+            elif harvester_type == 'osisaf_ftp':
+                harvester = 'osisaf_ftp_harvester_local'
+            elif harvester_type == 'nsidc_ftp':
+                harvester = 'nsidc_ftp_harvester_local'
 
-                if 'RDEFT4' in ds:
-                    path_to_code = Path(
-                        f'{path_to_harvesters}/{harvester_type}_harvester/RDEFT4_ftp_harvester/'
-                    )
-                    harvester = 'seaice_harvester_local'
-                elif harvester_type == 'podaac':
-                    harvester = 'podaac_harvester_local'
-                elif harvester_type == 'osisaf_ftp':
-                    harvester = 'osisaf_ftp_harvester_local'
-                elif harvester_type == 'nsidc_ftp':
-                    harvester = 'nsidc_ftp_harvester_local'
+            sys.path.insert(1, str(path_to_code))
 
-                sys.path.insert(1, str(path_to_code))
+            # Clear the last run's telemetry so a failed harvest isn't reported with old numbers
+            telemetry_path = f'{output_dir}{ds}/harvest_telemetry.json'
+            if os.path.exists(telemetry_path):
+                os.remove(telemetry_path)
 
-                try:
-                    ret_import = importlib.reload(ret_import)
-                except:
-                    ret_import = importlib.import_module(harvester)
+            ret_import = importlib.import_module(harvester)
 
+            if stdout_path:
+                if not os.path.exists(os.path.dirname(stdout_path)):
+                    os.makedirs(os.path.dirname(stdout_path))
+                with open(stdout_path, 'w', buffering=1) as f, redirect_stdout(f):
+                    ret_import.main(config_path=config_path,
+                                    output_path=output_dir)
+            else:
                 ret_import.main(config_path=config_path,
                                 output_path=output_dir)
-                sys.path.remove(str(path_to_code))
+            sys.path.remove(str(path_to_code))
 
-            harv_logger.info(f'Harvest successful')
-            print('\033[92mHarvest successful\033[0m')
-        except Exception as e:
+        harv_logger.info(f'Harvest successful')
+        return True
+    except Exception as e:
+        if path_to_code and str(path_to_code) in sys.path:
             sys.path.remove(str(path_to_code))
-            harv_logger.info(f'Harvest failed: {e}')
-            print('\033[91mHarvesting failed\033[0m')
+        harv_logger.info(f'Harvest failed: {e}')
+        return False
+
+
+# Sends a harvester worker's pipeline log records back to the main process, which writes
+# them with its own handlers under the pipeline.{ds}.harvester logger they were made with
+def init_harvest_worker(log_queue):
+    logger = logging.getLogger('pipeline')
+    logger.handlers = [QueueHandler(log_queue)]
+    logger.setLevel(logging.DEBUG)
+
+
+# Harvests datasets in worker processes, at most workers at once and at most
+# host_workers at once from the same remote host
+# Each harvester's printed output goes to {output_dir}{ds}/harvester_output.log
+def run_harvesters_concurrently(datasets, path_to_harvesters, output_dir, workers, host_workers):
+    hosts = {}
+    for ds in datasets:
+        try:
+            hosts[ds] = harvest_host(ds)
+        except Exception:
+            hosts[ds] = ds
+
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(
+        log_queue, *logging.getLogger('pipeline').handlers, respect_handler_level=True)
+    listener.start()
+
+    pending = list(datasets)
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_harvest_worker,
+                             initargs=(log_queue,)) as executor:
+        while pending or running:
+            # Start the next datasets whose hosts have room, keeping the listing order otherwise
+            for ds in list(pending):
+                if len(running) >= workers:
+                    break
+                if [host for _, host in running.values()].count(hosts[ds]) >= host_workers:
+                    continue
+
+                pending.remove(ds)
+                stdout_path = f'{output_dir}{ds}/harvester_output.log'
+                future = executor.submit(
+                    harvest_dataset, ds, path_to_harvesters, output_dir, stdout_path)
+                running[future] = (ds, hosts[ds])
+                print(f'\033[93mRunning harvester for {ds}\033[0m ({hosts[ds]})')
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                ds, _ = running.pop(future)
+                try:
+                    success = future.result()
+                except Exception as e:
+                    logging.getLogger(f'pipeline.{ds}.harvester').info(
+                        f'Harvest failed: {e}')
+                    success = False
+
+                if success:
+                    print(f'\033[92mHarvest successful\033[0m for {ds}')
+                else:
+                    print(f'\033[91mHarvesting failed\033[0m for {ds}')
+
+    listener.stop()
+
+
+def run_harvester(datasets, path_to_harvesters, output_dir, workers=1, host_workers=1):
+    print('\n=========================================================')
+    print(
+        '================== \033[36mRunning harvesters\033[0m ===================')
+    print('=========================================================\n')
+
+    if workers > 1 and len(datasets) > 1:
+        run_harvesters_concurrently(
+            datasets, path_to_harvesters, output_dir, workers, host_workers)
         print('=========================================================')
+    else:
+        for ds in datasets:
+            print(f'\033[93mRunning harvester for {ds}\033[0m')
+            print('=========================================================')
+
+            if harvest_dataset(ds, path_to_harvesters, output_dir):
+                print('\033[92mHarvest successful\033[0m')
+            else:
+                print('\033[91mHarvesting failed\033[0m')
+            print('=========================================================')
+
+
+# Combines the harvest telemetry of every dataset harvested this run into one report next to pipeline.log
+# Called once after all harvests, since run_harvester is called one dataset at a time by some options
+def merge_harvest_telemetry(datasets, output_dir):
+    if not datasets:
+        return
+
+    telemetry_paths = [
+        f'{output_dir}{ds}/harvest_telemetry.json' for ds in datasets]
+    harvest_telemetry.merge_reports(
+        telemetry_paths, f'{output_dir}/harvest_telemetry.json')
 
 
 def run_transformation(datasets, path_to_preprocessing, output_dir):
@@ -336,16 +463,31 @@ if __name__ == '__main__':
     ch.setFormatter(ch_formatter)
     logger.addHandler(ch)
 
+    # Datasets harvested this run, whose telemetry is merged at the end
+    harvested = []
+
+    # Concurrent harvests run for every dataset before the later steps start
+    if chosen_option in ['1', '3'] and harvest_workers > 1:
+        run_harvester(datasets, path_to_harvesters, output_dir,
+                      harvest_workers, harvest_workers_per_host)
+        harvested.extend(datasets)
+
     if chosen_option == '1':
         for ds in datasets:
-            run_harvester([ds], path_to_harvesters, output_dir)
+            if harvest_workers <= 1:
+                run_harvester([ds], path_to_harvesters, output_dir)
+                harvested.append(ds)
             run_transformation([ds], path_to_preprocessing, output_dir)
             run_aggregation([ds], path_to_preprocessing, output_dir)
     elif chosen_option == '2':
-        run_harvester(datasets, path_to_harvesters, output_dir)
+        run_harvester(datasets, path_to_harvesters, output_dir,
+                      harvest_workers, harvest_workers_per_host)
+        harvested.extend(datasets)
     elif chosen_option == '3':
         for ds in datasets:
-            run_harvester([ds], path_to_harvesters, output_dir)
+            if harvest_workers <= 1:
+                run_harvester([ds], path_to_harvesters, output_dir)
+                harvested.append(ds)
             run_transformation([ds], path_to_preprocessing, output_dir)
     elif chosen_option == '4':
         while True:
@@ -369,6 +511,7 @@ if __name__ == '__main__':
         for step in wanted_steps:
             if step == 'harvest':
                 run_harvester([wanted_ds], path_to_harvesters, output_dir)
+                harvested.append(wanted_ds)
             elif step == 'transform':
                 run_transformation(
                     [wanted_ds], path_to_preprocessing, output_dir)
@@ -376,6 +519,7 @@ if __name__ == '__main__':
                 run_aggregation([wanted_ds], path_to_preprocessing, output_dir)
             elif step == 'all':
                 run_harvester([wanted_ds], path_to_harvesters, output_dir)
+                harvested.append(wanted_ds)
                 run_transformation(
                     [wanted_ds], path_to_preprocessing, output_dir)
                 run_aggregation([wanted_ds], path_to_preprocessing, output_dir)
@@ -391,10 +535,13 @@ if __name__ == '__main__':
                     break
             if yes_no == 'Y':
                 run_harvester([ds], path_to_harvesters, output_dir)
+                harvested.append(ds)
                 run_transformation([ds], path_to_preprocessing, output_dir)
                 run_aggregation([ds], path_to_preprocessing, output_dir)
             elif yes_no == 'E':
                 break
             else:  # yes_no == 'N'
                 continue
+
+    merge_harvest_telemetry(list(dict.fromkeys(harvested)), output_dir)
     print_log(logger_path)